@@ -19,3 +19,7 @@ class AppDelegate(NSObject):
         NSLog("Application did finish launching.")
         if self.mainController:
             self.mainController.start()
+
+    def applicationWillTerminate_(self, notification):
+        if self.mainController:
+            self.mainController.cancel()
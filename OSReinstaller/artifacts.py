@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+#  artifacts.py
+#  OSReinstaller
+#
+#  Cache of built installers. Once Install macOS.app has been built from a
+#  product, it is kept as a compressed read-only disk image keyed by product
+#  id, version and build, so a later run for the same build mounts the
+#  image and skips the download and installer steps.
+#
+
+import os
+import re
+import sys
+import time
+import plistlib
+import threading
+
+from xml.parsers.expat import ExpatError
+
+import imaging
+from progress import format_bytes
+
+
+INDEX_NAME = 'artifacts.plist'
+# built installers kept, least recently used ones are removed first
+MAX_ENTRIES = 2
+
+
+def artifact_key(product_id, item):
+    '''Returns the cache key of a product_info entry'''
+    key = '%s-%s-%s' % (product_id, item.get('version') or 'unknown',
+                        item.get('BUILD') or 'unknown')
+    return re.sub(r'[^A-Za-z0-9._-]', '_', key)
+
+
+class ArtifactCache(object):
+    '''Built installer images below root_dir, with an index recording their
+    size and use and the hits and misses of all lookups'''
+
+    def __init__(self, root_dir, max_entries=MAX_ENTRIES):
+        self.root_dir = root_dir
+        self.max_entries = max_entries
+        self.index_path = os.path.join(root_dir, INDEX_NAME)
+        self._lock = threading.Lock()
+        self._index = None
+
+    def path_for(self, key):
+        return os.path.join(self.root_dir, key + '.dmg')
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                self._index = plistlib.readPlist(self.index_path)
+            except (OSError, IOError, ExpatError):
+                self._index = {}
+            self._index.setdefault('hits', 0)
+            self._index.setdefault('misses', 0)
+            self._index.setdefault('entries', {})
+        return self._index
+
+    def _save_index(self):
+        if not os.path.isdir(self.root_dir):
+            os.makedirs(self.root_dir)
+        temp_path = self.index_path + '.tmp'
+        try:
+            plistlib.writePlist(self._index, temp_path)
+            os.rename(temp_path, self.index_path)
+        except (OSError, IOError), err:
+            print >> sys.stderr, 'Error writing %s: %s' % (self.index_path, err)
+
+    def lookup(self, key):
+        '''Returns the path of the image for key, or None. Counts a hit or a
+        miss.'''
+        path = self.path_for(key)
+        with self._lock:
+            index = self._load_index()
+            entry = index['entries'].get(key)
+            if entry is not None and os.path.exists(path):
+                index['hits'] += 1
+                entry['last_used'] = int(time.time())
+            else:
+                index['entries'].pop(key, None)
+                index['misses'] += 1
+                path = None
+            self._save_index()
+        return path
+
+    def store(self, key, app_path):
+        '''Builds the image for key from app_path and returns its path'''
+        if not os.path.isdir(self.root_dir):
+            os.makedirs(self.root_dir)
+        path = self.path_for(key)
+        # hdiutil wants the .dmg extension; the image only gets its final
+        # name once it is complete
+        temp_path = path[:-len('.dmg')] + '.partial.dmg'
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        imaging.make_compressed_dmg(app_path, temp_path)
+        os.rename(temp_path, path)
+        with self._lock:
+            index = self._load_index()
+            index['entries'][key] = {
+                'size': os.path.getsize(path),
+                'created': int(time.time()),
+                'last_used': int(time.time()),
+            }
+            self._prune(index, keep=key)
+            self._save_index()
+        return path
+
+    def _prune(self, index, keep):
+        entries = index['entries']
+        by_use = sorted(entries, key=lambda key: entries[key]['last_used'],
+                        reverse=True)
+        for key in by_use[self.max_entries:]:
+            if key == keep:
+                continue
+            print 'Removing cached installer %s' % key
+            try:
+                os.unlink(self.path_for(key))
+            except OSError:
+                pass
+            del entries[key]
+
+    def stats(self):
+        '''Returns a dict with the number of entries, their total size, hits,
+        misses and the hit rate'''
+        with self._lock:
+            index = self._load_index()
+            lookups = index['hits'] + index['misses']
+            return {
+                'entries': len(index['entries']),
+                'size': sum(entry['size'] for entry in index['entries'].values()),
+                'hits': index['hits'],
+                'misses': index['misses'],
+                'hit_rate': float(index['hits']) / lookups if lookups else 0.0,
+            }
+
+
+def format_stats(stats):
+    return ('%d built installers, %s, %d hits, %d misses, %.0f%% hit rate'
+            % (stats['entries'], format_bytes(stats['size']), stats['hits'],
+               stats['misses'], stats['hit_rate'] * 100))
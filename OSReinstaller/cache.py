@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#  OSReinstaller
+#
+#  Persistent, verified package cache below workdir. Complete files are
+#  checked against the catalog's Size and Digest fields, partially
+#  downloaded files keep a small state file next to them so an interrupted
+#  download can be resumed with Range requests.
+#
+
+import os
+import sys
+import hashlib
+import plistlib
+import threading
+
+from xml.parsers.expat import ExpatError
+
+
+STATE_SUFFIX = '.download'
+VALIDATORS_SUFFIX = '.validators'
+INDEX_NAME = '.cacheindex.plist'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_for_digest(digest):
+    '''Returns a new hash object matching the length of a catalog digest'''
+    if len(digest) == 64:
+        return hashlib.sha256()
+    return hashlib.sha1()
+
+
+def file_digest(path, digest):
+    '''Returns the hex digest of the file at path, using the same algorithm
+    as the catalog digest it is compared to'''
+    hasher = hash_for_digest(digest)
+    with open(path, 'rb') as fileobj:
+        while True:
+            data = fileobj.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+class PackageCache(object):
+    '''Tracks which replicated files below root_dir are complete.
+
+    Digests that were verified once are remembered in an index together with
+    the file's size and mtime, so a rerun doesn't hash multi-GB packages
+    again.'''
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.index_path = os.path.join(root_dir, INDEX_NAME)
+        self._lock = threading.Lock()
+        self._index = None
+
+    def state_path(self, path):
+        return path + STATE_SUFFIX
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                self._index = plistlib.readPlist(self.index_path)
+            except (OSError, IOError, ExpatError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        if not os.path.isdir(self.root_dir):
+            os.makedirs(self.root_dir)
+        temp_path = self.index_path + '.tmp'
+        plistlib.writePlist(self._index, temp_path)
+        os.rename(temp_path, self.index_path)
+
+    def _index_key(self, path):
+        return os.path.relpath(path, self.root_dir)
+
+    def is_complete(self, path, size=None, digest=None):
+        '''Returns True if path is a complete download matching size and
+        digest'''
+        if os.path.exists(self.state_path(path)):
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if size is not None and stat.st_size != size:
+            return False
+        if not digest:
+            return True
+        key = self._index_key(path)
+        with self._lock:
+            entry = self._load_index().get(key)
+        if (entry and entry.get('digest') == digest.lower() and
+                entry.get('size') == stat.st_size and
+                entry.get('mtime') == int(stat.st_mtime)):
+            return True
+        if file_digest(path, digest) != digest.lower():
+            print >> sys.stderr, 'Cached %s does not match digest' % path
+            return False
+        self.record(path, digest)
+        return True
+
+    def record(self, path, digest):
+        '''Remembers that path matched digest'''
+        stat = os.stat(path)
+        with self._lock:
+            self._load_index()[self._index_key(path)] = {
+                'digest': digest.lower(),
+                'size': stat.st_size,
+                'mtime': int(stat.st_mtime),
+            }
+            self._save_index()
+
+    def path_for_digest(self, digest):
+        '''Returns the path of a complete file that was verified against
+        digest, or None. The index is read from disk, so files recorded by
+        another PackageCache are found as well.'''
+        try:
+            index = plistlib.readPlist(self.index_path)
+        except (OSError, IOError, ExpatError):
+            return None
+        digest = digest.lower()
+        for key, entry in index.items():
+            if entry.get('digest') != digest:
+                continue
+            path = os.path.join(self.root_dir, key)
+            if os.path.exists(self.state_path(path)):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (entry.get('size') == stat.st_size and
+                    entry.get('mtime') == int(stat.st_mtime)):
+                return path
+        return None
+
+    def load_state(self, path):
+        '''Returns the resume state of a partial download or None'''
+        state_path = self.state_path(path)
+        if not os.path.exists(state_path) or not os.path.exists(path):
+            return None
+        try:
+            return plistlib.readPlist(state_path)
+        except (OSError, IOError, ExpatError), err:
+            print >> sys.stderr, 'Error reading %s: %s' % (state_path, err)
+            return None
+
+    def save_state(self, path, state):
+        '''Writes the resume state of a partial download'''
+        state_path = self.state_path(path)
+        temp_path = state_path + '.tmp'
+        plistlib.writePlist(state, temp_path)
+        os.rename(temp_path, state_path)
+
+    def clear_state(self, path):
+        try:
+            os.unlink(self.state_path(path))
+        except OSError:
+            pass
+
+    def load_validators(self, path):
+        '''Returns the HTTP validators (ETag, Last-Modified) stored for a
+        replicated file, or an empty dict'''
+        if not os.path.exists(path):
+            return {}
+        try:
+            return plistlib.readPlist(path + VALIDATORS_SUFFIX)
+        except (OSError, IOError, ExpatError):
+            return {}
+
+    def save_validators(self, path, validators):
+        temp_path = path + VALIDATORS_SUFFIX + '.tmp'
+        plistlib.writePlist(validators, temp_path)
+        os.rename(temp_path, path + VALIDATORS_SUFFIX)
+
+    def discard(self, path):
+        '''Removes a file and its resume state from the cache'''
+        self.clear_state(path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
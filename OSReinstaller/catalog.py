@@ -0,0 +1,801 @@
+# -*- coding: utf-8 -*-
+#
+#  catalog.py
+#  OSReinstaller
+#
+#  Streaming softwareupdate catalog parser. The merged catalogs hold tens of
+#  thousands of products; only the few macOS installers are kept, everything
+#  else is dropped as soon as its product dict has been read. The result is
+#  kept in a product index until the catalog changes on the server.
+#
+#  Also downloads the catalog and the ServerMetadata and dist files needed
+#  to pick an installer. When the catalog was republished, it is diffed
+#  against the previous snapshot so only the files of new and changed
+#  products are fetched again. Dist files are read with a streaming parser
+#  too, collecting the auxinfo and the install sizes and order of the
+#  packages in one pass.
+#
+
+import os
+import sys
+import base64
+import datetime
+import plistlib
+
+from distutils.version import LooseVersion
+from xml.parsers import expat
+
+import fetch
+import instrument
+from cache import PackageCache
+from fetch import ReplicationError
+from progress import NULL_PROGRESS
+
+
+OSINSTALL_IDENTIFIER = 'com.apple.mpkg.OSInstall'
+READ_SIZE = 256 * 1024
+
+INDEX_NAME = 'productindex.plist'
+# dist file elements whose text is needed
+TEXT_ELEMENTS = ('key', 'string', 'pkg-ref')
+# the product_info fields kept in the index
+INDEX_FIELDS = ('title', 'version', 'BUILD', 'PostDate', 'DistributionPath')
+
+
+def is_mac_os_installer(product):
+    '''Returns True if a catalog product dict looks like a macOS installer'''
+    try:
+        return (product['ExtendedMetaInfo'][
+            'InstallAssistantPackageIdentifiers'][
+                'OSInstall'] == OSINSTALL_IDENTIFIER)
+    except (KeyError, TypeError):
+        return False
+
+
+def installers_by_postdate(catalog):
+    '''Returns the keys of the macOS installer products in catalog, most
+    recently posted first'''
+    products = catalog.get('Products', {})
+    keys = [key for key in products if is_mac_os_installer(products[key])]
+    return sorted(keys, key=lambda key: products[key].get('PostDate'),
+                  reverse=True)
+
+
+def installer_sort_key(info):
+    '''Sort key for product_info entries: version, then PostDate'''
+    return (LooseVersion(info.get('version') or '0'),
+            info.get('PostDate') or '')
+
+
+def select_product(product_info, build=None):
+    '''Returns the key of the newest installer in product_info whose dist
+    file has been fetched, or of the newest one with BUILD build. Returns
+    None if there is no such product.'''
+    candidates = [key for key, info in product_info.items()
+                  if info.get('DistributionPath') and
+                  (build is None or info.get('BUILD') == build)]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda key: installer_sort_key(product_info[key]))
+
+
+def product_fingerprint(product):
+    '''The parts of a catalog product that change when it is republished'''
+    return (
+        str(product.get('PostDate')),
+        product.get('ServerMetadataURL'),
+        sorted((product.get('Distributions') or {}).items()),
+        sorted((package.get('URL'), package.get('MetadataURL'),
+                package.get('Size'), package.get('Digest'))
+               for package in product.get('Packages', [])),
+    )
+
+
+def product_urls(product):
+    '''Returns the URLs of the files replicated for a catalog product'''
+    urls = [product.get('ServerMetadataURL')]
+    urls.extend((product.get('Distributions') or {}).values())
+    for package in product.get('Packages', []):
+        urls.extend([package.get('URL'), package.get('MetadataURL'),
+                     package.get('IntegrityDataURL')])
+    return set(url for url in urls if url)
+
+
+def diff_catalogs(old, new):
+    '''Compares the products of two catalogs by key, PostDate and URLs.
+    Returns a dict of sorted product key lists: added, changed, removed and
+    unchanged.'''
+    old_products = old.get('Products', {})
+    new_products = new.get('Products', {})
+    diff = {'added': [], 'changed': [], 'removed': [], 'unchanged': []}
+    for key, product in new_products.items():
+        if key not in old_products:
+            diff['added'].append(key)
+        elif product_fingerprint(old_products[key]) != product_fingerprint(
+                product):
+            diff['changed'].append(key)
+        else:
+            diff['unchanged'].append(key)
+    diff['removed'] = [key for key in old_products if key not in new_products]
+    for keys in diff.values():
+        keys.sort()
+    return diff
+
+
+def _string(text):
+    '''Returns text as str if it is plain ASCII, like plistlib does'''
+    try:
+        return text.encode('ascii')
+    except UnicodeError:
+        return text
+
+
+class CatalogParser(object):
+    '''Incremental plist parser that keeps only the products for which
+    product_filter returns True. Everything outside Products is kept as is.
+
+    Products are not built while they are read: the parser only counts
+    nesting and remembers where the product starts. Products whose raw
+    bytes contain marker are then parsed on their own and passed to
+    product_filter, all others are dropped without ever being decoded.'''
+
+    def __init__(self, product_filter=is_mac_os_installer,
+                 marker=OSINSTALL_IDENTIFIER):
+        self.product_filter = product_filter
+        self.marker = marker
+        self.root = None
+        # stack of [container, pending key] pairs
+        self._stack = []
+        self._text = []
+        # raw bytes fed to the parser that a product may still need
+        self._chunks = []
+        self._chunks_offset = 0
+        # offset of the last element the parser reported; a tag it hasn't
+        # reported yet, like a <dict> split across two reads, starts after it
+        self._reported = 0
+        self._product_start = None
+        self._depth = 0
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._build_mode()
+
+    def feed(self, data):
+        self._chunks.append(data)
+        self._parser.Parse(data, False)
+        # drop everything before the product currently being read, or
+        # before what the parser hasn't reported yet
+        keep_from = self._product_start
+        if keep_from is None:
+            keep_from = self._reported
+        while self._chunks and (self._chunks_offset + len(self._chunks[0])
+                                <= keep_from):
+            self._chunks_offset += len(self._chunks.pop(0))
+
+    def close(self):
+        self._parser.Parse('', True)
+        return self.root
+
+    def _build_mode(self):
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    def _skip_mode(self):
+        self._parser.StartElementHandler = self._skip_start
+        self._parser.EndElementHandler = self._skip_end
+        self._parser.CharacterDataHandler = None
+
+    def _in_products(self):
+        '''True if the next value completes a product of the root Products
+        dict'''
+        return (len(self._stack) == 2 and
+                self._stack[0][1] == 'Products')
+
+    def _start(self, name, attrs):
+        self._text = []
+        self._reported = self._parser.CurrentByteIndex
+        if name == 'dict' and self._in_products():
+            self._product_start = self._parser.CurrentByteIndex
+            self._depth = 1
+            self._skip_mode()
+        elif name == 'dict':
+            self._stack.append([{}, None])
+        elif name == 'array':
+            self._stack.append([[], None])
+
+    def _skip_start(self, name, attrs):
+        if name == 'dict' or name == 'array':
+            self._depth += 1
+
+    def _skip_end(self, name):
+        if name == 'dict' or name == 'array':
+            self._depth -= 1
+            if not self._depth:
+                end = self._parser.CurrentByteIndex + len('</%s>' % name)
+                self._end_product(self._product_start, end)
+                self._product_start = None
+                self._reported = end
+                self._build_mode()
+
+    def _end_product(self, start, end):
+        '''Handles the raw bytes of a product dict'''
+        raw = self._raw(start, end)
+        key = self._stack[-1][1]
+        self._stack[-1][1] = None
+        if self.marker and self.marker not in raw:
+            return
+        product = plistlib.readPlistFromString(
+            '<plist version="1.0">%s</plist>' % raw)
+        if self.product_filter(product):
+            self._stack[-1][0][key] = product
+
+    def _raw(self, start, end):
+        '''Returns the bytes between the absolute offsets start and end'''
+        parts = []
+        offset = self._chunks_offset
+        for chunk in self._chunks:
+            chunk_end = offset + len(chunk)
+            if chunk_end > start and offset < end:
+                parts.append(chunk[max(start - offset, 0):end - offset])
+            offset = chunk_end
+        return ''.join(parts)
+
+    def _data(self, text):
+        self._text.append(text)
+
+    def _end(self, name):
+        self._reported = self._parser.CurrentByteIndex
+        text = u''.join(self._text)
+        self._text = []
+        if name in ('dict', 'array'):
+            value = self._stack.pop()[0]
+        elif name == 'key':
+            self._stack[-1][1] = _string(text)
+            return
+        elif name == 'string':
+            value = _string(text)
+        elif name == 'integer':
+            value = int(text)
+        elif name == 'real':
+            value = float(text)
+        elif name == 'true':
+            value = True
+        elif name == 'false':
+            value = False
+        elif name == 'date':
+            value = datetime.datetime.strptime(
+                text.strip(), '%Y-%m-%dT%H:%M:%SZ')
+        elif name == 'data':
+            value = plistlib.Data(base64.b64decode(text))
+        else:
+            # <plist> itself
+            return
+        self._add(value)
+
+    def _add(self, value):
+        if not self._stack:
+            self.root = value
+            return
+        container, key = self._stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+        else:
+            container[key] = value
+            self._stack[-1][1] = None
+
+
+@instrument.traced
+def parse_sucatalog(path, product_filter=is_mac_os_installer,
+                    marker=OSINSTALL_IDENTIFIER):
+    '''Parses the catalog at path, keeping only the products accepted by
+    product_filter. Returns a dict shaped like plistlib.readPlist would.'''
+    parser = CatalogParser(product_filter, marker)
+    with open(path, 'rb') as fileobj:
+        while True:
+            data = fileobj.read(READ_SIZE)
+            if not data:
+                break
+            parser.feed(data)
+    return parser.close()
+
+
+def copy_product_info(product_info):
+    '''Returns a copy of product_info whose entries can be changed without
+    changing the original's'''
+    return dict((key, dict(info)) for key, info in product_info.items())
+
+
+class ProductIndex(object):
+    '''On-disk index of the installer products of a catalog, keyed by the
+    catalog's validator. It holds the filtered catalog and the product_info
+    dict built from it, so an unchanged catalog needs neither parsing nor
+    any ServerMetadata or dist file.
+
+    When the catalog changed, the index of the previous one is kept as a
+    snapshot: carry_over() diffs the new catalog against it, keeping the
+    product_info of unchanged products in carried and the keys of changed
+    products, whose replicated files are stale, in stale.'''
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.path = os.path.join(workdir, INDEX_NAME)
+        self.validator = None
+        self.catalog = None
+        self.product_info = None
+        self.previous = None
+        self.carried = {}
+        self.stale = set()
+
+    def load(self, validator):
+        '''Loads the index if it was built for validator. Returns True on
+        a hit.'''
+        self.validator = validator
+        self.catalog = None
+        self.product_info = None
+        self.previous = None
+        if not validator or not os.path.exists(self.path):
+            return False
+        try:
+            index = plistlib.readPlist(self.path)
+        except (OSError, IOError, expat.ExpatError), err:
+            print >> sys.stderr, 'Error reading %s: %s' % (self.path, err)
+            return False
+        if index.get('validator') != validator:
+            if index.get('catalog') is not None:
+                self.previous = index
+            return False
+        for info in index.get('product_info', {}).values():
+            # dist files live below workdir; if they're gone, so is the index
+            if ('DistributionPath' in info and
+                    not os.path.exists(info['DistributionPath'])):
+                return False
+        self.catalog = index.get('catalog')
+        self.product_info = index.get('product_info')
+        return self.catalog is not None and self.product_info is not None
+
+    def carry_over(self, catalog):
+        '''Diffs catalog against the previous snapshot, sets carried and
+        stale and removes the replicated files no product refers to any
+        more'''
+        self.carried = {}
+        self.stale = set()
+        if self.previous is None:
+            return
+        old_catalog = self.previous['catalog']
+        diff = diff_catalogs(old_catalog, catalog)
+        print ('Catalog changes: %d new, %d changed, %d removed, '
+               '%d unchanged products' % (
+                   len(diff['added']), len(diff['changed']),
+                   len(diff['removed']), len(diff['unchanged'])))
+        old_info = self.previous.get('product_info', {})
+        for key in diff['unchanged']:
+            info = old_info.get(key)
+            # a dist file that is gone is fetched again
+            if info and ('DistributionPath' not in info or
+                         os.path.exists(info['DistributionPath'])):
+                self.carried[key] = info
+        self.stale = set(diff['changed'])
+
+        still_used = set()
+        for product in catalog.get('Products', {}).values():
+            still_used.update(product_urls(product))
+        unused = set()
+        for key in diff['removed'] + diff['changed']:
+            unused.update(product_urls(old_catalog['Products'][key]))
+        cache = PackageCache(self.workdir)
+        for url in unused - still_used:
+            path = fetch.local_path_for_url(url, self.workdir)
+            if os.path.exists(path):
+                print 'Removing %s' % path
+            cache.discard(path)
+        self.previous = None
+
+    def copy_product_info(self):
+        '''Returns a copy of the product_info of a hit, or of the carried
+        over products otherwise, for a run to add to'''
+        if self.product_info is not None:
+            return copy_product_info(self.product_info)
+        return copy_product_info(self.carried)
+
+    def save(self, catalog, product_info):
+        '''Stores catalog and the compact product_info for the current
+        validator'''
+        self.catalog = catalog
+        self.product_info = copy_product_info(product_info)
+        if not self.validator:
+            return
+        compact = {}
+        for product_key, info in product_info.items():
+            compact[product_key] = dict(
+                (field, info[field]) for field in INDEX_FIELDS
+                if info.get(field) is not None)
+        index = {
+            'validator': self.validator,
+            'catalog': catalog,
+            'product_info': compact,
+        }
+        temp_path = self.path + '.tmp'
+        try:
+            plistlib.writePlist(index, temp_path)
+            os.rename(temp_path, self.path)
+        except (OSError, IOError, TypeError), err:
+            print >> sys.stderr, 'Error writing %s: %s' % (self.path, err)
+
+
+def _replicate(full_url, workdir, ignore_cache=False, progress=NULL_PROGRESS):
+    '''Replicates a small file below workdir and returns its path'''
+    progress.set_detail('%s...' % full_url.rsplit('/', 1)[-1])
+    return fetch.replicate_url(full_url, root_dir=workdir,
+                               ignore_cache=ignore_cache)
+
+
+@instrument.traced
+def download_and_parse_sucatalog(sucatalog, workdir, ignore_cache=False,
+                                 index=None):
+    '''Downloads and returns a parsed softwareupdate catalog. With a
+    ProductIndex, an unchanged catalog is taken from the index instead of
+    being parsed again.'''
+    try:
+        localcatalogpath, validator = fetch.replicate_if_modified(
+            sucatalog, root_dir=workdir, ignore_cache=ignore_cache)
+    except ReplicationError, err:
+        print >> sys.stderr, 'Could not replicate %s: %s' % (sucatalog, err)
+        raise
+    if index is not None:
+        if ignore_cache:
+            index.validator = validator
+        elif index.load(validator):
+            print 'Using product index for %s' % sucatalog
+            return index.catalog
+    try:
+        # only the macOS installer products are kept
+        catalog = parse_sucatalog(localcatalogpath)
+    except (OSError, IOError, expat.ExpatError), err:
+        print >> sys.stderr, 'Error reading %s: %s' % (localcatalogpath, err)
+        raise ReplicationError('Error reading %s: %s' % (localcatalogpath, err))
+    if index is not None:
+        index.carry_over(catalog)
+    return catalog
+
+
+def _ignores_cache(index, product_key, ignore_cache):
+    '''Returns True if the cached files of a product must not be used'''
+    return ignore_cache or (index is not None and product_key in index.stale)
+
+
+def find_mac_os_installers(catalog):
+    '''Return a list of product identifiers for what appear to be macOS
+    installers'''
+    products = catalog.get('Products', {})
+    return [key for key in products if is_mac_os_installer(products[key])]
+
+
+def parse_server_metadata(filename):
+    '''Parses a softwareupdate server metadata file, looking for information
+    of interest.
+    Returns a dictionary containing title and version.'''
+    title = ''
+    vers = ''
+    try:
+        md_plist = plistlib.readPlist(filename)
+    except (OSError, IOError, expat.ExpatError), err:
+        print >> sys.stderr, 'Error reading %s: %s' % (filename, err)
+        return {}
+    vers = md_plist.get('CFBundleShortVersionString', '')
+    localization = md_plist.get('localization', {})
+    preferred_localization = (localization.get('English') or
+                              localization.get('en'))
+    if preferred_localization:
+        title = preferred_localization.get('title', '')
+
+    metadata = {}
+    metadata['title'] = title
+    metadata['version'] = vers
+    return metadata
+
+
+def get_server_metadata(catalog, product_key, workdir, ignore_cache=False,
+                        progress=NULL_PROGRESS):
+    '''Replicates the ServerMetadata file of a product and returns its
+    path, or None'''
+    try:
+        url = catalog['Products'][product_key]['ServerMetadataURL']
+    except KeyError:
+        print >> sys.stderr, 'Malformed catalog.'
+        return None
+    try:
+        return _replicate(url, workdir, ignore_cache, progress)
+    except ReplicationError, err:
+        print >> sys.stderr, 'Could not replicate %s: %s' % (url, err)
+        return None
+
+
+class DistInfo(object):
+    '''What a dist file says about a product: the auxinfo key/string pairs,
+    and for every pkg-ref id its installKBytes and package file name, if
+    declared, and the order the choices install them in'''
+
+    def __init__(self):
+        self.auxinfo = {}
+        self.install_kbytes = {}
+        self.files = {}
+        self.order = []
+
+    def package_order(self):
+        '''Returns the package file names in install order'''
+        return [self.files[ref] for ref in self.order if ref in self.files]
+
+    def total_install_kbytes(self, packages=None):
+        '''Returns the installKBytes of all pkg-refs. With the catalog
+        package dicts of the product, pkg-refs that don't declare a size count
+        with the download size of their package. 0 if nothing is known.'''
+        total = sum(self.install_kbytes.values())
+        if packages:
+            sizes = dict((_package_name(package), package.get('Size') or 0)
+                         for package in packages if 'URL' in package)
+            for ref, name in self.files.items():
+                if ref not in self.install_kbytes and name in sizes:
+                    total += sizes[name] // 1024
+        return total
+
+
+def _package_name(package):
+    return os.path.basename(package['URL'])
+
+
+class DistParser(object):
+    '''Streaming parser for softwareupdate dist files, collecting a
+    DistInfo in one pass without building a DOM. Only the first auxinfo is
+    read; its pairs may be wrapped in a dict.'''
+
+    def __init__(self):
+        self.info = DistInfo()
+        self._names = []
+        self._text = []
+        self._key = None
+        self._ref = None
+        self._in_auxinfo = False
+        self._auxinfo_done = False
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        '''Finishes parsing and returns the DistInfo'''
+        try:
+            self._parser.Parse('', True)
+        finally:
+            self.release()
+        return self.info
+
+    def release(self):
+        '''Drops the expat parser. Its handlers refer back to this object,
+        and the cycle would keep the parser's buffers alive until the next
+        garbage collection.'''
+        self._parser = None
+
+    def _auxinfo_level(self):
+        '''True if the element being read is a direct child of auxinfo or
+        of a dict directly below it'''
+        parents = self._names[:-1]
+        return (parents[-1:] == ['auxinfo'] or
+                parents[-2:] == ['auxinfo', 'dict'])
+
+    def _start(self, name, attrs):
+        self._names.append(name)
+        self._text = []
+        if name == 'auxinfo' and not self._auxinfo_done:
+            self._in_auxinfo = True
+        elif name == 'pkg-ref':
+            ref = attrs.get('id')
+            self._ref = ref
+            if not ref:
+                return
+            if attrs.get('installKBytes'):
+                try:
+                    self.info.install_kbytes[ref] = int(attrs['installKBytes'])
+                except ValueError:
+                    pass
+            if self._names[-2:-1] == ['choice'] and ref not in self.info.order:
+                self.info.order.append(ref)
+
+    def _data(self, text):
+        # skip the text of scripts and localizations
+        if self._names[-1] in TEXT_ELEMENTS:
+            self._text.append(text)
+
+    def _end(self, name):
+        text = u''.join(self._text).strip()
+        self._text = []
+        if self._in_auxinfo:
+            if name == 'auxinfo':
+                self._in_auxinfo = False
+                self._auxinfo_done = True
+            elif self._auxinfo_level():
+                if name == 'key':
+                    self._key = _string(text)
+                elif name == 'string' and self._key:
+                    self.info.auxinfo[self._key] = _string(text)
+                    self._key = None
+        elif name == 'pkg-ref' and self._ref and text:
+            # the package, relative to the dist file, e.g. #InstallESD.pkg
+            self.info.files[self._ref] = _string(
+                os.path.basename(text.lstrip('#')))
+        self._names.pop()
+
+
+def analyze_dist(filename):
+    '''Parses a softwareupdate dist file into a DistInfo, which is empty
+    if the file can't be read'''
+    parser = DistParser()
+    try:
+        with open(filename, 'rb') as fileobj:
+            while True:
+                data = fileobj.read(READ_SIZE)
+                if not data:
+                    break
+                parser.feed(data)
+        return parser.close()
+    except expat.ExpatError:
+        print >> sys.stderr, 'Invalid XML in %s' % filename
+    except IOError, err:
+        print >> sys.stderr, 'Error reading %s: %s' % (filename, err)
+    finally:
+        parser.release()
+    return DistInfo()
+
+
+def parse_dist(filename):
+    '''Parses a softwareupdate dist file, returning a dict of info of
+    interest'''
+    return dict(analyze_dist(filename).auxinfo)
+
+
+def order_packages(packages, dist_info):
+    '''Returns the catalog package dicts of a product in download order:
+    largest first, so the longest transfers don't start last, and packages
+    of the same size in the order the dist file installs them'''
+    install_order = dict(
+        (name, idx) for idx, name in enumerate(dist_info.package_order()))
+
+    def sort_key(package):
+        name = _package_name(package) if 'URL' in package else None
+        return (-(package.get('Size') or 0),
+                install_order.get(name, len(install_order)))
+
+    return sorted(packages, key=sort_key)
+
+
+def product_metadata(catalog, product_key, workdir, ignore_cache=False,
+                     progress=NULL_PROGRESS):
+    '''Returns title, version and PostDate of a product'''
+    filename = get_server_metadata(
+        catalog, product_key, workdir, ignore_cache, progress)
+    metadata = {}
+    if filename:
+        metadata = parse_server_metadata(filename)
+    product = catalog['Products'][product_key]
+    metadata['PostDate'] = str(product['PostDate'])
+    return metadata
+
+
+def product_dist_info(catalog, product_key, workdir, ignore_cache=False,
+                      progress=NULL_PROGRESS):
+    '''Replicates the English dist file of a product and returns the
+    info parsed from it, including its DistributionPath'''
+    distributions = catalog['Products'][product_key]['Distributions']
+    dist_url = distributions.get('English') or distributions.get('en')
+    try:
+        dist_path = _replicate(dist_url, workdir, ignore_cache, progress)
+    except ReplicationError, err:
+        print >> sys.stderr, 'Could not replicate %s: %s' % (dist_url, err)
+        return {}
+    dist_info = parse_dist(dist_path)
+    dist_info['DistributionPath'] = dist_path
+    return dist_info
+
+
+@instrument.traced
+def os_installer_product_info(catalog, workdir, ignore_cache=False,
+                              index=None, progress=NULL_PROGRESS):
+    '''Returns a dict of info about products that look like macOS
+    installers. With a ProductIndex, the info is taken from or stored in the
+    index.'''
+    product_info = {}
+    if index is not None:
+        # without a hit, the unchanged products of a republished catalog
+        product_info = index.copy_product_info()
+    # select_installer only fetches the dist files it needs, so an entry
+    # may have its ServerMetadata info but no dist info yet
+    missing = [key for key in find_mac_os_installers(catalog)
+               if 'DistributionPath' not in product_info.get(key, {})]
+    if not missing and index is not None and index.product_info is not None:
+        return product_info
+
+    def info_for(product_key):
+        ignore = _ignores_cache(index, product_key, ignore_cache)
+        info = dict(product_info.get(product_key) or product_metadata(
+            catalog, product_key, workdir, ignore, progress))
+        info.update(product_dist_info(
+            catalog, product_key, workdir, ignore, progress))
+        return info
+
+    infos = fetch.map_concurrently(info_for, missing)
+    product_info.update(zip(missing, infos))
+    if index is not None:
+        index.save(catalog, product_info)
+    return product_info
+
+
+@instrument.traced
+def select_installer(catalog, workdir, build=None, ignore_cache=False,
+                     index=None, progress=NULL_PROGRESS):
+    '''Returns the product key of the newest installer, or of the newest
+    one with BUILD build, together with the product_info gathered to pick
+    it. The small ServerMetadata files are fetched for all installers,
+    dist files only for as many candidates as needed.'''
+    product_info = {}
+    if index is not None:
+        # without a hit, the unchanged products of a republished catalog
+        product_info = index.copy_product_info()
+        if index.product_info is not None:
+            product_key = select_product(product_info, build)
+            if product_key:
+                return product_key, product_info
+    candidates = installers_by_postdate(catalog)
+
+    missing = [key for key in candidates if key not in product_info]
+    metadata = fetch.map_concurrently(
+        lambda key: product_metadata(
+            catalog, key, workdir,
+            _ignores_cache(index, key, ignore_cache), progress), missing)
+    product_info.update(zip(missing, metadata))
+    product_key = None
+    if build is None:
+        # the newest version is the only one we need a dist file for, so
+        # the top-ranked candidate will do unless its dist file can't be
+        # fetched
+        candidates.sort(
+            key=lambda key: installer_sort_key(product_info[key]),
+            reverse=True)
+        batch_size = 1
+    else:
+        # a dist file with that BUILD carried over from the last catalog
+        # needs no other one; otherwise BUILD is only known from the dist
+        # files, fetched a batch at a time
+        product_key = select_product(product_info, build)
+        batch_size = fetch.DEFAULT_WORKERS
+
+    # walk the candidates in rank order, stopping at the first one that
+    # qualifies; a dist file carried over from the last catalog ends the
+    # walk before any dist file ranked below it is fetched
+    walked = 0
+    while product_key is None and walked < len(candidates):
+        batch = []
+        for key in candidates[walked:]:
+            if (len(batch) == batch_size or
+                    'DistributionPath' in product_info[key]):
+                break
+            batch.append(key)
+        if batch:
+            dist_infos = fetch.map_concurrently(
+                lambda key: product_dist_info(
+                    catalog, key, workdir,
+                    _ignores_cache(index, key, ignore_cache), progress),
+                batch)
+            for key, dist_info in zip(batch, dist_infos):
+                product_info[key].update(dist_info)
+            walked += len(batch)
+        else:
+            walked += 1
+        product_key = select_product(
+            dict((key, product_info[key]) for key in candidates[:walked]),
+            build)
+    if index is not None:
+        index.save(catalog, product_info)
+    return product_key, product_info
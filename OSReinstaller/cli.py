@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+#  cli.py
+#  OSReinstaller
+#
+#  Command line entry point running the reinstall workflow without a
+#  window, e.g. from a management agent:
+#
+#    python cli.py --build 17E199
+#
+
+import sys
+import time
+import argparse
+
+from pipeline import StageError
+from progress import ProgressBus, describe_byte_progress
+import peercache
+import workflow
+
+
+# seconds between progress lines
+PROGRESS_INTERVAL = 5
+
+
+def print_progress(snapshot):
+    '''ProgressBus callback. Info and detail are printed by the workflow
+    itself, so only byte and percent progress is shown here.'''
+    if 'bytes_done' in snapshot:
+        print '    %s' % describe_byte_progress(snapshot)
+    elif snapshot.get('percent', -1) >= 0:
+        print '    %.0f%%' % snapshot['percent']
+    sys.stdout.flush()
+
+
+def list_installers(reinstaller):
+    product_info = reinstaller.installers()
+    for product_id, info in sorted(product_info.items(),
+                                   key=lambda item: item[1].get('PostDate')):
+        print '%-14s %-10s %-10s %-26s %s' % (
+            product_id, info.get('version', ''), info.get('BUILD', ''),
+            info.get('PostDate', ''), info.get('title', ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Downloads the newest macOS installer and erases and '
+                    'reinstalls this Mac with it.')
+    parser.add_argument('--catalogurl', default=workflow.DEFAULT_SUCATALOG,
+                        help='Software Update catalog URL.')
+    parser.add_argument('--workdir', default=workflow.DEFAULT_WORKDIR,
+                        help='Path to working directory. The space the '
+                        'installer needs is checked before downloading.')
+    parser.add_argument('--build',
+                        help='Install this build instead of the newest one.')
+    parser.add_argument('--ignore-cache', action='store_true',
+                        help='Ignore any previously cached files.')
+    parser.add_argument('--list', action='store_true',
+                        help='List the available installers and exit.')
+    parser.add_argument('--download-only', action='store_true',
+                        help='Build the installer in a sparse image but do '
+                        'not run startosinstall.')
+    parser.add_argument('--peer', action='append', default=[], metavar='URL',
+                        help='Base URL of a peer cache to fetch packages from '
+                        'before the origin. May be given more than once.')
+    parser.add_argument('--mirrors', action='append', default=[],
+                        metavar='URL,URL,...',
+                        help='Comma separated base URLs serving the same '
+                        'files, e.g. a reposado content root and its mirrors. '
+                        'The catalog and packages below them are fetched from '
+                        'the fastest one. May be given more than once.')
+    parser.add_argument('--image-dir', action='append', default=[],
+                        metavar='PATH',
+                        help='Directory to build the sparse image in if the '
+                        'workdir volume is short of space. May be given more '
+                        'than once; the first with room is used.')
+    parser.add_argument('--report-dir',
+                        help='Directory to write the JSON run report and the '
+                        'Prometheus textfile to, e.g. node_exporter\'s '
+                        'textfile collector directory. Defaults to the '
+                        'workdir.')
+    parser.add_argument('--limit', metavar='RATE',
+                        help='Bandwidth limit for package downloads, e.g. '
+                        '5M, or a schedule like 08:00-17:00=2M,20M for '
+                        '2 MB/s during those hours and 20 MB/s otherwise.')
+    parser.add_argument('--host-limit', action='append', default=[], nargs=2,
+                        metavar=('HOST', 'RATE'),
+                        help='Bandwidth limit for downloads from HOST, in the '
+                        'format of --limit. May be given more than once.')
+    parser.add_argument('--no-artifact-cache', action='store_true',
+                        help='Do not keep built installers in the workdir '
+                        'for later runs of the same build.')
+    parser.add_argument('--share', action='store_true',
+                        help='Serve the workdir to peers while running.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Only serve the workdir to peers, until '
+                        'interrupted.')
+    parser.add_argument('--port', type=int, default=peercache.DEFAULT_PORT,
+                        help='Port to serve the workdir on.')
+    args = parser.parse_args(argv)
+
+    progress = ProgressBus(print_progress, fps=1.0 / PROGRESS_INTERVAL)
+    try:
+        reinstaller = workflow.Reinstaller(
+            sucatalog=args.catalogurl, workdir=args.workdir, build=args.build,
+            ignore_cache=args.ignore_cache, progress=progress,
+            reinstall=not args.download_only, peers=args.peer,
+            share_port=args.port if args.share else None,
+            mirror_groups=[group.split(',') for group in args.mirrors],
+            artifact_cache=not args.no_artifact_cache,
+            image_dirs=[args.workdir] + args.image_dir,
+            report_dir=args.report_dir, bandwidth_limit=args.limit,
+            host_limits=dict(args.host_limit))
+    except ValueError, err:
+        parser.error(str(err))
+    if args.list:
+        list_installers(reinstaller)
+        return 0
+    if args.serve:
+        server = reinstaller.share(args.port)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            server.stop()
+        return 0
+
+    if not args.download_only:
+        workflow.prevent_sleep()
+    progress.start()
+    try:
+        reinstaller.run()
+    except StageError, err:
+        print >> sys.stderr, 'Reinstall failed: %s' % err
+        return 1
+    except KeyboardInterrupt:
+        reinstaller.cancel()
+        print >> sys.stderr, 'Cancelled'
+        return 1
+    finally:
+        progress.stop()
+        workflow.allow_sleep()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
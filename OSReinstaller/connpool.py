@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+#  connpool.py
+#  OSReinstaller
+#
+#  Shared pool of persistent HTTP/1.1 connections, one set per host. A run
+#  makes many small requests to the same reposado server; reusing the
+#  connections saves a TCP and TLS handshake for every one of them.
+#
+
+import zlib
+import socket
+import httplib
+import urllib
+import urlparse
+import threading
+
+
+# idle connections kept per host
+MAX_IDLE_PER_HOST = 8
+DEFAULT_TIMEOUT = 60
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPError(Exception):
+    '''Raised for HTTP error status codes'''
+
+    def __init__(self, url, code, reason):
+        Exception.__init__(self, 'HTTP Error %s: %s (%s)' % (code, reason, url))
+        self.url = url
+        self.code = code
+
+
+class PooledResponse(object):
+    '''A response whose connection goes back to the pool once the body has
+    been read. Bodies sent with Content-Encoding gzip are decoded.'''
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.url = url
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._decoder = None
+        if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @property
+    def status(self):
+        return self._response.status
+
+    @property
+    def reason(self):
+        return self._response.reason
+
+    def getcode(self):
+        return self._response.status
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    @property
+    def encoded(self):
+        '''True if the body is transferred compressed, so Content-Length
+        doesn't describe the decoded size'''
+        return self._decoder is not None
+
+    def read(self, amt=None):
+        if self._response is None:
+            return ''
+        while True:
+            data = self._response.read(amt)
+            self.pool.count_bytes(len(data))
+            if self._decoder is None:
+                return data
+            if not data:
+                return self._decoder.flush()
+            data = self._decoder.decompress(data)
+            if data:
+                return data
+
+    def close(self):
+        '''Returns the connection to the pool if the response was read
+        completely, otherwise closes it'''
+        if self._response is None:
+            return
+        reusable = (self._response.isclosed() and
+                    not self._response.will_close)
+        if not reusable and not self._response.isclosed():
+            # drain small leftovers so the connection stays usable
+            try:
+                leftover = self._response.read(64 * 1024)
+                self.pool.count_bytes(len(leftover))
+                reusable = (self._response.isclosed() and
+                            not self._response.will_close)
+            except (httplib.HTTPException, socket.error):
+                reusable = False
+        self._response = None
+        self.pool.release(self._key, self._conn, reusable)
+
+
+class ConnectionPool(object):
+    '''Hands out persistent connections keyed by scheme, host and port.
+
+    stats counts connections opened, requests made and bytes received on the
+    wire, headers included, since the last reset_stats().'''
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST,
+                 timeout=DEFAULT_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                'connections_opened': 0,
+                'connections_reused': 0,
+                'requests': 0,
+                'bytes_received': 0,
+            }
+
+    def count_bytes(self, count):
+        with self._lock:
+            self.stats['bytes_received'] += count
+
+    def _proxy_for(self, scheme, host):
+        proxies = urllib.getproxies()
+        if scheme not in proxies or urllib.proxy_bypass(host):
+            return None
+        proxy = urlparse.urlsplit(proxies[scheme])
+        return proxy.hostname, proxy.port or 8080
+
+    def _connect(self, key):
+        scheme, host, port = key
+        proxy = self._proxy_for(scheme, host)
+        if scheme == 'https':
+            if proxy:
+                conn = httplib.HTTPSConnection(
+                    proxy[0], proxy[1], timeout=self.timeout)
+                conn.set_tunnel(host, port)
+            else:
+                conn = httplib.HTTPSConnection(
+                    host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(
+                proxy[0] if proxy else host, proxy[1] if proxy else port,
+                timeout=self.timeout)
+        conn.via_proxy = bool(proxy) and scheme == 'http'
+        with self._lock:
+            self.stats['connections_opened'] += 1
+        return conn
+
+    def acquire(self, key):
+        '''Returns an idle connection for key or a new one, and whether it
+        was reused'''
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.stats['connections_reused'] += 1
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def release(self, key, conn, reusable=True):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        '''Closes all idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def request(self, url, headers=None, accept_gzip=False, timeout=None):
+        '''GETs url and returns a PooledResponse. Redirects are followed,
+        error statuses raise HTTPError; 304 is returned to the caller.
+        timeout overrides the pool's socket timeout for this request.'''
+        headers = dict(headers or {})
+        if accept_gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        for dummy in range(MAX_REDIRECTS + 1):
+            response = self._request_once(url, headers, timeout)
+            status = response.status
+            if status in REDIRECT_CODES:
+                location = response.getheader('Location')
+                response.read()
+                response.close()
+                if not location:
+                    raise HTTPError(url, status, 'Redirect without Location')
+                url = urlparse.urljoin(url, location)
+                continue
+            if status >= 400:
+                reason = response.reason
+                response.close()
+                raise HTTPError(url, status, reason)
+            return response
+        raise HTTPError(url, status, 'Too many redirects')
+
+    def _request_once(self, url, headers, timeout=None):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self.acquire(key)
+            conn.timeout = timeout or self.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            target = url if conn.via_proxy else path
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), err:
+                conn.close()
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    continue
+                raise
+            with self._lock:
+                self.stats['requests'] += 1
+                self.stats['bytes_received'] += self._header_size(response)
+            return PooledResponse(self, key, conn, response, url)
+
+    def _header_size(self, response):
+        header_lines = getattr(response.msg, 'headers', [])
+        return len('HTTP/1.1 000 \r\n\r\n') + sum(
+            len(line) for line in header_lines)
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    '''Returns the process-wide ConnectionPool'''
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
+
+
+def format_stats(stats):
+    return ('%(connections_opened)d connections opened, '
+            '%(connections_reused)d reused, %(requests)d requests, '
+            '%(bytes_received)d bytes received' % stats)
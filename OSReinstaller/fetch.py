@@ -0,0 +1,967 @@
+# -*- coding: utf-8 -*-
+#
+#  fetch.py
+#  OSReinstaller
+#
+#  Parallel, range-segmented download engine. Several files are fetched at
+#  once on a bounded pool of worker threads and large files are split into
+#  HTTP Range segments that are written in place into a preallocated file.
+#
+
+import os
+import re
+import sys
+import time
+import errno
+import random
+import hashlib
+import threading
+import urlparse
+import Queue
+
+import instrument
+import shaping
+from cache import PackageCache, file_digest, hash_for_digest
+from integrity import (IntegrityError, ChunkVerifier, OrderedDigest,
+                       parse_chunklist, chunklist_size, chunk_segments,
+                       chunk_start)
+from connpool import ConnectionPool, HTTPError, shared_pool
+from mirrors import shared_mirrors
+from peercache import peer_urls
+
+
+# size of a single Range request
+SEGMENT_SIZE = 32 * 1024 * 1024
+# number of worker threads
+DEFAULT_WORKERS = 4
+# read/write block size
+BLOCK_SIZE = 256 * 1024
+# peers are on the LAN; give up on an unreachable one quickly
+PEER_TIMEOUT = 5
+# a segment transfer receiving nothing for this many seconds has stalled
+STALL_TIMEOUT = 20
+# a segment is moved to another mirror if that one was measured this many
+# times faster, once the segment ran for SLOW_GRACE seconds
+SLOW_FACTOR = 4
+SLOW_GRACE = 5
+# attempts per request, and the exponential backoff between them
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# priority of the sentinels that stop the workers, after all tasks
+STOP_PRIORITY = 99
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class ReplicationError(Exception):
+    '''A custom error when replication fails'''
+    pass
+
+
+class DownloadCancelled(ReplicationError):
+    '''Raised when the download engine was cancelled'''
+    pass
+
+
+class CorruptDownload(ReplicationError, IntegrityError):
+    '''Raised by the download engine for a file whose data didn't verify,
+    so callers can handle it as a failed download or as bad data'''
+    pass
+
+
+class SlowMirror(ReplicationError):
+    '''Raised to move a transfer away from a mirror much slower than
+    another one'''
+    pass
+
+
+def backoff_delay(attempt):
+    '''Returns the seconds to wait before retry number attempt, with
+    jitter so concurrent retries don't hit a server at the same time'''
+    delay = min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def is_retriable(err):
+    '''Returns False for errors that another attempt won't fix: client
+    errors other than timeouts and throttling, and cancellation'''
+    if isinstance(err, DownloadCancelled):
+        return False
+    if isinstance(err, HTTPError):
+        return err.code >= 500 or err.code in (408, 429)
+    return True
+
+
+def local_path_for_url(full_url, root_dir='/tmp'):
+    '''Returns the path a URL is replicated to: the same relative path below
+    root_dir'''
+    path = urlparse.urlsplit(full_url)[2]
+    relative_url = path.lstrip('/')
+    relative_url = os.path.normpath(relative_url)
+    return os.path.join(root_dir, relative_url)
+
+
+def make_parent_dirs(local_file_path):
+    '''Creates the parent directory of local_file_path if needed'''
+    dirname = os.path.dirname(local_file_path)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as exc: # Guard against race condition
+            if exc.errno != errno.EEXIST:
+                raise
+
+
+class DownloadJob(object):
+    '''A single file to download. size and digest come from the catalog
+    and may be None. chunks are the entries of its chunklist, if it has one.
+    peers are the peer cache URLs to try first, origins the mirror URLs of
+    url, best first, once resolved. source is the URL currently used.'''
+
+    def __init__(self, url, local_path, size=None, digest=None,
+                 compress=False, peers=None, chunks=None):
+        self.url = url
+        # small files go ahead of bulk segments and aren't throttled
+        self.priority = shaping.METADATA if compress else shaping.BULK
+        # seconds spent waiting for the bandwidth limit
+        self.throttled = 0.0
+        self.peers = list(peers or [])
+        self.origins = None
+        self.source = None
+        self.started = False
+        self.retries = 0
+        self.local_path = local_path
+        self.compress = compress
+        self.expected_size = size
+        self.digest = digest
+        self.chunks = chunks
+        self.digester = None
+        self.size = None
+        self.error = None
+        self.bytes_done = 0
+        # bytes received for the job, including those of failed attempts
+        self.bytes_fetched = 0
+        self.started_at = None
+        self.finished_at = None
+        self.pending = 0
+        # (start, end) of every segment once the size is known, and the
+        # starts of those completed
+        self.segments = None
+        self.completed = []
+        self.cached = False
+        self.done = threading.Event()
+
+    @property
+    def sources(self):
+        return self.peers + (self.origins or [self.url])
+
+    def on_peer(self, source=None):
+        return (source or self.source) in self.peers
+
+    @property
+    def verified_size(self):
+        '''The size the file must have, or None if unknown'''
+        if self.chunks:
+            return chunklist_size(self.chunks)
+        return self.expected_size
+
+
+class DownloadEngine(object):
+    '''Downloads a set of URLs concurrently.
+
+    Every job starts with a GET for its first segment. If the server answers
+    206 the remaining segments are queued for the other workers, otherwise the
+    whole body is streamed by the worker that asked for it. progress is called
+    with (bytes_done, bytes_total) from the worker threads.
+
+    With a PackageCache, complete files are not downloaded again and partial
+    files are resumed from the segments recorded in their state file.
+    Setting cancel_event makes all jobs fail as soon as possible.
+
+    peers are base URLs of peer caches tried before the origin. A job that
+    fails or doesn't match its digest on a peer is fetched again from the
+    origin.
+
+    Tasks are queued by priority: metadata files go ahead of the segments
+    of bulk packages. Bulk transfers from origins and mirrors wait for the
+    shaper's bandwidth limits; peers are on the LAN and are not limited.
+
+    Data is verified as it is written. Jobs with a chunklist are split into
+    segments on chunk boundaries and every chunk is checked against its
+    SHA-256 as it arrives; a bad chunk is fetched again from the next mirror
+    right away. Other jobs hash the catalog digest over the data in file
+    order, reading back only segments that completed ahead of it.
+
+    The origin URLs are expanded to their mirrors, best ranked first.
+    Failed requests are retried with exponential backoff on the next best
+    mirror; a segment continues where the failed transfer stopped. Segments
+    that stall, or run much slower than another mirror was measured, move to
+    that mirror.'''
+
+    def __init__(self, workers=DEFAULT_WORKERS, segment_size=SEGMENT_SIZE,
+                 progress=None, cache=None, pool=None, cancel_event=None,
+                 peers=None, mirrors=None, stall_timeout=STALL_TIMEOUT,
+                 shaper=None):
+        self.workers = max(1, workers)
+        self.cancel_event = cancel_event
+        self.pool = pool or shared_pool()
+        self.mirrors = mirrors or shared_mirrors()
+        self.shaper = shaper or shaping.shared_shaper()
+        self.stall_timeout = stall_timeout
+        self.peers = list(peers or [])
+        self.peer_pool = None
+        if self.peers:
+            self.peer_pool = ConnectionPool(timeout=PEER_TIMEOUT)
+        self.segment_size = segment_size
+        self.progress = progress
+        self.cache = cache
+        self.jobs = []
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self._lock = threading.Lock()
+        self._queue = Queue.PriorityQueue()
+        self._queued = 0
+
+    def add(self, url, local_path, size=None, digest=None, compress=False,
+            chunks=None):
+        '''Queues url to be stored at local_path. Small files like plists
+        and dist files should set compress: they are fetched in a single
+        request with gzip content-encoding instead of in segments. chunks
+        are the entries of the file's chunklist, see parse_chunklist.
+        Returns the DownloadJob.'''
+        job = DownloadJob(url, local_path, size=size, digest=digest,
+                          compress=compress,
+                          peers=peer_urls(self.peers, url, digest),
+                          chunks=chunks)
+        self.jobs.append(job)
+        return job
+
+    def run(self):
+        '''Downloads all queued jobs. Raises ReplicationError for the first
+        job that failed, CorruptDownload if its data didn't verify.'''
+        try:
+            self._run()
+        finally:
+            self._record_spans(instrument.shared_recorder())
+
+    def _run(self):
+        for job in self.jobs:
+            if self.cache and self.cache.is_complete(
+                    job.local_path, job.expected_size, job.digest):
+                print "Using cached %s" % job.local_path
+                job.cached = True
+                job.started_at = job.finished_at = time.time()
+                job.done.set()
+                continue
+            job.pending = 1
+            state = self.cache and self.cache.load_state(job.local_path)
+            if state and self._resumable(job, state):
+                self._put(job.priority, (self._resume, job, state))
+            else:
+                self._put(job.priority, (self._first_segment, job, None))
+        if all(job.cached for job in self.jobs):
+            return
+        threads = []
+        for dummy in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for job in self.jobs:
+            # wait on the event with a timeout so the calling thread stays
+            # interruptible
+            while not job.done.wait(1.0):
+                pass
+        for dummy in threads:
+            self._put(STOP_PRIORITY, None)
+        for thread in threads:
+            thread.join()
+        for job in self.jobs:
+            if job.error:
+                error_class = ReplicationError
+                if isinstance(job.error, IntegrityError):
+                    error_class = CorruptDownload
+                raise error_class(
+                    'Could not replicate %s: %s' % (job.url, job.error))
+
+    def _record_spans(self, recorder):
+        '''Records a replicate_url span for every job that ran, below the
+        span that called run()'''
+        parent = recorder.current()
+        fetched = 0
+        for job in self.jobs:
+            if job.started_at is None:
+                continue
+            recorder.record('replicate_url', job.started_at,
+                            job.finished_at or time.time(),
+                            count=job.bytes_fetched, error=job.error,
+                            parent=parent, url=job.url, cached=job.cached,
+                            retries=job.retries, chunked=bool(job.chunks),
+                            throttled=round(job.throttled, 3),
+                            read_back=(job.digester.read_back
+                                       if job.digester else 0))
+            fetched += job.bytes_fetched
+        if parent is not None:
+            parent.add_bytes(fetched)
+
+    def _resumable(self, job, state):
+        '''Returns True if a state file describes the download of job'''
+        if not state.get('size'):
+            return False
+        if (state.get('url') != job.url or
+                state.get('segment_size') != self.segment_size or
+                state.get('chunked', False) != bool(job.chunks)):
+            return False
+        if (job.verified_size is not None and
+                state.get('size') != job.verified_size):
+            return False
+        try:
+            return os.path.getsize(job.local_path) == state.get('size')
+        except OSError:
+            return False
+
+    def _put(self, priority, task):
+        '''Queues a task; equal priorities keep their order'''
+        with self._lock:
+            self._queued += 1
+            seq = self._queued
+        self._queue.put((priority, seq, task))
+
+    def _worker(self):
+        while True:
+            dummy_priority, dummy_seq, task = self._queue.get()
+            if task is None:
+                return
+            func, job, segment = task
+            if job.started_at is None:
+                job.started_at = time.time()
+            if job.error is None:
+                try:
+                    self._check_cancelled()
+                    func(job, segment)
+                except Exception, err:
+                    job.error = err
+                    print >> sys.stderr, (
+                        'Could not replicate %s: %s' % (job.url, err))
+            self._segment_finished(job)
+
+    def _segment_finished(self, job):
+        with self._lock:
+            job.pending -= 1
+            finished = job.pending == 0
+        if finished:
+            if job.error is None:
+                try:
+                    self._finish(job)
+                except Exception, err:
+                    job.error = err
+                    print >> sys.stderr, (
+                        'Could not replicate %s: %s' % (job.url, err))
+            if job.error is not None and self._retry_job(job):
+                return
+            job.finished_at = time.time()
+            job.done.set()
+
+    def _retry_job(self, job):
+        '''Queues a failed job again from the start: from the origin if it
+        failed on a peer, otherwise after a backoff from the next best
+        mirror. Jobs no source answered for were retried already and fail,
+        so do jobs whose data didn't verify and have no other mirror to
+        come from. Returns False if the job should fail.'''
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return False
+        if not job.started:
+            return False
+        delay = 0
+        if job.on_peer():
+            print >> sys.stderr, 'Fetching %s from the origin' % job.url
+            job.peers = []
+        else:
+            job.retries += 1
+            if job.retries >= MAX_ATTEMPTS or not is_retriable(job.error):
+                return False
+            if (isinstance(job.error, IntegrityError) and
+                    len(self.mirrors.alternatives(job.url)) < 2):
+                # the only source would send the same bytes again
+                return False
+            if job.source:
+                self.mirrors.record_failure(job.source)
+            job.origins = None
+            delay = backoff_delay(job.retries)
+            print >> sys.stderr, 'Retrying %s in %.1fs' % (job.url, delay)
+        self._add_progress(-job.bytes_done, -(job.size or 0), job)
+        if self.cache:
+            self.cache.discard(job.local_path)
+        job.source = None
+        job.started = False
+        job.error = None
+        job.size = None
+        job.digester = None
+        job.segments = None
+        job.completed = []
+        job.pending = 1
+        task = (self._first_segment, job, None)
+        if delay:
+            timer = threading.Timer(delay, self._put,
+                                    args=(job.priority, task))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._put(job.priority, task)
+        return True
+
+    def _finish(self, job):
+        '''Verifies a completed download and drops its resume state. Chunks
+        were verified as they were written; otherwise the digest is finished
+        with the data that arrived out of order.'''
+        expected = job.verified_size
+        if (expected is not None and
+                os.path.getsize(job.local_path) != expected):
+            if self.cache:
+                self.cache.discard(job.local_path)
+            raise IntegrityError('Size mismatch: %d bytes, expected %d'
+                                 % (os.path.getsize(job.local_path),
+                                    expected))
+        if job.digest:
+            if job.chunks:
+                digest = job.digest.lower()
+            elif job.digester is not None:
+                digest = job.digester.finish(job.local_path)
+            else:
+                digest = file_digest(job.local_path, job.digest)
+            if digest != job.digest.lower():
+                if self.cache:
+                    self.cache.discard(job.local_path)
+                raise IntegrityError('Digest mismatch')
+            if self.cache:
+                self.cache.record(job.local_path, job.digest)
+        if self.cache:
+            self.cache.clear_state(job.local_path)
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise DownloadCancelled('Cancelled')
+
+    def _backoff(self, attempt):
+        '''Waits before retry number attempt, returning early on cancel'''
+        delay = backoff_delay(attempt)
+        if self.cancel_event is not None:
+            self.cancel_event.wait(delay)
+        else:
+            time.sleep(delay)
+        self._check_cancelled()
+
+    def _add_progress(self, count, total=0, job=None, fetched=False):
+        with self._lock:
+            self.bytes_done += count
+            self.bytes_total += total
+            if job is not None:
+                job.bytes_done += count
+                if fetched:
+                    job.bytes_fetched += count
+            done, total = self.bytes_done, self.bytes_total
+        if self.progress:
+            self.progress(done, total)
+
+    def _save_state(self, job):
+        if not self.cache:
+            return
+        with self._lock:
+            state = {
+                'url': job.url,
+                'size': job.size or 0,
+                'segment_size': self.segment_size,
+                'chunked': bool(job.chunks),
+                'completed': sorted(job.completed),
+            }
+            self.cache.save_state(job.local_path, state)
+
+    def _segment_done(self, job, start):
+        with self._lock:
+            job.completed.append(start)
+            # the end of the completed segments at the start of the file
+            hashable = 0
+            for seg_start, seg_end in job.segments:
+                if seg_start not in job.completed:
+                    break
+                hashable = seg_end + 1
+        self._save_state(job)
+        if job.digester is not None:
+            # hash segments that completed ahead of the digest while they
+            # are still in the page cache
+            job.digester.advance(job.local_path, hashable)
+
+    def _plan_segments(self, job):
+        '''Splits job into segments once its size is known: on chunk
+        boundaries if it has a chunklist'''
+        if job.chunks:
+            job.segments = chunk_segments(job.chunks, self.segment_size)
+        else:
+            job.segments = [
+                (start, min(start + self.segment_size, job.size) - 1)
+                for start in range(0, job.size, self.segment_size)]
+
+    def _check_size(self, job, size):
+        '''Fails a job before anything is written if the server's size
+        doesn't match the catalog or the chunklist'''
+        expected = job.verified_size
+        if expected is not None and size != expected:
+            raise IntegrityError('Size mismatch: server has %d bytes, '
+                                 'expected %d' % (size, expected))
+
+    def _new_digester(self, job):
+        if job.digest and not job.chunks:
+            job.digester = OrderedDigest(hash_for_digest(job.digest))
+        else:
+            job.digester = None
+
+    def _open(self, job, source, start=None, end=None, accept_gzip=False):
+        '''Requests a range of job from source'''
+        headers = {}
+        timeout = None
+        if start is not None:
+            headers['Range'] = 'bytes=%d-%d' % (start, end)
+            timeout = self.stall_timeout
+        pool = self.peer_pool if job.on_peer(source) else self.pool
+        return pool.request(source, headers, accept_gzip=accept_gzip,
+                            timeout=timeout)
+
+    def _resolve(self, job):
+        '''Expands the origin of job to its ranked mirrors'''
+        if job.origins is None:
+            job.origins = self.mirrors.alternatives(job.url)
+        if job.source is None:
+            job.source = job.sources[0]
+
+    def _open_first(self, job, start=None, end=None, accept_gzip=False):
+        '''Like _open, but tries the sources of job in order until one of
+        them answers, with a backoff between rounds. Peers that fail are
+        dropped.'''
+        self._resolve(job)
+        last_error = None
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                self._backoff(attempt)
+            for source in job.sources:
+                job.source = source
+                try:
+                    response = self._open(job, source, start, end, accept_gzip)
+                    job.started = True
+                    return response
+                except Exception, err:
+                    last_error = err
+                    if job.on_peer(source):
+                        print 'Peer %s: %s' % (source, err)
+                        job.peers.remove(source)
+                    else:
+                        print >> sys.stderr, 'Mirror %s: %s' % (source, err)
+                        self.mirrors.record_failure(source)
+            if not is_retriable(last_error):
+                break
+        raise last_error
+
+    def _next_source(self, job, failed):
+        '''Returns the best ranked mirror of job other than failed, or
+        failed if there is no other'''
+        job.origins = self.mirrors.alternatives(job.url)
+        for source in job.origins:
+            if source != failed:
+                return source
+        return failed
+
+    def _queue_segments(self, job, first_start):
+        '''Queues all segments of job from first_start that are not yet
+        completed'''
+        segments = [(start, end) for start, end in job.segments
+                    if start >= first_start and start not in job.completed]
+        with self._lock:
+            job.pending += len(segments)
+        for segment in segments:
+            self._put(job.priority, (self._fetch_segment, job, segment))
+
+    def _resume(self, job, state):
+        '''Continues a partial download from its state file'''
+        print "Resuming %s..." % job.url
+        self._resolve(job)
+        job.started = True
+        job.size = state['size']
+        job.completed = list(state.get('completed', []))
+        self._plan_segments(job)
+        self._new_digester(job)
+        done = 0
+        for start, end in job.segments:
+            if start in job.completed:
+                done += end - start + 1
+        self._add_progress(done, job.size, job)
+        self._queue_segments(job, 0)
+
+    def _first_segment(self, job, dummy_segment):
+        '''Requests the first segment of a job and decides how the rest of
+        the file is fetched'''
+        print "Downloading %s..." % job.url
+        make_parent_dirs(job.local_path)
+        if self.cache:
+            self.cache.clear_state(job.local_path)
+        self._new_digester(job)
+        if job.compress:
+            response = self._open_first(job, accept_gzip=True)
+        elif job.chunks:
+            first_end = chunk_segments(job.chunks, self.segment_size)[0][1]
+            response = self._open_first(job, 0, first_end)
+        else:
+            response = self._open_first(job, 0, self.segment_size - 1)
+        if job.on_peer():
+            print "Using peer %s" % job.source
+        elif job.source != job.url:
+            print "Using mirror %s" % job.source
+        try:
+            match = None
+            if response.getcode() == 206:
+                match = CONTENT_RANGE_RE.match(
+                    response.getheader('Content-Range', ''))
+            if match and match.group(3) != '*':
+                self._check_size(job, int(match.group(3)))
+                job.size = int(match.group(3))
+                self._plan_segments(job)
+                self._add_progress(0, job.size, job)
+                with open(job.local_path, 'wb') as fileobj:
+                    fileobj.truncate(job.size)
+                self._save_state(job)
+                end = job.segments[0][1]
+                self._queue_segments(job, end + 1)
+                written = [0]
+                try:
+                    with open(job.local_path, 'r+b') as fileobj:
+                        self._copy(response, fileobj, job, job.source,
+                                   written)
+                except DownloadCancelled:
+                    raise
+                except Exception, err:
+                    print >> sys.stderr, 'Source %s: %s' % (job.source, err)
+                    if not job.on_peer():
+                        self.mirrors.record_failure(job.source)
+                        job.source = self._next_source(job, job.source)
+                if written[0] != end + 1:
+                    # continue the first segment like any other
+                    self._fetch_segment(job, (0, end), written)
+                else:
+                    self._segment_done(job, 0)
+            else:
+                # no Range support, stream the whole body
+                length = response.getheader('Content-Length')
+                if length and not response.encoded:
+                    self._check_size(job, int(length))
+                    job.size = int(length)
+                    self._add_progress(0, job.size, job)
+                # a state file without segments marks the file as partial
+                # until it is complete
+                self._save_state(job)
+                with open(job.local_path, 'wb') as fileobj:
+                    self._copy(response, fileobj, job, job.source)
+        finally:
+            response.close()
+
+    def _fetch_segment(self, job, segment, written=None):
+        '''Fetches a segment, retrying from where a failed transfer stopped.
+        written holds the next offset to write.'''
+        start, end = segment
+        written = written or [start]
+        attempt = 0
+        while True:
+            if job.chunks:
+                # continue at the start of the chunk the transfer stopped in,
+                # so the chunk can be verified as a whole
+                rewind = written[0] - chunk_start(job.chunks, written[0])
+                if rewind:
+                    written[0] -= rewind
+                    self._add_progress(-rewind, job=job)
+            source = job.source
+            try:
+                self._fetch_range(job, source, written, end)
+                break
+            except DownloadCancelled:
+                raise
+            except Exception, err:
+                if job.on_peer(source):
+                    # the peer went away, continue from the origin
+                    print >> sys.stderr, 'Peer %s: %s' % (source, err)
+                    if source in job.peers:
+                        job.peers.remove(source)
+                    job.source = self._next_source(job, None)
+                    continue
+                attempt += 1
+                self.mirrors.record_failure(source)
+                if attempt >= MAX_ATTEMPTS or not is_retriable(err):
+                    raise
+                job.source = self._next_source(job, source)
+                print >> sys.stderr, 'Mirror %s: %s, continuing from %s' % (
+                    source, err, job.source)
+                if job.source == source:
+                    self._backoff(attempt)
+        self._segment_done(job, start)
+
+    def _fetch_range(self, job, source, written, end):
+        response = self._open(job, source, written[0], end)
+        try:
+            if response.getcode() != 206:
+                raise ReplicationError(
+                    'Server did not honor Range request (HTTP %s)'
+                    % response.getcode())
+            with open(job.local_path, 'r+b') as fileobj:
+                fileobj.seek(written[0])
+                self._copy(response, fileobj, job, source, written, end)
+        finally:
+            response.close()
+        if written[0] != end + 1:
+            raise ReplicationError(
+                'Short read: transfer ended at offset %d of %d'
+                % (written[0], end + 1))
+
+    def _copy(self, response, fileobj, job, source, written=None, end=None):
+        '''Copies the body of response to fileobj, verifying it on the way.
+        With written, the offset in it is advanced as data arrives and a
+        transfer much slower than another mirror raises SlowMirror. A chunk
+        that doesn't match the chunklist raises IntegrityError before it is
+        written completely.'''
+        copied = 0
+        started = time.time()
+        position = fileobj.tell()
+        throttle = not job.on_peer(source) and self.shaper.enabled
+        # a capped transfer is slow on purpose
+        check_slow = (written is not None and not job.on_peer(source) and
+                      len(job.origins or ()) > 1 and
+                      not (throttle and self.shaper.limited(source)))
+        verifier = None
+        if job.chunks:
+            verifier = ChunkVerifier(job.chunks, position)
+        try:
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                if verifier is not None:
+                    verifier.update(data)
+                fileobj.write(data)
+                if job.digester is not None:
+                    job.digester.update(position + copied, data)
+                copied += len(data)
+                if written is not None:
+                    written[0] += len(data)
+                self._add_progress(len(data), job=job, fetched=True)
+                if throttle:
+                    self._throttle(job, source, len(data))
+                self._check_cancelled()
+                if check_slow:
+                    self._check_slow(job, source, copied, started)
+        finally:
+            # small files say more about latency than about throughput
+            if copied >= BLOCK_SIZE:
+                self.mirrors.record(source, copied, time.time() - started)
+        return copied
+
+    def _throttle(self, job, source, count):
+        '''Waits until count bytes from source fit the bandwidth limits'''
+        delay = self.shaper.reserve(source, count, job.priority)
+        if not delay:
+            return
+        job.throttled += delay
+        if self.cancel_event is not None:
+            self.cancel_event.wait(delay)
+        else:
+            time.sleep(delay)
+
+    def _check_slow(self, job, source, copied, started):
+        elapsed = time.time() - started
+        if elapsed < SLOW_GRACE:
+            return
+        best = self.mirrors.best_rate(job.url, exclude=source)
+        if best and copied / elapsed * SLOW_FACTOR < best:
+            raise SlowMirror('%.1f KB/s, another mirror does %.1f KB/s'
+                             % (copied / elapsed / 1024, best / 1024))
+
+
+def map_concurrently(func, items, workers=DEFAULT_WORKERS):
+    '''Calls func for every item on a pool of at most workers threads.
+    Returns the results in the order of items. The first exception raised
+    by func is re-raised in the calling thread.'''
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    tasks = Queue.Queue()
+    for idx, item in enumerate(items):
+        tasks.put((idx, item))
+    recorder = instrument.shared_recorder()
+    parent = recorder.current()
+
+    def worker():
+        with recorder.within(parent):
+            while not errors:
+                try:
+                    idx, item = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[idx] = func(item)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+    threads = []
+    for dummy in range(min(max(1, workers), len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def _make_cache(root_dir, ignore_cache):
+    if ignore_cache:
+        return None
+    return PackageCache(root_dir)
+
+
+@instrument.traced
+def replicate_if_modified(full_url, root_dir='/tmp', ignore_cache=False):
+    '''Downloads a URL that is republished in place, like the sucatalog,
+    with If-None-Match/If-Modified-Since. The previous copy is kept if the
+    server answers 304 or the download fails.
+    Returns a tuple of the path to the replicated file and a validator string
+    that changes whenever the content does.'''
+    local_file_path = local_path_for_url(full_url, root_dir)
+    make_parent_dirs(local_file_path)
+    cache = PackageCache(root_dir)
+    validators = {}
+    if not ignore_cache:
+        validators = cache.load_validators(local_file_path)
+    headers = {}
+    if validators.get('ETag'):
+        headers['If-None-Match'] = validators['ETag']
+    if validators.get('Last-Modified'):
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    print "Downloading %s..." % full_url
+    mirror_list = shared_mirrors()
+    last_error = None
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(backoff_delay(attempt))
+        for source in mirror_list.alternatives(full_url):
+            try:
+                fetched = _fetch_if_modified(source, headers, local_file_path)
+            except Exception, err:
+                print >> sys.stderr, 'Could not replicate %s: %s' % (source, err)
+                mirror_list.record_failure(source)
+                last_error = err
+                continue
+            if fetched is None:
+                print "%s not modified" % full_url
+                return local_file_path, validators['validator']
+            cache.save_validators(local_file_path, fetched)
+            instrument.add_bytes(os.path.getsize(local_file_path))
+            return local_file_path, fetched['validator']
+        if not is_retriable(last_error):
+            break
+    raise ReplicationError(last_error)
+
+
+def _fetch_if_modified(url, headers, local_file_path):
+    '''Conditionally GETs url into local_file_path. Returns None if the
+    server answered 304, otherwise the new validators.'''
+    response = shared_pool().request(url, headers, accept_gzip=True)
+    if response.status == 304:
+        response.close()
+        return None
+    temp_path = local_file_path + '.tmp'
+    hasher = hashlib.sha1()
+    shaper = shaping.shared_shaper()
+    try:
+        with open(temp_path, 'wb') as fileobj:
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                # counts against the limits without waiting for them
+                shaper.reserve(url, len(data), shaping.METADATA)
+                hasher.update(data)
+                fileobj.write(data)
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+    finally:
+        response.close()
+    os.rename(temp_path, local_file_path)
+    validators = {'validator': 'sha1:' + hasher.hexdigest()}
+    if etag:
+        validators['ETag'] = etag
+    if last_modified:
+        validators['Last-Modified'] = last_modified
+    return validators
+
+
+def replicate_url(full_url, root_dir='/tmp', ignore_cache=False,
+                  progress=None):
+    '''Downloads a URL and stores it in the same relative path on our
+    filesystem. Returns a path to the replicated file.'''
+    local_file_path = local_path_for_url(full_url, root_dir)
+    engine = DownloadEngine(workers=1, progress=progress,
+                            cache=_make_cache(root_dir, ignore_cache))
+    engine.add(full_url, local_file_path, compress=True)
+    engine.run()
+    return local_file_path
+
+
+def _load_chunklist(url, root_dir, ignore_cache):
+    '''Replicates and parses a chunklist. Returns None if that fails, so the
+    package is checked against its catalog digest instead.'''
+    try:
+        return parse_chunklist(replicate_url(url, root_dir, ignore_cache))
+    except (ReplicationError, IntegrityError), err:
+        print >> sys.stderr, 'Not using chunklist %s: %s' % (url, err)
+        return None
+
+
+def replicate_packages(packages, root_dir='/tmp', ignore_cache=False,
+                       workers=DEFAULT_WORKERS, progress=None,
+                       cancel_event=None, peers=None):
+    '''Downloads the URL and MetadataURL of catalog package dicts. Package
+    files are checked against the catalog's Size and Digest as they are
+    written, or chunk by chunk against their IntegrityDataURL chunklist.
+    peers are base URLs of peer caches to try before the origin.
+    Returns a list of paths to the replicated files.'''
+    chunklist_urls = [package['IntegrityDataURL'] for package in packages
+                      if 'URL' in package and 'IntegrityDataURL' in package]
+    chunklists = dict(zip(chunklist_urls, map_concurrently(
+        lambda url: _load_chunklist(url, root_dir, ignore_cache),
+        chunklist_urls, workers)))
+    engine = DownloadEngine(workers=workers, progress=progress,
+                            cache=_make_cache(root_dir, ignore_cache),
+                            cancel_event=cancel_event, peers=peers)
+    paths = []
+    for package in packages:
+        if 'URL' in package:
+            local_file_path = local_path_for_url(package['URL'], root_dir)
+            chunks = chunklists.get(package.get('IntegrityDataURL'))
+            if (chunks and package.get('Size') is not None and
+                    chunklist_size(chunks) != package['Size']):
+                print >> sys.stderr, (
+                    'Ignoring the chunklist of %s: it describes %d bytes, '
+                    'the catalog %d' % (package['URL'],
+                                        chunklist_size(chunks),
+                                        package['Size']))
+                chunks = None
+            engine.add(package['URL'], local_file_path,
+                       size=package.get('Size'),
+                       digest=package.get('Digest'), chunks=chunks)
+            paths.append(local_file_path)
+        if 'MetadataURL' in package:
+            local_file_path = local_path_for_url(
+                package['MetadataURL'], root_dir)
+            engine.add(package['MetadataURL'], local_file_path,
+                       compress=True)
+            paths.append(local_file_path)
+    engine.run()
+    return paths
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+#  imaging.py
+#  OSReinstaller
+#
+#  Disk image handling with hdiutil: the sparse image an installer product
+#  is installed to, compressed images and mounting.
+#
+
+import os
+import sys
+import plistlib
+import subprocess
+
+from xml.parsers.expat import ExpatError
+
+import instrument
+
+
+HDIUTIL = '/usr/bin/hdiutil'
+
+
+class ImagingError(Exception):
+    '''A custom error when hdiutil fails'''
+    pass
+
+
+@instrument.traced
+def make_sparse_image(volume_name, output_path, size='8g'):
+    '''Make a sparse disk image we can install a product to'''
+    cmd = [HDIUTIL, 'create', '-size', size, '-fs', 'HFS+',
+           '-volname', volume_name, '-type', 'SPARSE', '-plist', output_path]
+    try:
+        output = subprocess.check_output(cmd)
+    except subprocess.CalledProcessError, err:
+        print >> sys.stderr, err
+        raise ImagingError(err)
+    try:
+        return plistlib.readPlistFromString(output)[0]
+    except IndexError, err:
+        print >> sys.stderr, 'Unexpected output from hdiutil: %s' % output
+        raise ImagingError('Unexpected output from hdiutil: %s' % output)
+    except ExpatError, err:
+        print >> sys.stderr, 'Malformed output from hdiutil: %s' % output
+        print >> sys.stderr, err
+        raise ImagingError('Malformed output from hdiutil: %s' % output)
+
+
+@instrument.traced
+def make_compressed_dmg(app_path, diskimagepath):
+    """Returns path to newly-created compressed r/o disk image containing
+    Install macOS.app"""
+
+    print ('Making read-only compressed disk image containing %s...'
+           % os.path.basename(app_path))
+    cmd = [HDIUTIL, 'create', '-fs', 'HFS+',
+           '-srcfolder', app_path, diskimagepath]
+    try:
+        subprocess.check_call(cmd)
+    except subprocess.CalledProcessError, err:
+        print >> sys.stderr, err
+        raise ImagingError(err)
+    print 'Disk image created at: %s' % diskimagepath
+    instrument.add_bytes(os.path.getsize(diskimagepath))
+    return diskimagepath
+
+
+@instrument.traced
+def mountdmg(dmgpath):
+    """
+    Attempts to mount the dmg at dmgpath and returns first mountpoint
+    """
+    mountpoints = []
+    dmgname = os.path.basename(dmgpath)
+    cmd = [HDIUTIL, 'attach', dmgpath,
+           '-mountRandom', '/tmp', '-nobrowse', '-plist',
+           '-owners', 'on']
+    proc = subprocess.Popen(cmd, bufsize=-1,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (pliststr, err) = proc.communicate()
+    if proc.returncode:
+        print >> sys.stderr, 'Error: "%s" while mounting %s.' % (err, dmgname)
+        return None
+    if pliststr:
+        plist = plistlib.readPlistFromString(pliststr)
+        for entity in plist['system-entities']:
+            if 'mount-point' in entity:
+                mountpoints.append(entity['mount-point'])
+
+    return mountpoints[0]
+
+
+@instrument.traced
+def unmountdmg(mountpoint):
+    """
+    Unmounts the dmg at mountpoint
+    """
+    proc = subprocess.Popen([HDIUTIL, 'detach', mountpoint],
+                            bufsize=-1, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (dummy_output, err) = proc.communicate()
+    if proc.returncode:
+        print >> sys.stderr, 'Polite unmount failed: %s' % err
+        print >> sys.stderr, 'Attempting to force unmount %s' % mountpoint
+        # try forcing the unmount
+        retcode = subprocess.call([HDIUTIL, 'detach', mountpoint, '-force'])
+        if retcode:
+            print >> sys.stderr, 'Failed to unmount %s' % mountpoint
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+#  install.py
+#  OSReinstaller
+#
+#  Runs installer to build Install macOS.app from a product and
+#  startosinstall to erase and reinstall the system.
+#
+
+import os
+import sys
+import subprocess
+
+import instrument
+import outputparser
+from progress import NULL_PROGRESS
+from supervise import OutputLog
+
+
+INSTALLER = '/usr/sbin/installer'
+# runs startosinstall on a pty, so it doesn't buffer its percent complete
+# output; None to run it directly
+PTYEXEC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ptyexec')
+# fall back to /usr/bin/script
+# this is not preferred because it uses way too much CPU
+# checking stdin for input that will never come...
+SCRIPT_CMD = ['/usr/bin/script', '-q', '-t', '1', '/dev/null']
+
+
+class InstallError(Exception):
+    '''A custom error when building the installer or reinstalling fails'''
+    pass
+
+
+def _print(text, stream=None):
+    '''Prints decoded tool output, which often isn't ASCII, also when stdout
+    is not a terminal'''
+    print >> stream, text.encode('utf-8')
+
+
+def _print_tail(name, log):
+    '''Prints the last lines of a failed tool's output to stderr'''
+    _print(u'%s failed, last output:\n%s' % (name, log.describe()),
+           sys.stderr)
+
+
+@instrument.traced
+def install_product(dist_path, target_vol, progress=NULL_PROGRESS,
+                    on_process=None, log=None):
+    '''Install a product to a target volume.
+    on_process is called with the installer process once it started. The
+    output goes to log, an OutputLog; its tail is printed on failure.
+    Returns a boolean to indicate success or failure.'''
+    log = log or OutputLog()
+    cmd = [INSTALLER, '-pkg', dist_path, '-target', target_vol, '-verboseR']
+    log.mark(' '.join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if on_process:
+        on_process(proc)
+    for event in outputparser.parse_output(proc, outputparser.installer_table()):
+        log.append(event.line)
+        if event.kind == outputparser.PHASE:
+            _print(event.text)
+            progress.set_info(event.text)
+        elif event.kind == outputparser.STATUS:
+            _print(event.text)
+            progress.set_detail(event.text)
+        elif event.kind == outputparser.PERCENT:
+            progress.set_percent(event.percent)
+        elif event.kind == outputparser.STDERR:
+            _print(event.text, sys.stderr)
+
+    if proc.returncode == 0:
+        return True
+    _print_tail('installer', log)
+    return False
+
+
+def find_install_macos_app(dir_path):
+    '''Returns the path to the first Install macOS.app found the top level of
+    dir_path, or None'''
+    for item in os.listdir(dir_path):
+        item_path = os.path.join(dir_path, item)
+        startosinstall_path = os.path.join(
+            item_path, 'Contents/Resources/startosinstall')
+        if os.path.exists(startosinstall_path):
+            return item_path
+    # if we get here we didn't find one
+    return None
+
+
+@instrument.traced
+def reinstall_os(startosinstall_path, macos_app, progress=NULL_PROGRESS,
+                 on_process=None, log=None):
+    '''Runs startosinstall. on_process is called with the process once it
+    started. The output goes to log, an OutputLog; its tail is printed on
+    failure. Returns a boolean to indicate success or failure.'''
+    log = log or OutputLog()
+    if PTYEXEC and os.path.exists(PTYEXEC):
+        cmd = [PTYEXEC]
+    else:
+        cmd = list(SCRIPT_CMD)
+
+    cmd.extend([startosinstall_path, "--applicationpath", macos_app,
+                "--eraseinstall", "--agreetolicense", "--nointeraction"])
+
+    # more magic to get startosinstall to not buffer its output for
+    # percent complete
+    env = {'NSUnbufferedIO': 'YES'}
+
+    log.mark(' '.join(cmd))
+    proc = subprocess.Popen(
+        cmd, shell=False, bufsize=-1, env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if on_process:
+        on_process(proc)
+
+    for event in outputparser.parse_output(
+            proc, outputparser.startosinstall_table()):
+        # keep the output in case there is an error so we can dump its
+        # tail to the log
+        log.append(event.line)
+        if event.kind == outputparser.PHASE:
+            _print(event.text)
+            progress.set_info(event.text)
+        elif event.kind == outputparser.PERCENT:
+            progress.set_percent(event.percent)
+        elif event.kind == outputparser.LOG:
+            _print(event.text)
+        elif event.kind == outputparser.DONE:
+            msg = 'System will restart and begin install of macOS.'
+            print msg
+            progress.set_info(msg)
+            progress.set_percent(100)
+            progress.set_detail("done")
+        elif event.kind == outputparser.STATUS:
+            # none of the above, just display
+            _print(event.text)
+            progress.set_detail(event.text)
+
+    if proc.returncode == 0:
+        return True
+    _print_tail('startosinstall', log)
+    return False
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#
+#  instrument.py
+#  OSReinstaller
+#
+#  Span based instrumentation. Every step of a run - the pipeline stages,
+#  catalog parsing, each download, hdiutil, installer and startosinstall -
+#  is recorded as a span with its wall time, the bytes it moved and the
+#  peak resident memory of this process and its children when it ended.
+#  At the end of a run the spans are written as a JSON report and as a
+#  Prometheus textfile for node_exporter's textfile collector.
+#
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+from contextlib import contextmanager
+from functools import wraps
+
+
+REPORT_NAME = 'osreinstaller-report.json'
+METRICS_NAME = 'osreinstaller.prom'
+METRIC_PREFIX = 'osreinstaller'
+
+
+def peak_rss():
+    '''Returns the peak resident set size in bytes of this process and of
+    its largest waited-for child'''
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class Span(object):
+    '''A timed step of a run'''
+
+    def __init__(self, span_id, name, parent_id=None, started=None,
+                 attrs=None):
+        self.span_id = span_id
+        self.name = name
+        self.parent_id = parent_id
+        self.thread = threading.current_thread().name
+        self.started = started if started is not None else time.time()
+        self.finished = None
+        self.bytes = 0
+        self.error = None
+        self.peak_rss = None
+        self.attrs = dict(attrs or {})
+        self._lock = threading.Lock()
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.bytes += count
+
+    def finish(self, error=None, finished=None):
+        self.finished = finished if finished is not None else time.time()
+        if error is not None:
+            self.error = str(error) or error.__class__.__name__
+        self.peak_rss = peak_rss()
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        '''Bytes per second, or None for spans that moved no bytes'''
+        if not self.bytes or self.duration <= 0:
+            return None
+        return self.bytes / self.duration
+
+    def as_dict(self, origin):
+        return {
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'thread': self.thread,
+            'start': round(self.started - origin, 3),
+            'duration': round(self.duration, 3),
+            'bytes': self.bytes,
+            'throughput': self.throughput,
+            'peak_rss': self.peak_rss,
+            'error': self.error,
+            'attrs': self.attrs,
+        }
+
+
+class Recorder(object):
+    '''Collects the spans of a run. Spans opened with span() nest per
+    thread; spans recorded after the fact name their parent explicitly.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.spans = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        '''Returns the innermost open span of the calling thread, or None'''
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def within(self, span):
+        '''Makes span the parent of the spans the calling thread opens in the
+        enclosed block, e.g. on a worker thread doing part of its work'''
+        if span is None:
+            yield
+            return
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield
+        finally:
+            stack.remove(span)
+
+    def _new_span(self, name, parent, started, attrs):
+        with self._lock:
+            span = Span(self._next_id, name,
+                        parent.span_id if parent is not None else None,
+                        started, attrs)
+            self._next_id += 1
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attrs):
+        '''Records the enclosed block as a span and yields it'''
+        span = self._new_span(name, self.current(), None, attrs)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        except BaseException, err:
+            span.finish(error=err)
+            raise
+        else:
+            span.finish()
+        finally:
+            stack.remove(span)
+
+    def record(self, name, started, finished, count=0, error=None,
+               parent=None, **attrs):
+        '''Adds a span that was timed elsewhere, e.g. on worker threads'''
+        span = self._new_span(name, parent, started, attrs)
+        span.add_bytes(count)
+        span.finish(error=error, finished=finished)
+        return span
+
+    def summary(self):
+        '''Returns a dict of span name to count, errors, seconds and bytes'''
+        summary = {}
+        with self._lock:
+            spans = [span for span in self.spans if span.finished is not None]
+        for span in spans:
+            entry = summary.setdefault(
+                span.name, {'count': 0, 'errors': 0, 'seconds': 0.0,
+                            'bytes': 0})
+            entry['count'] += 1
+            entry['seconds'] += span.duration
+            entry['bytes'] += span.bytes
+            if span.error is not None:
+                entry['errors'] += 1
+        for entry in summary.values():
+            entry['throughput'] = (entry['bytes'] / entry['seconds']
+                                   if entry['bytes'] and entry['seconds']
+                                   else None)
+        return summary
+
+    def report(self, success, error=None):
+        '''Returns the report of the run as a dict'''
+        finished = time.time()
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            'started': self.started,
+            'finished': finished,
+            'duration': round(finished - self.started, 3),
+            'success': success,
+            'error': str(error) if error is not None else None,
+            'peak_rss': peak_rss(),
+            'summary': self.summary(),
+            'spans': [span.as_dict(self.started) for span in spans],
+        }
+
+
+def _write_atomically(path, text):
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as fileobj:
+        fileobj.write(text)
+    os.rename(temp_path, path)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def prometheus_text(report):
+    '''Returns the report as Prometheus text exposition format'''
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        name = '%s_%s' % (METRIC_PREFIX, name)
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            if labels:
+                label_text = ','.join('%s="%s"' % (key, _label(labels[key]))
+                                      for key in sorted(labels))
+                lines.append('%s{%s} %s' % (name, label_text, repr(value)))
+            else:
+                lines.append('%s %s' % (name, repr(value)))
+
+    summary = sorted(report['summary'].items())
+    metric('run_success', 'gauge', 'Whether the last run succeeded.',
+           [(None, 1 if report['success'] else 0)])
+    metric('run_finished_timestamp_seconds', 'gauge',
+           'When the last run ended.', [(None, report['finished'])])
+    metric('run_duration_seconds', 'gauge', 'Wall time of the last run.',
+           [(None, report['duration'])])
+    metric('peak_rss_bytes', 'gauge',
+           'Peak resident set size during the last run.',
+           [({'process': key}, value)
+            for key, value in sorted(report['peak_rss'].items())])
+    metric('span_count', 'gauge', 'Number of spans of a step.',
+           [({'span': name}, entry['count']) for name, entry in summary])
+    metric('span_errors', 'gauge', 'Number of failed spans of a step.',
+           [({'span': name}, entry['errors']) for name, entry in summary])
+    metric('span_seconds', 'gauge', 'Total wall time of a step.',
+           [({'span': name}, round(entry['seconds'], 3))
+            for name, entry in summary])
+    metric('span_bytes', 'gauge', 'Bytes moved by a step.',
+           [({'span': name}, entry['bytes']) for name, entry in summary])
+    metric('span_throughput_bytes_per_second', 'gauge',
+           'Bytes per second of a step.',
+           [({'span': name}, round(entry['throughput'], 1))
+            for name, entry in summary if entry['throughput']])
+    return '\n'.join(lines) + '\n'
+
+
+def export(report, report_dir):
+    '''Writes the JSON report and the Prometheus textfile to report_dir.
+    Returns their paths.'''
+    json_path = os.path.join(report_dir, REPORT_NAME)
+    metrics_path = os.path.join(report_dir, METRICS_NAME)
+    _write_atomically(json_path, json.dumps(report, indent=2, sort_keys=True))
+    _write_atomically(metrics_path, prometheus_text(report))
+    return json_path, metrics_path
+
+
+_recorder = Recorder()
+
+
+def shared_recorder():
+    return _recorder
+
+
+def span(name, **attrs):
+    '''Records the enclosed block as a span of the shared recorder'''
+    return _recorder.span(name, **attrs)
+
+
+def add_bytes(count):
+    '''Adds count to the bytes of the calling thread's innermost span'''
+    current = _recorder.current()
+    if current is not None:
+        current.add_bytes(count)
+
+
+def traced(func):
+    '''Decorator recording every call of func as a span named after it'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _recorder.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
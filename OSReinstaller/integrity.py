@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+#  integrity.py
+#  OSReinstaller
+#
+#  Verification of downloads in the same pass that writes them. Packages
+#  with an Apple chunklist (the catalog's IntegrityDataURL) are checked
+#  chunk by chunk as each segment is written, so a corrupt chunk is fetched
+#  again right away. For other packages, the catalog Digest is computed
+#  over the data written in file order; data that arrived ahead of that
+#  point is read back as soon as the segments before it completed, while it
+#  is still in the page cache.
+#
+
+import struct
+import hashlib
+import threading
+
+
+CHUNKLIST_MAGIC = 'CNKL'
+# magic, header size, file version, chunk method, signature method,
+# padding, chunk count, chunk offset, signature offset
+CHUNKLIST_HEADER = struct.Struct('<4sIBBBxQQQ')
+# chunk size and its SHA-256
+CHUNKLIST_ENTRY = struct.Struct('<I32s')
+CHUNK_METHOD_SHA256 = 1
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class IntegrityError(Exception):
+    '''Raised when downloaded data doesn't match its size, digest or
+    chunklist'''
+    pass
+
+
+class Chunk(object):
+    '''A range of a file and the SHA-256 it must have'''
+
+    def __init__(self, offset, size, digest):
+        self.offset = offset
+        self.size = size
+        self.digest = digest
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+def parse_chunklist(path):
+    '''Returns the chunks listed in an Apple chunklist file. The signature
+    is not checked. Raises IntegrityError for files that are not a SHA-256
+    chunklist.'''
+    try:
+        with open(path, 'rb') as fileobj:
+            data = fileobj.read()
+    except IOError, err:
+        raise IntegrityError('Error reading %s: %s' % (path, err))
+    if len(data) < CHUNKLIST_HEADER.size:
+        raise IntegrityError('%s is not a chunklist' % path)
+    (magic, header_size, dummy_version, chunk_method, dummy_signature_method,
+     count, chunk_offset, dummy_signature_offset) = CHUNKLIST_HEADER.unpack(
+         data[:CHUNKLIST_HEADER.size])
+    if magic != CHUNKLIST_MAGIC or header_size != CHUNKLIST_HEADER.size:
+        raise IntegrityError('%s is not a chunklist' % path)
+    if chunk_method != CHUNK_METHOD_SHA256:
+        raise IntegrityError('Unsupported chunk method %d in %s'
+                             % (chunk_method, path))
+    if chunk_offset + count * CHUNKLIST_ENTRY.size > len(data):
+        raise IntegrityError('Truncated chunklist %s' % path)
+    chunks = []
+    offset = 0
+    for idx in range(count):
+        start = chunk_offset + idx * CHUNKLIST_ENTRY.size
+        size, digest = CHUNKLIST_ENTRY.unpack(
+            data[start:start + CHUNKLIST_ENTRY.size])
+        chunks.append(Chunk(offset, size, digest))
+        offset += size
+    return chunks
+
+
+def chunklist_size(chunks):
+    '''Returns the size of the file described by chunks'''
+    return chunks[-1].end if chunks else 0
+
+
+def chunk_segments(chunks, segment_size):
+    '''Groups chunks into (start, end) segments of at most segment_size
+    bytes, or a single chunk if it is larger, so every segment starts and
+    ends on a chunk boundary'''
+    segments = []
+    start = None
+    for chunk in chunks:
+        if start is not None and chunk.end - start > segment_size:
+            segments.append((start, chunk.offset - 1))
+            start = None
+        if start is None:
+            start = chunk.offset
+    if start is not None:
+        segments.append((start, chunklist_size(chunks) - 1))
+    return segments
+
+
+def chunk_start(chunks, offset):
+    '''Returns the start of the chunk offset falls in'''
+    for chunk in chunks:
+        if chunk.offset <= offset < chunk.end:
+            return chunk.offset
+    return offset
+
+
+class ChunkVerifier(object):
+    '''Checks a sequential write starting on a chunk boundary against the
+    chunklist as the data arrives'''
+
+    def __init__(self, chunks, offset):
+        self.chunks = chunks
+        self.index = None
+        for idx, chunk in enumerate(chunks):
+            if chunk.offset == offset:
+                self.index = idx
+                break
+        if self.index is None:
+            raise IntegrityError('Offset %d is not on a chunk boundary'
+                                 % offset)
+        self._start_chunk()
+
+    def _start_chunk(self):
+        self.hasher = hashlib.sha256()
+        self.remaining = (self.chunks[self.index].size
+                          if self.index < len(self.chunks) else 0)
+
+    def update(self, data):
+        '''Hashes data, raising IntegrityError as soon as a chunk it
+        completes doesn't match'''
+        while data:
+            if self.index >= len(self.chunks):
+                raise IntegrityError('Data beyond the end of the chunklist')
+            part = data[:self.remaining]
+            self.hasher.update(part)
+            self.remaining -= len(part)
+            data = data[len(part):]
+            if not self.remaining:
+                chunk = self.chunks[self.index]
+                if self.hasher.digest() != chunk.digest:
+                    raise IntegrityError(
+                        'Chunk %d at offset %d does not match the chunklist'
+                        % (self.index, chunk.offset))
+                self.index += 1
+                self._start_chunk()
+
+
+class OrderedDigest(object):
+    '''Computes a whole-file digest from data written in any order. Data
+    written at the point hashed so far is hashed right away; advance() and
+    finish() read back what arrived ahead of it.'''
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.offset = 0
+        self.read_back = 0
+        self._lock = threading.Lock()
+
+    def update(self, offset, data):
+        '''Hashes data written at offset if it continues the hashed part'''
+        with self._lock:
+            if offset == self.offset:
+                self.hasher.update(data)
+                self.offset += len(data)
+
+    def advance(self, path, limit=None):
+        '''Hashes the file at path from the point hashed so far up to
+        limit, or to its end. The data up to limit must be written
+        completely.'''
+        with self._lock:
+            if limit is not None and limit <= self.offset:
+                return
+            with open(path, 'rb') as fileobj:
+                fileobj.seek(self.offset)
+                while limit is None or self.offset < limit:
+                    size = READ_BLOCK_SIZE
+                    if limit is not None:
+                        size = min(size, limit - self.offset)
+                    data = fileobj.read(size)
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    self.offset += len(data)
+                    self.read_back += len(data)
+
+    def finish(self, path):
+        '''Hashes the rest of the file at path and returns the hex digest'''
+        self.advance(path)
+        return self.hasher.hexdigest()
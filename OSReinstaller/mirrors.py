@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+#  mirrors.py
+#  OSReinstaller
+#
+#  Mirror selection. A mirror group is a list of base URLs serving the same
+#  tree, e.g. the reposado content root and its mirrors. Any catalog or
+#  package URL below one of the bases can be fetched from all of them. A
+#  group is probed for latency and throughput the first time it is used and
+#  ranked; the download engine keeps the ranking current with the
+#  throughput and errors it sees.
+#
+
+import sys
+import time
+import threading
+
+from connpool import shared_pool
+
+
+# bytes fetched from every mirror to measure it
+PROBE_SIZE = 256 * 1024
+PROBE_TIMEOUT = 10
+# mirrors are ranked by the expected seconds to fetch this many bytes
+SCORE_SIZE = 4 * 1024 * 1024
+# weight of the newest sample in the throughput moving average
+SMOOTHING = 0.3
+
+
+class Mirror(object):
+    '''A base URL and what is known about its performance'''
+
+    def __init__(self, base, order):
+        self.base = base
+        self.order = order
+        self.latency = None
+        self.rate = None
+        self.failures = 0
+
+    def score(self):
+        '''Expected seconds to fetch SCORE_SIZE bytes, or None if the mirror
+        wasn't measured yet'''
+        if not self.rate:
+            return None
+        return (self.latency or 0.0) + SCORE_SIZE / self.rate
+
+    def rank_key(self):
+        # mirrors failing right now go last, unmeasured ones keep the
+        # configured order behind the measured ones
+        score = self.score()
+        return (self.failures, score is None, score or 0.0, self.order)
+
+    def describe(self):
+        if self.failures:
+            return '%s (failing)' % self.base
+        if self.rate is None:
+            return '%s (not measured)' % self.base
+        return '%s (%.0f ms, %.1f MB/s)' % (
+            self.base, (self.latency or 0) * 1000, self.rate / 1048576.0)
+
+
+class MirrorGroup(object):
+    '''Base URLs serving the same files'''
+
+    def __init__(self, bases):
+        # a base without its slash would match siblings starting with the
+        # same name, e.g. .../content for .../content-old/
+        bases = [base if base.endswith('/') else base + '/'
+                 for base in bases]
+        self.mirrors = [Mirror(base, order) for order, base in enumerate(bases)]
+        self.probed = False
+        self._lock = threading.Lock()
+
+    def match(self, url):
+        '''Returns the mirror url is below and the path relative to it, or
+        (None, None)'''
+        for mirror in self.mirrors:
+            if url.startswith(mirror.base):
+                return mirror, url[len(mirror.base):]
+        return None, None
+
+    def ranked(self):
+        with self._lock:
+            return sorted(self.mirrors, key=Mirror.rank_key)
+
+    def record(self, mirror, count, seconds):
+        sample = count / seconds
+        with self._lock:
+            mirror.failures = 0
+            if mirror.rate is None:
+                mirror.rate = sample
+            else:
+                mirror.rate += SMOOTHING * (sample - mirror.rate)
+
+    def record_failure(self, mirror):
+        with self._lock:
+            mirror.failures += 1
+
+    def probe(self, relative, pool=None):
+        '''Measures latency and throughput of every mirror with a small Range
+        request for relative, concurrently'''
+        pool = pool or shared_pool()
+        threads = []
+        for mirror in self.mirrors:
+            thread = threading.Thread(
+                target=self._probe_one, args=(pool, mirror, relative))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.probed = True
+        print 'Mirror ranking: %s' % ', '.join(
+            mirror.describe() for mirror in self.ranked())
+
+    def _probe_one(self, pool, mirror, relative):
+        headers = {'Range': 'bytes=0-%d' % (PROBE_SIZE - 1)}
+        started = time.time()
+        try:
+            response = pool.request(mirror.base + relative, headers,
+                                    timeout=PROBE_TIMEOUT)
+            try:
+                first_byte = time.time()
+                count = 0
+                while True:
+                    data = response.read(64 * 1024)
+                    if not data:
+                        break
+                    count += len(data)
+            finally:
+                response.close()
+        except Exception, err:
+            print >> sys.stderr, 'Mirror %s failed: %s' % (mirror.base, err)
+            self.record_failure(mirror)
+            return
+        finished = time.time()
+        with self._lock:
+            mirror.latency = first_byte - started
+            if count:
+                mirror.rate = count / max(finished - first_byte, 0.001)
+
+
+class MirrorList(object):
+    '''The configured mirror groups. URLs outside all groups have no
+    alternatives.'''
+
+    def __init__(self, groups=()):
+        self.groups = [MirrorGroup(bases) for bases in groups if bases]
+        self._probe_lock = threading.Lock()
+
+    def _find(self, url):
+        for group in self.groups:
+            mirror, relative = group.match(url)
+            if mirror is not None:
+                return group, mirror, relative
+        return None, None, None
+
+    def alternatives(self, url):
+        '''Returns the URLs url can be fetched from, best mirror first. A
+        group is probed the first time one of its URLs is asked for.'''
+        group, dummy_mirror, relative = self._find(url)
+        if group is None:
+            return [url]
+        if not group.probed:
+            with self._probe_lock:
+                if not group.probed:
+                    group.probe(relative)
+        return [mirror.base + relative for mirror in group.ranked()]
+
+    def best_rate(self, url, exclude=None):
+        '''Returns the best throughput measured in the group of url, not
+        counting the mirror of the URL exclude'''
+        group, dummy_mirror, dummy_relative = self._find(url)
+        if group is None:
+            return None
+        excluded = group.match(exclude)[0] if exclude else None
+        rates = [mirror.rate for mirror in group.mirrors
+                 if mirror.rate and not mirror.failures and
+                 mirror is not excluded]
+        return max(rates) if rates else None
+
+    def record(self, url, count, seconds):
+        '''Feeds the throughput of a transfer from url into its mirror's
+        moving average'''
+        group, mirror, dummy_relative = self._find(url)
+        if group is not None and count > 0 and seconds > 0:
+            group.record(mirror, count, seconds)
+
+    def record_failure(self, url):
+        group, mirror, dummy_relative = self._find(url)
+        if group is not None:
+            group.record_failure(mirror)
+
+
+_shared_mirrors = MirrorList()
+
+
+def configure(groups):
+    '''Sets the mirror groups used by all downloads. groups is a list of
+    lists of equivalent base URLs.'''
+    global _shared_mirrors
+    _shared_mirrors = MirrorList(groups)
+
+
+def shared_mirrors():
+    return _shared_mirrors
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+#  outputparser.py
+#  OSReinstaller
+#
+#  Streaming parser for the output of installer and startosinstall. The
+#  process's pipes are read without blocking until both are closed, lines
+#  are split on '\n' and on the '\r' used for in-place progress updates,
+#  and every line is matched against a compiled rule table that turns it
+#  into a typed event.
+#
+
+import os
+import re
+import select
+import errno
+
+
+READ_SIZE = 64 * 1024
+# longer lines are split, so output without newlines can't grow a line
+# without bounds
+MAX_LINE = 64 * 1024
+
+# event kinds
+PHASE = 'phase'         # a new step, shown as the main info line
+STATUS = 'status'       # detail about the current step
+PERCENT = 'percent'     # percent complete, -1 if it couldn't be parsed
+LOG = 'log'             # only worth logging
+IGNORE = 'ignore'       # not worth anything
+DONE = 'done'           # the tool finished successfully
+STDERR = 'stderr'       # a line written to stderr
+
+INSTALLER_RULES = (
+    (r'^installer:PHASE:(?P<text>.+)$', PHASE),
+    (r'^installer:STATUS:(?P<text>.+)$', STATUS),
+    (r'^installer:%(?P<percent>.*)$', PERCENT),
+)
+
+STARTOSINSTALL_RULES = (
+    (r'^Preparing to ', PHASE),
+    # percent-complete messages
+    (r'^Preparing (?P<percent>.*?)\.*$', PERCENT),
+    # annoying legalese
+    (r'^(By using the agreetolicense option|If you do not agree,)', IGNORE),
+    # 10.12: 'Helper tool creashed', 10.13: 'Helper tool crashed'
+    (r'^Helper tool cr', LOG),
+    # messages around the SIGUSR1 signalling
+    (r'^(Signaling PID:|Waiting to reboot|Process signaled okay)', LOG),
+    (r'^System going down for install', DONE),
+)
+
+
+class OutputEvent(object):
+    '''A parsed line of tool output'''
+
+    __slots__ = ('kind', 'text', 'percent', 'line')
+
+    def __init__(self, kind, text, percent=None, line=None):
+        self.kind = kind
+        self.text = text
+        self.percent = percent
+        self.line = line if line is not None else text
+
+    def __repr__(self):
+        return 'OutputEvent(%r, %r, %r)' % (self.kind, self.text, self.percent)
+
+
+class LineReader(object):
+    '''Splits a byte stream into lines. '\n', '\r' and '\r\n' all end a
+    line; a trailing partial line is kept until more data arrives, or until
+    it is longer than MAX_LINE.'''
+
+    def __init__(self, encoding='UTF-8'):
+        self.encoding = encoding
+        self._partial = ''
+        self._skip_newline = False
+
+    def feed(self, data):
+        '''Returns the list of lines completed by data'''
+        if self._skip_newline and data.startswith('\n'):
+            data = data[1:]
+        self._skip_newline = data.endswith('\r')
+        data = self._partial + data
+        lines = data.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        self._partial = lines.pop()
+        if len(self._partial) > MAX_LINE:
+            lines.append(self._partial)
+            self._partial = ''
+        return [self._decode(line) for line in lines]
+
+    def flush(self):
+        '''Returns the final partial line, if any, at end of stream'''
+        partial, self._partial = self._partial, ''
+        if partial:
+            return [self._decode(partial)]
+        return []
+
+    def _decode(self, line):
+        return line.decode(self.encoding, 'replace')
+
+
+class RuleTable(object):
+    '''Maps lines to OutputEvents. rules is a sequence of (pattern, kind);
+    the first matching pattern wins. A named group 'text' selects the text
+    of the event (the whole line otherwise), a group 'percent' is parsed as
+    a float. Lines matching no rule get the default kind, or no event at
+    all if default is None.'''
+
+    def __init__(self, rules, default=None):
+        self.rules = [(re.compile(pattern), kind) for pattern, kind in rules]
+        self.default = default
+
+    def parse(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        for regex, kind in self.rules:
+            match = regex.match(line)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            text = groups.get('text') or line
+            percent = None
+            if 'percent' in groups:
+                try:
+                    percent = float(groups['percent'].strip())
+                except ValueError:
+                    percent = -1
+            return OutputEvent(kind, text, percent, line)
+        if self.default is None:
+            return None
+        return OutputEvent(self.default, line)
+
+
+def installer_table():
+    '''Rules for /usr/sbin/installer -verboseR; other lines are dropped'''
+    return RuleTable(INSTALLER_RULES)
+
+
+def startosinstall_table():
+    '''Rules for startosinstall; other lines are shown as status'''
+    return RuleTable(STARTOSINSTALL_RULES, default=STATUS)
+
+
+def read_lines(proc, encoding='UTF-8'):
+    '''Yields (stream name, line) tuples from the stdout and stderr pipes of
+    proc as they arrive, without blocking on either pipe. Returns once both
+    pipes are closed and the process has been waited for, so no output
+    written before exit is lost.'''
+    readers = {}
+    for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+        if pipe is not None:
+            readers[pipe.fileno()] = (name, LineReader(encoding))
+    while readers:
+        try:
+            ready, dummy_w, dummy_x = select.select(list(readers), [], [])
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            name, reader = readers[fd]
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError, err:
+                if err.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                # EIO from a pty whose slave side is closed
+                data = ''
+            if data:
+                lines = reader.feed(data)
+            else:
+                lines = reader.flush()
+                del readers[fd]
+            for line in lines:
+                yield name, line
+    proc.wait()
+
+
+def parse_output(proc, table):
+    '''Yields OutputEvents for the output of proc. stdout lines are parsed
+    with table, stderr lines become STDERR events.'''
+    for name, line in read_lines(proc):
+        if name == 'stderr':
+            if line.strip():
+                yield OutputEvent(STDERR, line.strip())
+            continue
+        event = table.parse(line)
+        if event is not None:
+            yield event
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+#  peercache.py
+#  OSReinstaller
+#
+#  LAN peer cache. A machine that has replicated a product serves its
+#  workdir over HTTP, so other machines reinstalling from the same catalog
+#  fetch the packages from it instead of from the origin server. Files are
+#  served under the same relative path replicate_url stores them at, and
+#  verified packages also by content at /digest/<digest>. Only replicated
+#  catalog content is served: partial downloads, logs, reports, indexes and
+#  built installers never are.
+#
+
+import os
+import re
+import sys
+import socket
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from cache import PackageCache, STATE_SUFFIX
+
+
+DEFAULT_PORT = 8087
+BLOCK_SIZE = 256 * 1024
+DIGEST_PREFIX = '/digest/'
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+# workdir folders that hold our own files rather than replicated ones
+PRIVATE_DIRS = ('logs', 'artifacts')
+# the kinds of files a catalog refers to
+CONTENT_SUFFIXES = ('.sucatalog', '.pkg', '.pkm', '.dist', '.smd',
+                    '.chunklist', '.dmg', '.plist')
+
+
+def peer_urls(peers, full_url, digest=None):
+    '''Returns the URLs to try on each peer for full_url, before the origin.
+    peers are base URLs of peer caches or of any server mirroring the
+    replicate_url layout. With a digest, a peer is asked for the file by
+    content first and then by path, which servers that only mirror the
+    layout answer.'''
+    urls = []
+    path = urlparse.urlsplit(full_url)[2]
+    for peer in peers:
+        base = peer.rstrip('/')
+        if digest:
+            urls.append(base + DIGEST_PREFIX + digest.lower())
+        urls.append(base + path)
+    return urls
+
+
+class PeerCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves complete files below the server's root_dir, with Range
+    support so peers can fetch them in segments'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        path = self.server.resolve(urlparse.urlsplit(self.path)[2])
+        if path is None:
+            self._send_empty(404, 'Not Found')
+            return
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            self._send_empty(404, 'Not Found')
+            return
+        with fileobj:
+            size = os.fstat(fileobj.fileno()).st_size
+            start, end = 0, size - 1
+            status = 200
+            match = RANGE_RE.match(self.headers.get('Range', ''))
+            if match and size:
+                first, last = match.groups()
+                if first:
+                    start = int(first)
+                    if last:
+                        end = min(int(last), size - 1)
+                elif last:
+                    start = max(size - int(last), 0)
+                if start > end:
+                    self.send_response(416, 'Requested Range Not Satisfiable')
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (start, end, size))
+            self.end_headers()
+            if not send_body:
+                return
+            fileobj.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = fileobj.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+            self.server.count_served(end - start + 1 - remaining)
+
+    def _send_empty(self, code, reason):
+        self.send_response(code, reason)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class PeerCacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server for the replicated files below root_dir. Run it with
+    start() in a background thread or serve_forever() in the foreground.'''
+
+    allow_reuse_address = True
+
+    def __init__(self, root_dir, port=DEFAULT_PORT, host='', verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, (host, port), PeerCacheHandler)
+        self.root_dir = os.path.abspath(root_dir)
+        self.cache = PackageCache(self.root_dir)
+        self.verbose = verbose
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._handlers = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def process_request(self, request, client_address):
+        '''Handles a connection on a new thread like ThreadingMixIn, keeping
+        the thread so stop() can end it'''
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self._lock:
+            self._handlers = [(handler, conn) for handler, conn
+                              in self._handlers if handler.is_alive()]
+            self._handlers.append((thread, request))
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        '''Peers close connections mid-transfer when they cancel or move a
+        segment elsewhere; only other errors are printed'''
+        if sys is None:
+            # a handler still running at interpreter shutdown, its module
+            # globals are gone
+            return
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def count_served(self, count):
+        with self._lock:
+            self.bytes_served += count
+
+    def resolve(self, url_path):
+        '''Returns the local path for a request path, or None if there is no
+        complete replicated file for it. Replicated files are always below
+        the folders of their URL path, so nothing at the top of root_dir is
+        served.'''
+        url_path = urlparse.unquote(url_path)
+        if url_path.startswith(DIGEST_PREFIX):
+            digest = url_path[len(DIGEST_PREFIX):]
+            if not re.match(r'^[0-9a-fA-F]{40,64}$', digest):
+                return None
+            return self.cache.path_for_digest(digest)
+        relative = os.path.normpath(url_path.lstrip('/'))
+        if relative.startswith('..') or os.path.isabs(relative):
+            return None
+        parts = relative.split(os.sep)
+        if len(parts) < 2 or parts[0] in PRIVATE_DIRS:
+            return None
+        if any(part.startswith('.') for part in parts):
+            return None
+        name = parts[-1]
+        if (not name.endswith(CONTENT_SUFFIXES) or
+                name.endswith('.partial.dmg')):
+            return None
+        path = os.path.join(self.root_dir, relative)
+        if not os.path.isfile(path) or os.path.exists(path + STATE_SUFFIX):
+            return None
+        return path
+
+    def start(self):
+        '''Serves requests on a background thread'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+            print 'Serving %s to peers on port %d' % (self.root_dir, self.port)
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+        # hang up on idle keep-alive connections so their handlers end
+        with self._lock:
+            handlers, self._handlers = self._handlers, []
+        for thread, request in handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+        print 'Served %d bytes to peers' % self.bytes_served
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+#  pipeline.py
+#  OSReinstaller
+#
+#  Runs the reinstall workflow as a small dependency graph of stages. A
+#  stage starts as soon as all stages it depends on have finished, so
+#  independent stages run concurrently. The first failing stage cancels the
+#  pipeline and its error is raised to the caller.
+#
+
+import sys
+import time
+import threading
+import contextlib
+
+import instrument
+
+
+class Cancelled(Exception):
+    '''Raised in a stage that notices the pipeline was cancelled'''
+    pass
+
+
+class StageError(Exception):
+    '''Raised by Pipeline.run for the stage that failed first'''
+
+    def __init__(self, stage, error):
+        Exception.__init__(self, str(error))
+        self.stage = stage
+        self.error = error
+
+
+class Stage(object):
+    '''A named unit of work. func is called with the pipeline and its return
+    value is stored in pipeline.results under the stage name.'''
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+
+class Pipeline(object):
+    '''A set of stages and the results they produced'''
+
+    def __init__(self):
+        self.stages = []
+        self.results = {}
+        self.cancelled = threading.Event()
+        self._cancel_callbacks = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def add(self, name, func, deps=()):
+        '''Adds a stage running func once all stages in deps finished'''
+        known = [stage.name for stage in self.stages]
+        for dep in deps:
+            if dep not in known:
+                raise ValueError('Unknown dependency %s of %s' % (dep, name))
+        stage = Stage(name, func, deps)
+        self.stages.append(stage)
+        return stage
+
+    def on_cancel(self, callback):
+        '''Registers callback to be called when the pipeline is cancelled,
+        e.g. to terminate a child process. Returns a handle for
+        remove_cancel.'''
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._cancel_callbacks.append(callback)
+                return callback
+        callback()
+        return callback
+
+    def remove_cancel(self, handle):
+        '''Unregisters a cancel callback once it no longer applies, e.g.
+        when its process has been waited for'''
+        with self._lock:
+            if handle in self._cancel_callbacks:
+                self._cancel_callbacks.remove(handle)
+
+    @contextlib.contextmanager
+    def terminating(self):
+        '''Yields an on_process callback for the install functions. The
+        processes it is called with are terminated if the pipeline is
+        cancelled before the block exits, but never once they exited or
+        the block is left, so a reused pid can't get the signal.'''
+        handles = []
+
+        def on_process(proc):
+            handles.append(self.on_cancel(
+                lambda: proc.poll() is None and proc.terminate()))
+        try:
+            yield on_process
+        finally:
+            for handle in handles:
+                self.remove_cancel(handle)
+
+    def cancel(self):
+        '''Cancels the pipeline: no further stages start and running stages
+        get their cancel callbacks called'''
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+            self._changed.notify_all()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception, err:
+                print >> sys.stderr, 'Cancel callback failed: %s' % err
+
+    def check_cancelled(self):
+        '''Raises Cancelled if the pipeline was cancelled'''
+        if self.cancelled.is_set():
+            raise Cancelled('Cancelled')
+
+    def _run_stage(self, stage):
+        print 'Stage %s started' % stage.name
+        result = error = None
+        try:
+            with instrument.span('stage.' + stage.name):
+                result = stage.func(self)
+        except Exception, err:
+            error = err
+            print >> sys.stderr, 'Stage %s failed: %s' % (stage.name, err)
+        with self._lock:
+            stage.finished = time.time()
+            stage.error = error
+            if error is None:
+                self.results[stage.name] = result
+            self._changed.notify_all()
+        if error is None:
+            print 'Stage %s finished in %.1fs' % (stage.name, stage.duration)
+        else:
+            self.cancel()
+
+    def run(self):
+        '''Runs all stages. Returns the results dict or raises StageError for
+        the stage that failed first.'''
+        pending = list(self.stages)
+        running = []
+        with self._lock:
+            while pending or running:
+                running = [stage for stage in running if stage.finished is None]
+                if not self.cancelled.is_set():
+                    for stage in list(pending):
+                        if all(dep in self.results for dep in stage.deps):
+                            pending.remove(stage)
+                            running.append(stage)
+                            stage.started = time.time()
+                            thread = threading.Thread(
+                                target=self._run_stage, args=(stage,))
+                            thread.daemon = True
+                            thread.start()
+                elif not running:
+                    break
+                if running:
+                    # wait with a timeout so the calling thread stays
+                    # interruptible
+                    self._changed.wait(1.0)
+        failed = [stage for stage in self.stages if stage.error is not None]
+        if failed:
+            first = min(failed, key=lambda stage: stage.finished)
+            raise StageError(first.name, first.error)
+        if self.cancelled.is_set():
+            raise StageError(None, Cancelled('Cancelled'))
+        return self.results
+
+    def timings(self):
+        '''Returns a list of (stage name, seconds) for the stages that ran'''
+        return [(stage.name, stage.duration) for stage in self.stages
+                if stage.duration is not None]
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+#  progress.py
+#  OSReinstaller
+#
+#  Progress event bus. Worker threads publish progress as often as they like;
+#  publishing only stores the latest values. A ticker thread hands a
+#  coalesced snapshot to the UI at a fixed frame rate, together with a
+#  smoothed throughput and ETA for byte counts.
+#
+
+import time
+import threading
+
+
+DEFAULT_FPS = 10
+# weight of the newest sample in the throughput moving average
+SMOOTHING = 0.3
+
+
+def format_bytes(count):
+    '''Returns count as a short human readable string'''
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if abs(count) < 1024.0 or unit == 'GB':
+            if unit == 'bytes':
+                return '%d %s' % (count, unit)
+            return '%.1f %s' % (count, unit)
+        count /= 1024.0
+
+
+def format_duration(seconds):
+    '''Returns seconds as a short human readable string'''
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%d s' % seconds
+    if seconds < 3600:
+        return '%d min' % ((seconds + 30) // 60)
+    return '%d h %d min' % (seconds // 3600, (seconds % 3600) // 60)
+
+
+class Progress(object):
+    '''Progress callback interface of the core modules. This base class
+    ignores all updates, so it can be passed where nobody is watching.'''
+
+    def set_info(self, text):
+        pass
+
+    def set_detail(self, text):
+        pass
+
+    def set_percent(self, percent):
+        pass
+
+    def set_bytes(self, bytes_done, bytes_total):
+        pass
+
+
+NULL_PROGRESS = Progress()
+
+
+class ProgressBus(Progress):
+    '''Coalesces progress updates from worker threads.
+
+    deliver is called from the ticker thread with a snapshot dict holding
+    the keys that changed since the last frame: 'info', 'detail', 'percent',
+    and for byte progress also 'bytes_done', 'bytes_total', 'rate' (bytes
+    per second) and 'eta' (seconds, or None).'''
+
+    def __init__(self, deliver, fps=DEFAULT_FPS, smoothing=SMOOTHING):
+        self.deliver = deliver
+        self.interval = 1.0 / fps
+        self.smoothing = smoothing
+        self._values = {}
+        self._delivered = {}
+        self._dirty = False
+        self._stopped = threading.Event()
+        self._thread = None
+        self._rate = None
+        self._last_bytes = None
+        self._last_time = None
+
+    # publishing only stores values; a dict item assignment is atomic under
+    # the GIL, so no lock is needed on this hot path
+
+    def set_info(self, text):
+        self._values['info'] = text
+        self._dirty = True
+
+    def set_detail(self, text):
+        self._values['detail'] = text
+        self._dirty = True
+
+    def set_percent(self, percent):
+        self._values['percent'] = percent
+        self._dirty = True
+
+    def set_bytes(self, bytes_done, bytes_total):
+        '''Publishes byte progress; usable directly as the download engine's
+        progress callback'''
+        self._values['bytes'] = (bytes_done, bytes_total)
+        self._dirty = True
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        '''Stops the ticker after delivering the last frame'''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        '''Delivers a snapshot if anything changed since the last frame'''
+        if not self._dirty:
+            return
+        self._dirty = False
+        # values are never removed, so an update racing with this copy is
+        # picked up by the next frame at the latest
+        current = dict(self._values)
+        values = dict((key, value) for key, value in current.items()
+                      if self._delivered.get(key) != value)
+        self._delivered = current
+        snapshot = {}
+        for key in ('info', 'detail', 'percent'):
+            if key in values:
+                snapshot[key] = values[key]
+        if 'bytes' in values:
+            bytes_done, bytes_total = values['bytes']
+            snapshot.update(self._byte_progress(bytes_done, bytes_total))
+        if snapshot:
+            self.deliver(snapshot)
+
+    def _byte_progress(self, bytes_done, bytes_total):
+        now = time.time()
+        if self._last_time is not None and bytes_done >= self._last_bytes:
+            elapsed = now - self._last_time
+            if elapsed > 0:
+                sample = (bytes_done - self._last_bytes) / elapsed
+                if self._rate is None:
+                    self._rate = sample
+                else:
+                    self._rate += self.smoothing * (sample - self._rate)
+        else:
+            # first sample or a new transfer
+            self._rate = None
+        self._last_bytes = bytes_done
+        self._last_time = now
+        eta = None
+        if self._rate and bytes_total:
+            eta = max(bytes_total - bytes_done, 0) / self._rate
+        progress = {
+            'bytes_done': bytes_done,
+            'bytes_total': bytes_total,
+            'rate': self._rate or 0.0,
+            'eta': eta,
+        }
+        if bytes_total:
+            progress['percent'] = bytes_done * 100.0 / bytes_total
+        return progress
+
+
+def describe_byte_progress(snapshot):
+    '''Returns a line like "1.2 GB of 5.8 GB, 42.0 MB/s, 2 min left"'''
+    text = format_bytes(snapshot['bytes_done'])
+    if snapshot.get('bytes_total'):
+        text += ' of %s' % format_bytes(snapshot['bytes_total'])
+    if snapshot.get('rate'):
+        text += ', %s/s' % format_bytes(snapshot['rate'])
+    if snapshot.get('eta') is not None:
+        text += ', %s left' % format_duration(snapshot['eta'])
+    return text
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+#  shaping.py
+#  OSReinstaller
+#
+#  Bandwidth shaping for downloads, so reimaging a room full of machines
+#  doesn't saturate the uplink. Bulk package transfers draw from token
+#  buckets, one for the whole run and one per host, whose rates can follow
+#  a time-of-day schedule. Metadata fetches - the catalog, ServerMetadata
+#  and dist files - count against the buckets but never wait for them, so
+#  they stay fast while bulk transfers are capped.
+#
+
+import re
+import time
+import threading
+import urlparse
+
+
+# download priorities, lower first
+METADATA = 0
+BULK = 1
+
+# a bucket holds this many seconds of its rate, but at least MIN_BURST
+# bytes so a whole read block fits
+BURST_SECONDS = 1.0
+MIN_BURST = 256 * 1024
+
+RATE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([kmg]?)(?:b|b/s|bps)?$', re.I)
+RANGE_RE = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$')
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(text):
+    '''Returns bytes per second for a rate like 500K, 2.5M or 1G, None for
+    0, none or unlimited. Raises ValueError.'''
+    text = text.strip()
+    if text.lower() in ('', '0', 'none', 'unlimited'):
+        return None
+    match = RATE_RE.match(text)
+    if not match:
+        raise ValueError('Invalid rate %r, expected e.g. 500K or 2M' % text)
+    rate = int(float(match.group(1)) * UNITS[match.group(2).lower()])
+    return rate or None
+
+
+def format_rate(rate):
+    if rate is None:
+        return 'unlimited'
+    for unit in ('G', 'M', 'K'):
+        if rate >= UNITS[unit.lower()]:
+            return '%.1f %sB/s' % (float(rate) / UNITS[unit.lower()], unit)
+    return '%d B/s' % rate
+
+
+class Schedule(object):
+    '''A rate that depends on the time of day. ranges is a list of
+    (start minute, end minute, rate); a range may wrap past midnight. The
+    first range containing the time wins, default applies outside all of
+    them. Rates are bytes per second, None for unlimited.'''
+
+    def __init__(self, default=None, ranges=()):
+        self.default = default
+        self.ranges = list(ranges)
+
+    @classmethod
+    def parse(cls, spec):
+        '''Parses a comma separated list of RATE and HH:MM-HH:MM=RATE
+        entries, e.g. "08:00-17:00=2M,20M" for 2 MB/s during school hours
+        and 20 MB/s otherwise. Raises ValueError.'''
+        default = None
+        ranges = []
+        for entry in spec.split(','):
+            entry = entry.strip()
+            if '=' not in entry:
+                default = parse_rate(entry)
+                continue
+            period, rate = entry.split('=', 1)
+            match = RANGE_RE.match(period.strip())
+            if not match:
+                raise ValueError('Invalid time range %r, expected e.g. '
+                                 '08:00-17:00' % period)
+            start_hour, start_min, end_hour, end_min = [
+                int(group) for group in match.groups()]
+            if start_hour > 23 or end_hour > 24 or max(start_min, end_min) > 59:
+                raise ValueError('Invalid time range %r' % period)
+            ranges.append((start_hour * 60 + start_min,
+                           end_hour * 60 + end_min, parse_rate(rate)))
+        return cls(default, ranges)
+
+    def rate_at(self, when=None):
+        '''Returns the rate at the local time when, default now'''
+        now = time.localtime(when)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.ranges:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default
+
+    def describe(self):
+        parts = ['%02d:%02d-%02d:%02d %s' % (
+            start // 60, start % 60, end // 60, end % 60, format_rate(rate))
+                 for start, end, rate in self.ranges]
+        if self.default is not None or not parts:
+            parts.append(('otherwise %s' if parts else '%s')
+                         % format_rate(self.default))
+        return ', '.join(parts)
+
+
+class TokenBucket(object):
+    '''A token bucket of rate bytes per second. Bytes are reserved up
+    front; the bucket may go into debt, and reserve() returns how long the
+    caller has to wait before the bytes it reserved are covered.'''
+
+    def __init__(self, rate=None, clock=time.time):
+        self.clock = clock
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = clock()
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    @property
+    def burst(self):
+        return max(self.rate * BURST_SECONDS, MIN_BURST)
+
+    def set_rate(self, rate):
+        with self._lock:
+            if rate == self.rate:
+                return
+            self._refill()
+            unlimited = self.rate is None
+            self.rate = rate
+            if rate is not None:
+                # a bucket that just got a rate starts full
+                self.tokens = (self.burst if unlimited
+                               else min(self.tokens, self.burst))
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                              self.burst)
+        self.updated = now
+
+    def reserve(self, count, wait=True):
+        '''Takes count bytes from the bucket and returns the seconds to wait
+        for them. With wait=False the bytes are taken without waiting, which
+        delays later reservations instead.'''
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            self.tokens -= count
+            if not wait or self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Shaper(object):
+    '''Shapes downloads with a run-wide Schedule and per-host Schedules.
+    Buckets follow their schedule whenever bytes are reserved.'''
+
+    def __init__(self, limit=None, host_limits=None, clock=time.time):
+        self.limit = limit
+        self.host_limits = dict(host_limits or {})
+        self.clock = clock
+        self._run_bucket = TokenBucket(clock=clock)
+        self._host_buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_specs(cls, limit=None, host_limits=None):
+        '''Returns a Shaper for a schedule spec and a dict of host name to
+        schedule spec, see Schedule.parse. Raises ValueError.'''
+        return cls(Schedule.parse(limit) if limit else None,
+                   dict((host.lower(), Schedule.parse(spec))
+                        for host, spec in (host_limits or {}).items()))
+
+    @property
+    def enabled(self):
+        return self.limit is not None or bool(self.host_limits)
+
+    def limited(self, url):
+        '''True if transfers from url are currently capped'''
+        return any(bucket.rate is not None
+                   for bucket in self._buckets(url))
+
+    def _buckets(self, url):
+        now = self.clock()
+        buckets = []
+        if self.limit is not None:
+            self._run_bucket.set_rate(self.limit.rate_at(now))
+            buckets.append(self._run_bucket)
+        host = (urlparse.urlsplit(url).hostname or '').lower()
+        schedule = self.host_limits.get(host)
+        if schedule is not None:
+            with self._lock:
+                bucket = self._host_buckets.get(host)
+                if bucket is None:
+                    bucket = self._host_buckets[host] = TokenBucket(
+                        clock=self.clock)
+            bucket.set_rate(schedule.rate_at(now))
+            buckets.append(bucket)
+        return buckets
+
+    def reserve(self, url, count, priority=BULK):
+        '''Accounts count bytes received from url. Returns the seconds a
+        bulk transfer has to wait; metadata never waits.'''
+        if not self.enabled:
+            return 0.0
+        delays = [bucket.reserve(count, wait=priority != METADATA)
+                  for bucket in self._buckets(url)]
+        return max(delays or [0.0])
+
+    def describe(self):
+        parts = []
+        if self.limit is not None:
+            parts.append('run %s' % self.limit.describe())
+        for host in sorted(self.host_limits):
+            parts.append('%s %s' % (host, self.host_limits[host].describe()))
+        return '; '.join(parts) or 'unlimited'
+
+
+_shared_shaper = Shaper()
+
+
+def configure(shaper):
+    '''Sets the Shaper used by all downloads'''
+    global _shared_shaper
+    _shared_shaper = shaper or Shaper()
+
+
+def shared_shaper():
+    return _shared_shaper
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+#  storage.py
+#  OSReinstaller
+#
+#  Storage planning. Before anything is downloaded, the packages' catalog
+#  sizes and the install size declared by the dist file tell how much the
+#  downloads, the sparse image and the cached built installer will need.
+#  The sparse image is sized to fit the product, and the plan fails early
+#  when no candidate volume has the room.
+#
+
+import os
+
+from fetch import local_path_for_url
+from progress import format_bytes
+
+
+MB = 1024 * 1024
+GB = 1024 * MB
+# room in the sparse image on top of the declared install size
+IMAGE_MARGIN = 0.15
+IMAGE_SLACK = 512 * MB
+# used when neither the dist file nor the catalog tell the product's size
+DEFAULT_INSTALL_SIZE = 8 * GB
+# never plan to fill a volume completely
+RESERVE = 1 * GB
+
+
+class StorageError(Exception):
+    '''A custom error when there is not enough space for a product'''
+    pass
+
+
+def existing_parent(path):
+    '''Returns path or its nearest existing parent directory'''
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def free_bytes(path):
+    '''Returns the space available to us on the volume path is on'''
+    stat = os.statvfs(existing_parent(path))
+    return stat.f_bavail * stat.f_frsize
+
+
+def volume_of(path):
+    return os.stat(existing_parent(path)).st_dev
+
+
+def allocated_bytes(path):
+    '''Returns the space a file already takes on disk, 0 if it is missing'''
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+class StoragePlan(object):
+    '''Where a product's downloads and sparse image go and the space they
+    need'''
+
+    def __init__(self, workdir, image_dir, download_bytes, pending_bytes,
+                 install_bytes, image_size, artifact_bytes):
+        self.workdir = workdir
+        self.image_dir = image_dir
+        # catalog size of all packages, and the part not on disk yet
+        self.download_bytes = download_bytes
+        self.pending_bytes = pending_bytes
+        self.install_bytes = install_bytes
+        self.image_size = image_size
+        self.artifact_bytes = artifact_bytes
+
+    def image_size_arg(self):
+        '''The sparse image size in hdiutil's -size syntax'''
+        return '%dm' % ((self.image_size + MB - 1) // MB)
+
+    def describe(self):
+        return ('downloads %s (%s to go), installed %s, sparse image %s in %s'
+                % (format_bytes(self.download_bytes),
+                   format_bytes(self.pending_bytes),
+                   format_bytes(self.install_bytes),
+                   format_bytes(self.image_size), self.image_dir))
+
+
+def plan_storage(packages, install_kbytes, workdir, image_dirs=None,
+                 keep_artifact=False):
+    '''Returns a StoragePlan for the catalog package dicts of a product.
+    install_kbytes is the size declared by its dist file, 0 if unknown. The
+    sparse image goes to the first of image_dirs (default: workdir) with
+    room for it. Raises StorageError if there is none.'''
+    download_bytes = 0
+    pending_bytes = 0
+    for package in packages:
+        size = package.get('Size') or 0
+        if 'URL' not in package or not size:
+            continue
+        download_bytes += size
+        local_path = local_path_for_url(package['URL'], workdir)
+        pending_bytes += max(size - allocated_bytes(local_path), 0)
+
+    # Install macOS.app carries the downloaded payload, so the downloads
+    # are a fair guess when the dist file doesn't declare a size
+    install_bytes = (install_kbytes * 1024 or download_bytes or
+                     DEFAULT_INSTALL_SIZE)
+    image_size = int(install_bytes * (1 + IMAGE_MARGIN)) + IMAGE_SLACK
+    # the compressed image of the app is about as big as the app
+    artifact_bytes = install_bytes if keep_artifact else 0
+
+    # the sparse image only grows to what is installed to it
+    workdir_needs = pending_bytes + artifact_bytes
+    workdir_free = free_bytes(workdir) - RESERVE
+    if workdir_needs > workdir_free:
+        raise StorageError(
+            'Not enough space in %s: %s needed, %s available'
+            % (workdir, format_bytes(workdir_needs),
+               format_bytes(max(workdir_free, 0))))
+    candidates = []
+    for image_dir in image_dirs or [workdir]:
+        needs = install_bytes
+        available = free_bytes(image_dir) - RESERVE
+        if volume_of(image_dir) == volume_of(workdir):
+            needs += workdir_needs
+        if needs <= available:
+            return StoragePlan(workdir, image_dir, download_bytes,
+                               pending_bytes, install_bytes, image_size,
+                               artifact_bytes)
+        candidates.append('%s (%s needed, %s available)'
+                          % (image_dir, format_bytes(needs),
+                             format_bytes(max(available, 0))))
+    raise StorageError('Not enough space for the sparse image: %s'
+                       % ', '.join(candidates))
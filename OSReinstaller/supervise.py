@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+#  supervise.py
+#  OSReinstaller
+#
+#  Supervision of child processes with bounded memory. The output of
+#  installer and startosinstall goes to an OutputLog: the last lines are
+#  kept in a fixed-size ring buffer for error messages, everything is
+#  written to a log file that is rotated at a fixed size. Helper processes
+#  like caffeinate are tracked, so they are stopped and reaped when we
+#  are done with them or exit.
+#
+
+import os
+import sys
+import time
+import atexit
+import threading
+import subprocess
+
+from collections import deque
+
+
+# lines kept in memory for error reporting
+TAIL_LINES = 200
+# a log file is rotated once it is larger than this, keeping LOG_BACKUPS
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+# seconds a helper gets to exit after SIGTERM before it is killed
+HELPER_STOP_TIMEOUT = 5
+
+
+def rotate(path, backups=LOG_BACKUPS):
+    '''Renames path to path.1, path.1 to path.2 and so on, dropping the
+    oldest of backups'''
+    for idx in range(backups - 1, 0, -1):
+        older = '%s.%d' % (path, idx)
+        if os.path.exists(older):
+            os.rename(older, '%s.%d' % (path, idx + 1))
+    if os.path.exists(path):
+        if backups:
+            os.rename(path, path + '.1')
+        else:
+            os.remove(path)
+
+
+class OutputLog(object):
+    '''The output of a process. The last lines are kept in memory; with
+    log_path, all lines are also appended to that file, which is rotated
+    once it grows beyond max_bytes. Memory use doesn't depend on how much
+    the process writes.'''
+
+    def __init__(self, log_path=None, lines=TAIL_LINES,
+                 max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.count = 0
+        self._lines = deque(maxlen=lines)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        if log_path:
+            self._open()
+
+    def _open(self):
+        try:
+            parent = os.path.dirname(self.log_path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            self._file = open(self.log_path, 'ab')
+            self._size = self._file.tell()
+        except (OSError, IOError), err:
+            # the tail in memory is still there for error messages
+            print >> sys.stderr, 'Could not open %s: %s' % (self.log_path, err)
+            self.log_path = None
+            self._file = None
+
+    def _spill(self, data):
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._file.close()
+            try:
+                rotate(self.log_path, self.backups)
+            except OSError, err:
+                print >> sys.stderr, 'Could not rotate %s: %s' % (
+                    self.log_path, err)
+            self._open()
+            if self._file is None:
+                return
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def append(self, line):
+        '''Adds a line of output'''
+        with self._lock:
+            self._lines.append(line)
+            self.count += 1
+            if self._file is not None:
+                if isinstance(line, unicode):
+                    line = line.encode('utf-8')
+                self._spill(line + '\n')
+
+    def mark(self, text):
+        '''Writes a timestamped separator to the log file only, e.g. before
+        the output of a new run'''
+        with self._lock:
+            if self._file is not None:
+                self._spill('--- %s %s ---\n' % (
+                    time.strftime('%Y-%m-%d %H:%M:%S'), text))
+
+    def tail(self, count=None):
+        '''Returns the last count lines kept in memory, all if None'''
+        with self._lock:
+            lines = list(self._lines)
+        if count is not None:
+            lines = lines[-count:] if count else []
+        return lines
+
+    def describe(self):
+        '''Returns the tail as text for error reports, noting how many lines
+        were dropped and where to find them'''
+        lines = self.tail()
+        dropped = self.count - len(lines)
+        if dropped > 0:
+            note = u'[%d earlier lines' % dropped
+            if self.log_path:
+                note += u' in %s' % self.log_path
+            lines.insert(0, note + u']')
+        return u'\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, dummy_type, dummy_value, dummy_traceback):
+        self.close()
+
+
+_helpers = []
+_helpers_lock = threading.Lock()
+
+
+def start_helper(cmd, **kwargs):
+    '''Starts a helper process that runs alongside the workflow, like
+    caffeinate. It is stopped with stop_helper or when Python exits.
+    Returns the process.'''
+    proc = subprocess.Popen(cmd, **kwargs)
+    with _helpers_lock:
+        # reap helpers that exited on their own
+        _helpers[:] = [helper for helper in _helpers if helper.poll() is None]
+        _helpers.append(proc)
+    return proc
+
+
+def stop_helper(proc, timeout=HELPER_STOP_TIMEOUT):
+    '''Terminates a helper, kills it if it doesn't exit within timeout and
+    waits for it'''
+    with _helpers_lock:
+        if proc in _helpers:
+            _helpers.remove(proc)
+    if proc.poll() is not None:
+        return
+    try:
+        proc.terminate()
+    except OSError:
+        # exited in the meantime
+        pass
+    deadline = time.time() + timeout
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+
+
+def stop_helpers():
+    '''Stops all running helpers'''
+    with _helpers_lock:
+        helpers = list(_helpers)
+    for proc in helpers:
+        stop_helper(proc)
+
+
+atexit.register(stop_helpers)
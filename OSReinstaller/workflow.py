@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+#  workflow.py
+#  OSReinstaller
+#
+#  The reinstall workflow without any UI: pick the newest macOS installer
+#  from the catalog, download it, build Install macOS.app in a sparse image
+#  and run startosinstall --eraseinstall from it. Progress is reported
+#  through a progress.Progress; the app and the command line tool only
+#  differ in what they do with it.
+#
+
+import os
+import sys
+import socket
+
+import artifacts
+import catalog
+import connpool
+import fetch
+import imaging
+import install
+import instrument
+import mirrors
+import peercache
+import shaping
+import storage
+import supervise
+from install import InstallError
+from pipeline import Pipeline, StageError
+from progress import NULL_PROGRESS
+
+
+DEFAULT_SUCATALOG = (
+    'https://reposado.srgssr.ch/content/catalogs/others/'
+    'index-10.13-10.12-10.11-10.10-10.9'
+    '-mountainlion-lion-snowleopard-leopard.merged-1_3_Fast.sucatalog')
+DEFAULT_WORKDIR = '/tmp/OSReinstaller'
+
+_caffeinate = None
+
+
+def prevent_sleep():
+    '''Starts caffeinate to keep the system from sleeping, unless it runs
+    already, and returns its process. caffeinate exits with this process.'''
+    global _caffeinate
+    if _caffeinate is None or _caffeinate.poll() is not None:
+        print('Running \'caffeinate\' on MacOSX to prevent the system from sleeping')
+        _caffeinate = supervise.start_helper(
+            ['caffeinate', '-d', '-i', '-w', str(os.getpid())])
+    return _caffeinate
+
+
+def allow_sleep():
+    '''Stops and reaps the caffeinate started by prevent_sleep'''
+    global _caffeinate
+    if _caffeinate is not None:
+        supervise.stop_helper(_caffeinate)
+        _caffeinate = None
+
+
+class Reinstaller(object):
+    '''Runs the reinstall workflow as a pipeline of stages.
+
+    on_product is called with the product_info entry of the selected
+    installer. With reinstall=False the workflow stops once the installer
+    has been built in the sparse image. Packages are fetched from the peer
+    caches at the base URLs in peers before the origin; with share_port the
+    workdir is served to peers on that port while the workflow runs.
+    mirror_groups lists groups of equivalent base URLs the catalog and
+    packages can be fetched from. With artifact_cache, built installers are
+    kept and reused for later runs of the same build. The sparse image goes
+    to the first of image_dirs (default: workdir) with room for it. A JSON
+    report and a Prometheus textfile of every run are written to report_dir
+    (default: workdir). The output of installer and startosinstall is
+    logged to the logs directory of workdir. Package downloads are capped
+    by bandwidth_limit for the whole run and by host_limits, a dict of host
+    name to limit; see shaping.Schedule.parse for the format. Raises
+    ValueError for an invalid limit.'''
+
+    def __init__(self, sucatalog=DEFAULT_SUCATALOG, workdir=DEFAULT_WORKDIR,
+                 build=None, ignore_cache=False, progress=NULL_PROGRESS,
+                 on_product=None, reinstall=True, peers=None,
+                 share_port=None, mirror_groups=None, artifact_cache=True,
+                 image_dirs=None, report_dir=None, bandwidth_limit=None,
+                 host_limits=None):
+        self.sucatalog = sucatalog
+        self.workdir = workdir
+        self.build = build
+        self.ignore_cache = ignore_cache
+        self.progress = progress
+        self.on_product = on_product
+        self.reinstall = reinstall
+        self.peers = list(peers or [])
+        self.share_port = share_port
+        self.mirror_groups = list(mirror_groups or [])
+        self.shaper = shaping.Shaper.from_specs(bandwidth_limit, host_limits)
+        self.artifacts = None
+        if artifact_cache:
+            self.artifacts = artifacts.ArtifactCache(
+                os.path.join(workdir, 'artifacts'))
+        self.image_dirs = list(image_dirs or [])
+        self.report_dir = report_dir or workdir
+        self.pipeline = None
+
+    def installers(self):
+        '''Returns the product_info of all macOS installers in the catalog'''
+        mirrors.configure(self.mirror_groups)
+        shaping.configure(self.shaper)
+        index = catalog.ProductIndex(self.workdir)
+        sucatalog = catalog.download_and_parse_sucatalog(
+            self.sucatalog, self.workdir, self.ignore_cache, index)
+        return catalog.os_installer_product_info(
+            sucatalog, self.workdir, self.ignore_cache, index, self.progress)
+
+    # each stage gets the pipeline and reads the results of the stages it
+    # depends on from pipeline.results
+
+    def load_catalog(self, pipeline):
+        index = catalog.ProductIndex(self.workdir)
+        sucatalog = catalog.download_and_parse_sucatalog(
+            self.sucatalog, self.workdir, self.ignore_cache, index)
+        return sucatalog, index
+
+    def choose_installer(self, pipeline):
+        sucatalog, index = pipeline.results['catalog']
+        product_id, product_info = catalog.select_installer(
+            sucatalog, self.workdir, self.build, self.ignore_cache, index,
+            self.progress)
+        if not product_id:
+            raise InstallError('No macOS installer found.')
+        item = product_info[product_id]
+        if self.on_product:
+            self.on_product(item)
+        return product_id, item
+
+    def cached_installer(self, pipeline):
+        '''Mounts the cached image of the selected installer, if there is
+        one, and returns its mountpoint'''
+        if self.artifacts is None:
+            return None
+        product_id, item = pipeline.results['installer']
+        path = self.artifacts.lookup(artifacts.artifact_key(product_id, item))
+        if path is None:
+            return None
+        print 'Using built installer %s' % path
+        mountpoint = imaging.mountdmg(path)
+        if not mountpoint:
+            # build it again instead
+            print >> sys.stderr, 'Could not mount %s' % path
+        return mountpoint
+
+    def analyze_dist(self, pipeline):
+        '''Returns the catalog.DistInfo of the selected installer'''
+        if pipeline.results['artifact']:
+            return None
+        item = pipeline.results['installer'][1]
+        return catalog.analyze_dist(item['DistributionPath'])
+
+    def plan_storage(self, pipeline):
+        '''Checks there is room for the product before anything is
+        downloaded and returns the storage.StoragePlan'''
+        dist_info = pipeline.results['dist']
+        if dist_info is None:
+            return None
+        sucatalog = pipeline.results['catalog'][0]
+        product_id = pipeline.results['installer'][0]
+        packages = sucatalog['Products'][product_id].get('Packages', [])
+        install_kbytes = dist_info.total_install_kbytes(packages)
+        plan = storage.plan_storage(
+            packages, install_kbytes, self.workdir, self.image_dirs,
+            keep_artifact=self.artifacts is not None)
+        print 'Storage: %s' % plan.describe()
+        return plan
+
+    def download(self, pipeline):
+        if pipeline.results['artifact']:
+            return
+        sucatalog = pipeline.results['catalog'][0]
+        product_id = pipeline.results['installer'][0]
+        packages = catalog.order_packages(
+            sucatalog['Products'][product_id].get('Packages', []),
+            pipeline.results['dist'])
+        self.progress.set_info("Downloading %i packages" % len(packages))
+        self.progress.set_detail("")
+        fetch.replicate_packages(packages, root_dir=self.workdir,
+                                 ignore_cache=self.ignore_cache,
+                                 progress=self.progress.set_bytes,
+                                 cancel_event=pipeline.cancelled,
+                                 peers=self.peers)
+        print 'Network: %s' % connpool.format_stats(connpool.shared_pool().stats)
+
+    def sparse_image(self, pipeline):
+        plan = pipeline.results['plan']
+        if plan is None:
+            return None
+        item = pipeline.results['installer'][1]
+        # generate a name for the sparseimage
+        volname = ('Install_macOS_%s-%s' % (item['version'], item['BUILD']))
+        if not os.path.isdir(plan.image_dir):
+            os.makedirs(plan.image_dir)
+        sparse_diskimage_path = os.path.join(
+            plan.image_dir, volname + '.sparseimage')
+        if os.path.exists(sparse_diskimage_path):
+            os.unlink(sparse_diskimage_path)
+        print 'Making empty sparseimage...'
+        return imaging.make_sparse_image(volname, sparse_diskimage_path,
+                                         size=plan.image_size_arg())
+
+    def mount(self, pipeline):
+        sparse_diskimage_path = pipeline.results['sparseimage']
+        if sparse_diskimage_path is None:
+            return None
+        print 'Mount sparseimage...'
+        mountpoint = imaging.mountdmg(sparse_diskimage_path)
+        if not mountpoint:
+            raise InstallError('Could not mount %s' % sparse_diskimage_path)
+        return mountpoint
+
+    def build_installer(self, pipeline):
+        '''Returns the path to Install macOS.app, built from the product or
+        taken from the artifact cache'''
+        if pipeline.results['artifact']:
+            return install.find_install_macos_app(pipeline.results['artifact'])
+        product_id, item = pipeline.results['installer']
+        mountpoint = pipeline.results['mount']
+        # install the product to the mounted sparseimage volume
+        self.progress.set_percent(0)
+        self.progress.set_info('Install the product to the mounted sparseimage...')
+        self.progress.set_detail("")
+        with pipeline.terminating() as on_process, \
+                self.output_log('installer') as log:
+            success = install.install_product(
+                item['DistributionPath'], mountpoint, self.progress,
+                on_process=on_process, log=log)
+        if not success:
+            raise InstallError('Product installation failed: %s'
+                               % self.last_line(log))
+        msg = ('Product downloaded and installed to %s'
+               % pipeline.results['sparseimage'])
+        print msg
+        self.progress.set_info(msg)
+        self.progress.set_detail("")
+        macos_app = install.find_install_macos_app(
+            os.path.join(mountpoint, "Applications"))
+        if macos_app and self.artifacts is not None:
+            self.progress.set_info('Keeping the built installer for later runs...')
+            try:
+                self.artifacts.store(
+                    artifacts.artifact_key(product_id, item), macos_app)
+            except (imaging.ImagingError, OSError), err:
+                # the reinstall doesn't need the cached copy
+                print >> sys.stderr, 'Could not cache %s: %s' % (macos_app, err)
+        return macos_app
+
+    def reinstall_os(self, pipeline):
+        macos_app = pipeline.results['install']
+        print 'Start os reinstall'
+        if not macos_app:
+            raise InstallError('startosinstall not found!')
+        startosinstall_path = os.path.join(
+            macos_app, 'Contents/Resources/startosinstall')
+        with pipeline.terminating() as on_process, \
+                self.output_log('startosinstall') as log:
+            success = install.reinstall_os(
+                startosinstall_path, macos_app, self.progress,
+                on_process=on_process, log=log)
+        if not success:
+            raise InstallError('startosinstall failed: %s'
+                               % self.last_line(log))
+
+    def output_log(self, name):
+        '''Returns the OutputLog for a tool run by the workflow'''
+        return supervise.OutputLog(
+            os.path.join(self.workdir, 'logs', name + '.log'))
+
+    def last_line(self, log):
+        '''Returns the last line a failed tool wrote, and where to find the
+        rest'''
+        lines = log.tail(1)
+        # error messages are byte strings
+        text = lines[0].encode('utf-8') if lines else 'no output'
+        if log.log_path:
+            text += ' (see %s)' % log.log_path
+        return text
+
+    def make_pipeline(self):
+        # sparse image creation and mounting don't depend on the downloads
+        pipeline = Pipeline()
+        pipeline.add('catalog', self.load_catalog)
+        pipeline.add('installer', self.choose_installer, deps=('catalog',))
+        pipeline.add('artifact', self.cached_installer, deps=('installer',))
+        pipeline.add('dist', self.analyze_dist, deps=('artifact',))
+        pipeline.add('plan', self.plan_storage, deps=('dist',))
+        pipeline.add('download', self.download, deps=('plan',))
+        pipeline.add('sparseimage', self.sparse_image, deps=('plan',))
+        pipeline.add('mount', self.mount, deps=('sparseimage',))
+        pipeline.add('install', self.build_installer, deps=('download', 'mount'))
+        if self.reinstall:
+            pipeline.add('reinstall', self.reinstall_os, deps=('install',))
+        return pipeline
+
+    def run(self):
+        '''Runs the workflow. Returns the pipeline results or raises
+        StageError for the stage that failed first.'''
+        connpool.shared_pool().reset_stats()
+        instrument.shared_recorder().reset()
+        mirrors.configure(self.mirror_groups)
+        shaping.configure(self.shaper)
+        if self.shaper.enabled:
+            print 'Bandwidth: %s' % self.shaper.describe()
+        self.pipeline = pipeline = self.make_pipeline()
+        server = None
+        if self.share_port:
+            try:
+                server = self.share(self.share_port)
+            except socket.error, err:
+                # sharing is optional, the reinstall works without it
+                print >> sys.stderr, 'Could not share %s: %s' % (self.workdir, err)
+        error = 'Interrupted'
+        try:
+            results = pipeline.run()
+            error = None
+            return results
+        except StageError, err:
+            error = err
+            print >> sys.stderr, 'Stage %s failed: %s' % (err.stage, err)
+            for stage in ('mount', 'artifact'):
+                if pipeline.results.get(stage):
+                    imaging.unmountdmg(pipeline.results[stage])
+            raise
+        finally:
+            if server is not None:
+                server.stop()
+            if self.artifacts is not None:
+                print 'Artifact cache: %s' % artifacts.format_stats(
+                    self.artifacts.stats())
+            for name, seconds in pipeline.timings():
+                print 'Stage %s took %.1fs' % (name, seconds)
+            self.write_report(error)
+
+    def write_report(self, error=None):
+        '''Exports the spans of the last run to report_dir'''
+        report = instrument.shared_recorder().report(error is None, error)
+        try:
+            paths = instrument.export(report, self.report_dir)
+        except (OSError, IOError), err:
+            print >> sys.stderr, 'Could not write the run report: %s' % err
+            return
+        print 'Run report written to %s' % ', '.join(paths)
+
+    def share(self, port=peercache.DEFAULT_PORT):
+        '''Starts serving the workdir to peers and returns the server'''
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        server = peercache.PeerCacheServer(self.workdir, port)
+        server.start()
+        return server
+
+    def cancel(self):
+        '''Cancels a running workflow'''
+        if self.pipeline:
+            self.pipeline.cancel()
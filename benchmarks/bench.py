@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+#
+#  bench.py
+#  OSReinstaller benchmarks
+#
+#  End-to-end benchmark of the reinstall workflow that runs anywhere,
+#  Linux included. A synthetic catalog with its ServerMetadata, dist and
+#  package files is served on localhost, hdiutil, installer and
+#  startosinstall are replaced by the scripted stubs in stubs/, and the
+#  whole workflow is run a number of times, reporting per-stage and
+#  per-step timings:
+#
+#    python benchmarks/bench.py --runs 3 --package-size 256
+#    python benchmarks/bench.py --json new.json --baseline old.json
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import datetime
+import plistlib
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import connpool
+import imaging
+import install
+import instrument
+import peercache
+import workflow
+from pipeline import StageError
+
+
+MB = 1024 * 1024
+OSINSTALL_IDENTIFIER = 'com.apple.mpkg.OSInstall'
+# stage or step medians slower than the baseline by less than this many
+# seconds are noise, whatever the ratio
+MIN_REGRESSION = 0.05
+
+
+def write_package(path, size):
+    '''Writes size bytes of incompressible data to path and returns their
+    SHA-1'''
+    hasher = hashlib.sha1()
+    block = hashlib.sha512(path).digest() * (MB // 64)
+    with open(path, 'wb') as fileobj:
+        remaining = size
+        while remaining > 0:
+            data = block[:min(remaining, len(block))]
+            fileobj.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+            block = block[1:] + block[:1]
+    return hasher.hexdigest()
+
+
+def make_dist(version, build, packages):
+    pkg_refs = ''.join(
+        '<pkg-ref id="com.apple.pkg.%s" installKBytes="%d" '
+        'version="%s">%s</pkg-ref>'
+        % (name[:-len('.pkg')], size // 1024 + 1, version, name)
+        for name, size in packages)
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<installer-gui-script minSpecVersion="2">'
+            '<title>SU_TITLE</title>'
+            '<options hostArchitectures="x86_64"/>'
+            '<choices-outline><line choice="manual"/></choices-outline>'
+            '<choice id="manual">%s</choice>%s'
+            '<auxinfo><dict><key>BUILD</key><string>%s</string>'
+            '<key>VERSION</key><string>%s</string></dict></auxinfo>'
+            '</installer-gui-script>\n'
+            % (''.join('<pkg-ref id="com.apple.pkg.%s"/>'
+                       % name[:-len('.pkg')] for name, dummy in packages),
+               pkg_refs, build, version))
+
+
+def make_tree(root, base_url, args):
+    '''Writes the catalog, metadata, dist and package files below root.
+    Only the newest installer has package files; it is the one the
+    workflow picks. Returns the catalog URL.'''
+    products = {}
+    for idx in range(args.installers):
+        product_id = '091-%05d' % idx
+        version = '10.13.%d' % idx
+        build = '17A%03d' % idx
+        newest = idx == args.installers - 1
+        product_dir = os.path.join('content', 'downloads', product_id)
+        os.makedirs(os.path.join(root, product_dir))
+        packages = []
+        catalog_packages = []
+        for pkg_idx in range(args.packages):
+            name = 'InstallAssistantPart%d.pkg' % pkg_idx
+            size = int(args.package_size * MB)
+            path = os.path.join(root, product_dir, name)
+            digest = write_package(path, size) if newest else '0' * 40
+            packages.append((name, size))
+            catalog_packages.append({
+                'URL': '%s/%s/%s' % (base_url, product_dir, name),
+                'Size': size,
+                'Digest': digest,
+            })
+        dist_name = '%s.English.dist' % product_id
+        with open(os.path.join(root, product_dir, dist_name), 'w') as fileobj:
+            fileobj.write(make_dist(version, build, packages))
+        smd_name = '%s.smd' % product_id
+        plistlib.writePlist({
+            'CFBundleShortVersionString': version,
+            'localization': {'English': {'title': 'Install macOS Bench'}},
+        }, os.path.join(root, product_dir, smd_name))
+        products[product_id] = {
+            'Distributions': {
+                'English': '%s/%s/%s' % (base_url, product_dir, dist_name)},
+            'ExtendedMetaInfo': {'InstallAssistantPackageIdentifiers': {
+                'OSInstall': OSINSTALL_IDENTIFIER}},
+            'Packages': catalog_packages,
+            'PostDate': datetime.datetime(2017, 1, 1) +
+                        datetime.timedelta(days=idx),
+            'ServerMetadataURL': '%s/%s/%s' % (base_url, product_dir, smd_name),
+        }
+    # the merged catalogs are mostly other products the parser skips
+    for idx in range(args.other_products):
+        products['041-%05d' % idx] = {
+            'Packages': [{
+                'URL': '%s/content/downloads/041-%05d/Update.pkg'
+                       % (base_url, idx),
+                'Size': 1024 * idx,
+                'Digest': '%040x' % idx,
+            }],
+            'PostDate': datetime.datetime(2016, 1, 1),
+            'ServerMetadataURL': '%s/content/downloads/041-%05d/Update.smd'
+                                 % (base_url, idx),
+        }
+    catalog_path = os.path.join('content', 'catalogs', 'bench.sucatalog')
+    os.makedirs(os.path.join(root, os.path.dirname(catalog_path)))
+    plistlib.writePlist({'CatalogVersion': 2, 'Products': products},
+                        os.path.join(root, catalog_path))
+    return '%s/%s' % (base_url, catalog_path)
+
+
+def install_stubs(bin_dir, state_dir, args):
+    '''Points imaging and install at the stub tools'''
+    os.makedirs(bin_dir)
+    tools = {}
+    for name in ('hdiutil', 'installer'):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as fileobj:
+            fileobj.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+                sys.executable, os.path.join(HERE, 'stubs', name + '.py')))
+        os.chmod(path, 0755)
+        tools[name] = path
+    imaging.HDIUTIL = tools['hdiutil']
+    install.INSTALLER = tools['installer']
+    # the stub flushes its own output, it needs no pty
+    install.PTYEXEC = None
+    install.SCRIPT_CMD = []
+    os.environ['BENCH_STATE_DIR'] = state_dir
+    os.environ['BENCH_TOOL_DELAY'] = str(args.tool_delay)
+    os.environ['BENCH_OUTPUT_LINES'] = str(args.output_lines)
+    os.environ['BENCH_OUTPUT_RATE'] = str(args.output_rate)
+
+
+def run_once(catalog_url, workdir, args):
+    '''Runs the workflow once and returns its timings'''
+    reinstaller = workflow.Reinstaller(
+        sucatalog=catalog_url, workdir=workdir,
+        reinstall=not args.download_only,
+        artifact_cache=args.artifact_cache,
+        report_dir=os.path.join(workdir, 'reports'))
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    started = time.time()
+    try:
+        reinstaller.run()
+    finally:
+        if not args.verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+    total = time.time() - started
+    steps = instrument.shared_recorder().summary()
+    return {
+        'total': total,
+        'stages': dict(reinstaller.pipeline.timings()),
+        'steps': dict((name, entry['seconds'])
+                      for name, entry in steps.items()
+                      if not name.startswith('stage.')),
+        'bytes': steps.get('stage.download', {}).get('bytes', 0),
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(runs):
+    '''Returns min, median and max of every stage and step over runs'''
+    summary = {'total': {}, 'stages': {}, 'steps': {}}
+    totals = [run['total'] for run in runs]
+    summary['total'] = {'min': min(totals), 'median': median(totals),
+                        'max': max(totals)}
+    for kind in ('stages', 'steps'):
+        names = sorted(set(name for run in runs for name in run[kind]))
+        for name in names:
+            values = [run[kind].get(name, 0.0) for run in runs]
+            summary[kind][name] = {'min': min(values),
+                                   'median': median(values),
+                                   'max': max(values)}
+    return summary
+
+
+def print_summary(summary, runs):
+    print '%-32s %9s %9s %9s' % ('', 'min', 'median', 'max')
+    for kind in ('stages', 'steps'):
+        print kind
+        for name, values in sorted(summary[kind].items()):
+            print '  %-30s %8.3fs %8.3fs %8.3fs' % (
+                name, values['min'], values['median'], values['max'])
+    values = summary['total']
+    print '%-32s %8.3fs %8.3fs %8.3fs' % (
+        'total', values['min'], values['median'], values['max'])
+    fetched = median([run['bytes'] for run in runs])
+    download = summary['stages'].get('download', {}).get('median')
+    if fetched and download:
+        print 'download throughput %.1f MB/s' % (fetched / download / MB)
+
+
+def compare(summary, baseline, tolerance):
+    '''Returns descriptions of the stages and steps whose median is more
+    than tolerance slower than in baseline'''
+    regressions = []
+    for kind in ('stages', 'steps'):
+        for name, values in sorted(summary[kind].items()):
+            before = baseline.get(kind, {}).get(name)
+            if before is None:
+                continue
+            now, then = values['median'], before['median']
+            if now - then > max(then * tolerance, MIN_REGRESSION):
+                regressions.append('%s %s: %.3fs, was %.3fs' % (
+                    kind[:-1], name, now, then))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the reinstall workflow against a local '
+                    'catalog server and stub system tools.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Number of runs, each with an empty workdir.')
+    parser.add_argument('--installers', type=int, default=4,
+                        help='macOS installer products in the catalog.')
+    parser.add_argument('--other-products', type=int, default=2000,
+                        help='Other products in the catalog.')
+    parser.add_argument('--packages', type=int, default=4,
+                        help='Packages of the installer that is downloaded.')
+    parser.add_argument('--package-size', type=float, default=64,
+                        help='Size of every package in MB.')
+    parser.add_argument('--output-lines', type=int, default=1000,
+                        help='Percent lines installer and startosinstall '
+                        'print.')
+    parser.add_argument('--output-rate', type=float, default=0,
+                        help='Lines per second the tools print, 0 for as '
+                        'fast as possible.')
+    parser.add_argument('--tool-delay', type=float, default=0,
+                        help='Seconds every tool invocation takes.')
+    parser.add_argument('--download-only', action='store_true',
+                        help='Leave out the startosinstall stage.')
+    parser.add_argument('--artifact-cache', action='store_true',
+                        help='Keep the built installer, as the app does by '
+                        'default. Off so every run builds it.')
+    parser.add_argument('--warm', action='store_true',
+                        help='Keep the workdir between runs.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the output of the workflow.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the temporary directory.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the runs and their summary to PATH.')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='JSON written by an earlier --json to compare '
+                        'the medians with; exits with 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fraction a median may exceed the baseline by.')
+    args = parser.parse_args(argv)
+
+    temp_dir = tempfile.mkdtemp(prefix='osreinstaller-bench.')
+    server = None
+    try:
+        server = peercache.PeerCacheServer(
+            os.path.join(temp_dir, 'srv'), port=0, host='127.0.0.1')
+        base_url = 'http://127.0.0.1:%d' % server.port
+        os.makedirs(server.root_dir)
+        started = time.time()
+        catalog_url = make_tree(server.root_dir, base_url, args)
+        print 'Generated the catalog tree in %.1fs' % (time.time() - started)
+        install_stubs(os.path.join(temp_dir, 'bin'),
+                      os.path.join(temp_dir, 'state'), args)
+        server.start()
+
+        runs = []
+        for run in range(args.runs):
+            workdir = os.path.join(temp_dir, 'work')
+            if not args.warm and os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            try:
+                runs.append(run_once(catalog_url, workdir, args))
+            except StageError, err:
+                print >> sys.stderr, 'Run %d failed in stage %s: %s' % (
+                    run + 1, err.stage, err)
+                return 1
+            print 'Run %d took %.2fs' % (run + 1, runs[-1]['total'])
+        summary = summarize(runs)
+        print_summary(summary, runs)
+
+        if args.json:
+            with open(args.json, 'w') as fileobj:
+                json.dump({'options': vars(args), 'runs': runs,
+                           'summary': summary}, fileobj, indent=2,
+                          sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as fileobj:
+                baseline = json.load(fileobj)['summary']
+            regressions = compare(summary, baseline, args.tolerance)
+            for regression in regressions:
+                print >> sys.stderr, 'Regression: %s' % regression
+            if regressions:
+                return 1
+        return 0
+    finally:
+        # let the server's handler threads see the kept-alive connections
+        # close before the interpreter goes away
+        connpool.shared_pool().close()
+        if server is not None:
+            server.stop()
+        if args.keep:
+            print 'Kept %s' % temp_dir
+        else:
+            shutil.rmtree(temp_dir, True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
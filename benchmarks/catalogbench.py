@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+#  catalogbench.py
+#  OSReinstaller benchmarks
+#
+#  Parse time and memory of the streaming catalog parser compared with
+#  reading the whole catalog with plistlib. A synthetic catalog shaped like
+#  a merged reposado catalog - a few macOS installers among many other
+#  products - is written to a temporary directory and parsed by each parser
+#  in a fresh Python process, which reports its wall time and the growth of
+#  its peak resident set size:
+#
+#    python benchmarks/catalogbench.py --products 40000
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import plistlib
+import resource
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import catalog
+
+
+BASE_URL = 'http://swcdn.example.com/content/downloads'
+
+
+def make_catalog(path, installers, products, packages):
+    '''Writes a catalog with installers macOS installers and products other
+    products of packages packages each'''
+    entries = {}
+    for idx in range(installers):
+        product_id = '091-%05d' % idx
+        entries[product_id] = {
+            'Distributions': {
+                'English': '%s/%s/%s.English.dist'
+                           % (BASE_URL, product_id, product_id)},
+            'ExtendedMetaInfo': {'InstallAssistantPackageIdentifiers': {
+                'OSInstall': catalog.OSINSTALL_IDENTIFIER}},
+            'Packages': [{
+                'URL': '%s/%s/InstallAssistantPart%d.pkg'
+                       % (BASE_URL, product_id, pkg),
+                'Size': 500000000 + pkg,
+                'Digest': '%040x' % pkg,
+            } for pkg in range(packages)],
+            'PostDate': datetime.datetime(2017, 1, 1) +
+                        datetime.timedelta(days=idx),
+            'ServerMetadataURL': '%s/%s/%s.smd'
+                                 % (BASE_URL, product_id, product_id),
+        }
+    for idx in range(products):
+        product_id = '041-%05d' % idx
+        entries[product_id] = {
+            'Distributions': {
+                'English': '%s/%s/%s.English.dist'
+                           % (BASE_URL, product_id, product_id)},
+            'Packages': [{
+                'URL': '%s/%s/Update%d.pkg' % (BASE_URL, product_id, pkg),
+                'MetadataURL': '%s/%s/Update%d.pkm'
+                               % (BASE_URL, product_id, pkg),
+                'Size': 1024 * idx + pkg,
+                'Digest': '%040x' % idx,
+            } for pkg in range(packages)],
+            'PostDate': datetime.datetime(2016, 1, 1),
+            'ServerMetadataURL': '%s/%s/Update.smd' % (BASE_URL, product_id),
+        }
+    plistlib.writePlist({'CatalogVersion': 2,
+                         'IndexDate': datetime.datetime(2018, 5, 1),
+                         'Products': entries}, path)
+
+
+def plistlib_parse(path):
+    '''Reads the whole catalog and filters it afterwards'''
+    result = plistlib.readPlist(path)
+    products = result.get('Products', {})
+    result['Products'] = dict(
+        (key, products[key]) for key in products
+        if catalog.is_mac_os_installer(products[key]))
+    return result
+
+
+PARSERS = (
+    ('plistlib', plistlib_parse),
+    ('parse_sucatalog', catalog.parse_sucatalog),
+)
+
+
+def run_parser(name, path, repeat):
+    '''Parses the catalog at path with parser name repeat times and prints
+    the best wall time, the peak RSS growth in bytes and the installer keys
+    found as JSON'''
+    func = dict(PARSERS)[name]
+    scale = 1 if sys.platform == 'darwin' else 1024
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    best = None
+    for dummy in range(repeat):
+        started = time.time()
+        result = func(path)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+        del result
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    print json.dumps({
+        'seconds': best,
+        'rss_growth': peak - baseline,
+        'installers': sorted(func(path)['Products']),
+    })
+
+
+def measure(name, path, repeat):
+    '''Runs parser name in a fresh process, so its peak RSS doesn't include
+    writing the catalog or the other parser. Returns the parsed JSON.'''
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run', name,
+         '--repeat', str(repeat), path])
+    return json.loads(output)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the streaming catalog parser against '
+                    'plistlib.')
+    parser.add_argument('--installers', type=int, default=10,
+                        help='Number of macOS installer products.')
+    parser.add_argument('--products', type=int, default=20000,
+                        help='Number of other products.')
+    parser.add_argument('--packages', type=int, default=3,
+                        help='Packages per product.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Parses of the catalog; the best one counts.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to PATH.')
+    # used for the measurements themselves
+    parser.add_argument('--run', choices=[name for name, dummy in PARSERS],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('path', nargs='?', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run:
+        run_parser(args.run, args.path, args.repeat)
+        return 0
+    root = tempfile.mkdtemp(prefix='osreinstaller-catalogbench-')
+    try:
+        path = os.path.join(root, 'bench.sucatalog')
+        make_catalog(path, args.installers, args.products, args.packages)
+        print '%d products, %.1f MB' % (args.installers + args.products,
+                                        os.path.getsize(path) / 1048576.0)
+        measured = {}
+        for name, dummy in PARSERS:
+            measured[name] = measure(name, path, args.repeat)
+        expected = measured[PARSERS[0][0]].pop('installers')
+        print '%-16s %10s %14s' % ('', 'time', 'RSS growth')
+        for name, dummy in PARSERS:
+            result = measured[name]
+            if result.pop('installers', expected) != expected:
+                print >> sys.stderr, '%s found different installers' % name
+                return 1
+            print '%-16s %9.3fs %11.1f MB' % (
+                name, result['seconds'], result['rss_growth'] / 1048576.0)
+        if args.json:
+            with open(args.json, 'w') as fileobj:
+                json.dump(measured, fileobj, indent=2, sort_keys=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+#  distbench.py
+#  OSReinstaller benchmarks
+#
+#  Parse time and memory of the dist file analyzer compared with the
+#  minidom parser it replaced. A number of synthetic dist files shaped
+#  like Apple's, with installation check scripts, localizations and
+#  pkg-refs, are written to a temporary directory and parsed by each
+#  parser in a fresh Python process, which reports its wall time and the
+#  growth of its peak resident set size:
+#
+#    python benchmarks/distbench.py --files 500 --script-kb 64
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from xml.parsers import expat
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import catalog
+
+
+def make_dist(idx, packages, script_kb):
+    '''Returns a dist file with packages pkg-refs and script_kb KB of
+    installation check script'''
+    script_line = 'function check%d() { return system.compareVersions(' \
+                  'my.target.systemVersion.ProductVersion, "10.9") &gt;= 0; }\n'
+    script = ''.join(script_line % line
+                     for line in range(script_kb * 1024 // len(script_line)))
+    names = ['Package%d' % pkg for pkg in range(packages)]
+    return ('<?xml version="1.0" encoding="utf-8" standalone="no"?>\n'
+            '<installer-gui-script minSpecVersion="2">\n'
+            '<title>SU_TITLE</title>\n'
+            '<options hostArchitectures="x86_64" customize="never"/>\n'
+            '<script>%s</script>\n'
+            '<localization><strings language="English">'
+            '"SU_TITLE" = "Install macOS";</strings></localization>\n'
+            '<choices-outline><line choice="manual"/></choices-outline>\n'
+            '<choice id="manual" title="SU_TITLE">%s</choice>\n'
+            '%s'
+            '<auxinfo><dict>'
+            '<key>BUILD</key><string>17G%03d</string>'
+            '<key>VERSION</key><string>10.13.%d</string>'
+            '</dict></auxinfo>\n'
+            '</installer-gui-script>\n'
+            % (script,
+               ''.join('<pkg-ref id="com.apple.pkg.%s"/>' % name
+                       for name in names),
+               ''.join('<pkg-ref id="com.apple.pkg.%s" auth="root" '
+                       'installKBytes="%d" version="10.13.%d">#%s.pkg'
+                       '</pkg-ref>\n' % (name, 1000 * (pkg + 1), idx, name)
+                       for pkg, name in enumerate(names)),
+               idx, idx))
+
+
+def minidom_parse_dist(filename):
+    '''The minidom parser analyze_dist replaced, for comparison'''
+    from xml.dom import minidom
+    dist_info = {}
+    try:
+        dom = minidom.parse(filename)
+    except (expat.ExpatError, IOError):
+        return dist_info
+    auxinfos = dom.getElementsByTagName('auxinfo')
+    if not auxinfos:
+        return dist_info
+    auxinfo = auxinfos[0]
+    key = None
+    value = None
+    children = auxinfo.childNodes
+    dict_nodes = [n for n in auxinfo.childNodes
+                  if n.nodeType == n.ELEMENT_NODE and
+                  n.tagName == 'dict']
+    if dict_nodes:
+        children = dict_nodes[0].childNodes
+    for node in children:
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'key':
+            key = node.firstChild.wholeText
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'string':
+            value = node.firstChild.wholeText
+        if key and value:
+            dist_info[key] = value
+            key = None
+            value = None
+    return dist_info
+
+
+def streaming_parse_dist(filename):
+    info = catalog.analyze_dist(filename)
+    # what the workflow uses besides the auxinfo
+    info.total_install_kbytes()
+    info.package_order()
+    return info.auxinfo
+
+
+PARSERS = (
+    ('minidom', minidom_parse_dist),
+    ('analyze_dist', streaming_parse_dist),
+)
+
+
+def run_parser(name, root, repeat):
+    '''Runs parser name over the dist files in root repeat times and prints
+    the best wall time, the peak RSS growth in bytes and the auxinfo of the
+    last pass as JSON'''
+    func = dict(PARSERS)[name]
+    paths = sorted(os.path.join(root, item) for item in os.listdir(root))
+    # the first pass also loads the modules the parser needs
+    func(paths[0])
+    scale = 1 if sys.platform == 'darwin' else 1024
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    best = None
+    for dummy in range(repeat):
+        started = time.time()
+        results = [func(path) for path in paths]
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    print json.dumps({
+        'seconds': best,
+        'rss_growth': peak - baseline,
+        'results': results,
+    })
+
+
+def measure(name, root, repeat):
+    '''Runs parser name in a fresh process, so its peak RSS doesn't include
+    writing the files or the other parser. Returns the parsed JSON.'''
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run', name,
+         '--repeat', str(repeat), root])
+    return json.loads(output)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the dist file analyzer against minidom.')
+    parser.add_argument('--files', type=int, default=200,
+                        help='Number of dist files.')
+    parser.add_argument('--packages', type=int, default=8,
+                        help='pkg-refs per dist file.')
+    parser.add_argument('--script-kb', type=int, default=32,
+                        help='KB of installation check script per file.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Passes over all files; the best one counts.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to PATH.')
+    # used for the measurements themselves
+    parser.add_argument('--run', choices=[name for name, dummy in PARSERS],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('root', nargs='?', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run:
+        run_parser(args.run, args.root, args.repeat)
+        return 0
+    root = tempfile.mkdtemp(prefix='osreinstaller-distbench-')
+    try:
+        paths = []
+        for idx in range(args.files):
+            path = os.path.join(root, '%03d.English.dist' % idx)
+            with open(path, 'w') as fileobj:
+                fileobj.write(make_dist(idx, args.packages, args.script_kb))
+            paths.append(path)
+        total = sum(os.path.getsize(path) for path in paths)
+        print '%d dist files, %.1f MB' % (len(paths), total / 1048576.0)
+        measured = {}
+        for name, dummy in PARSERS:
+            measured[name] = measure(name, root, args.repeat)
+        expected = measured[PARSERS[0][0]].pop('results')
+        print '%-16s %10s %12s %14s' % ('', 'total', 'per file', 'RSS growth')
+        for name, dummy in PARSERS:
+            result = measured[name]
+            if result.pop('results', expected) != expected:
+                print >> sys.stderr, '%s parsed different auxinfo' % name
+                return 1
+            print '%-16s %9.3fs %10.2fms %11.1f MB' % (
+                name, result['seconds'],
+                result['seconds'] / len(paths) * 1000,
+                result['rss_growth'] / 1048576.0)
+        if args.json:
+            with open(args.json, 'w') as fileobj:
+                json.dump(measured, fileobj, indent=2, sort_keys=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+#  importbench.py
+#  OSReinstaller benchmarks
+#
+#  Import time of the core modules and the command line entry point. Each
+#  module is imported in a fresh Python process, which reports the time the
+#  import took and the number of modules it loaded; the median of a number
+#  of runs counts:
+#
+#    python benchmarks/importbench.py --runs 9 workflow cli
+#
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(os.path.dirname(HERE), 'OSReinstaller')
+
+DEFAULT_MODULES = ['workflow', 'cli', 'catalog', 'fetch']
+
+CHILD = '''
+import sys, time
+sys.path.insert(0, %r)
+before = len(sys.modules)
+started = time.time()
+import %s
+print time.time() - started, len(sys.modules) - before
+'''
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def import_once(name):
+    '''Returns the seconds importing name took in a fresh process and the
+    modules it loaded'''
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD % (SOURCE, name)])
+    seconds, modules = output.split()
+    return float(seconds), int(modules)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the import time of the core modules.')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='Modules to import.')
+    parser.add_argument('--runs', type=int, default=9,
+                        help='Imports per module; the median counts.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to PATH.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    print '%-12s %12s %10s' % ('', 'import', 'modules')
+    for name in args.modules:
+        # the first import writes the .pyc files
+        import_once(name)
+        runs = [import_once(name) for dummy in range(args.runs)]
+        seconds = median([run[0] for run in runs])
+        modules = runs[-1][1]
+        results[name] = {'seconds': seconds, 'modules': modules}
+        print '%-12s %10.1fms %10d' % (name, seconds * 1000, modules)
+    if args.json:
+        with open(args.json, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+#  progressbench.py
+#  OSReinstaller benchmarks
+#
+#  Publish cost of the progress bus. Worker threads call set_bytes,
+#  set_percent and set_detail on a running ProgressBus as fast as they can,
+#  the way download segments and the installer output parser do; the
+#  deliver callback formats each frame like the window does. Prints the
+#  cost per publish call and the frames delivered, next to the Progress
+#  base class, which ignores all calls, as the floor:
+#
+#    python benchmarks/progressbench.py --calls 1000000 --threads 4
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import progress
+
+# publish calls per round of publish(): set_bytes every round, set_percent
+# and set_detail every 16th
+CALLS_PER_ROUND = 1 + 2 / 16.0
+
+
+def publish(target, calls):
+    '''What a download segment and the installer output parser publish'''
+    total = calls * 1024
+    for idx in xrange(calls):
+        target.set_bytes(idx * 1024, total)
+        if not idx % 16:
+            target.set_percent(idx * 100.0 / calls)
+            target.set_detail('Writing files...')
+
+
+def run(target, calls, threads):
+    '''Runs publish() in threads threads at once, each for calls rounds.
+    Returns the wall time.'''
+    workers = [threading.Thread(target=publish, args=(target, calls))
+               for dummy in range(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - started
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the publish cost of the progress bus.')
+    parser.add_argument('--calls', type=int, default=200000,
+                        help='set_bytes calls per thread.')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Publishing threads.')
+    parser.add_argument('--fps', type=int, default=progress.DEFAULT_FPS,
+                        help='Frame rate of the bus.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to PATH.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    frames = []
+
+    def deliver(snapshot):
+        frames.append(snapshot)
+        if 'bytes_done' in snapshot:
+            progress.describe_byte_progress(snapshot)
+
+    calls = args.calls * CALLS_PER_ROUND * args.threads
+    results = {}
+    print '%-12s %10s %14s %8s' % ('', 'total', 'per call', 'frames')
+    for name in ('Progress', 'ProgressBus'):
+        if name == 'Progress':
+            target = progress.NULL_PROGRESS
+            seconds = run(target, args.calls, args.threads)
+        else:
+            target = progress.ProgressBus(deliver, fps=args.fps)
+            target.start()
+            seconds = run(target, args.calls, args.threads)
+            target.stop()
+        results[name] = {
+            'seconds': seconds,
+            'per_call': seconds / calls,
+            'frames': len(frames),
+        }
+        print '%-12s %9.3fs %12.0fns %8d' % (
+            name, seconds, seconds / calls * 1e9, len(frames))
+    if args.json:
+        with open(args.json, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+#  ptybench.py
+#  OSReinstaller benchmarks
+#
+#  Latency and throughput of ptyexec, which runs startosinstall on a pty.
+#  A child prints a number of lines, then a last line with the time it is
+#  about to exit. The exit latency is the time from that line until ptyexec
+#  itself has exited, compared with running the child on plain pipes; the
+#  throughput is the lines per second that arrived. Another ptyexec, e.g.
+#  one from an older checkout, can be measured with --ptyexec:
+#
+#    python benchmarks/ptybench.py --lines 20000 --runs 5
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PTYEXEC = os.path.join(os.path.dirname(HERE), 'OSReinstaller', 'ptyexec')
+
+CHILD = '''
+import sys, time
+write = sys.stdout.write
+for idx in range(%d):
+    write('Preparing %%d of %d lines...\\n' %% idx)
+sys.stdout.write('EXIT %%r\\n' %% time.time())
+sys.stdout.flush()
+'''
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_once(lines, ptyexec=None):
+    '''Runs the child, on a pty through ptyexec if given. Returns the
+    lines that arrived, the total seconds and the seconds from the child's
+    last line until the wrapper exited, or None if the run failed or its
+    last line got lost.'''
+    cmd = [sys.executable, '-c', CHILD % (lines, lines)]
+    if ptyexec:
+        # ptyexec's #! may not point at a Python 2 here
+        cmd = [sys.executable, ptyexec] + cmd
+    started = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    proc.wait()
+    finished = time.time()
+    output = output.replace('\r\n', '\n').split('\n')
+    exit_lines = [line for line in output if line.startswith('EXIT ')]
+    if proc.returncode or not exit_lines:
+        return None
+    arrived = len([line for line in output if line.startswith('Preparing ')])
+    return (arrived, finished - started,
+            finished - float(exit_lines[-1].split()[1]))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks exit latency and throughput of ptyexec.')
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='Lines the child prints.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Runs per wrapper; the median counts.')
+    parser.add_argument('--ptyexec', default=PTYEXEC, metavar='PATH',
+                        help='The ptyexec to measure.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to PATH.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    print '%-10s %12s %14s %12s %8s' % ('', 'lines/s', 'exit latency',
+                                        'lost lines', 'failed')
+    for name, ptyexec in (('pipe', None), ('ptyexec', args.ptyexec)):
+        runs = [run_once(args.lines, ptyexec) for dummy in range(args.runs)]
+        failed = runs.count(None)
+        runs = [run for run in runs if run is not None]
+        results[name] = {'failed_runs': failed}
+        if not runs:
+            print '%-10s %12s %14s %12s %8d' % (name, '-', '-', '-', failed)
+            continue
+        lost = max(args.lines - arrived for arrived, dummy, dummy in runs)
+        seconds = median([total for dummy, total, dummy in runs])
+        latency = median([exited for dummy, dummy, exited in runs])
+        results[name].update({
+            'lines_per_second': args.lines / seconds,
+            'exit_latency': latency,
+            'lost_lines': lost,
+        })
+        print '%-10s %12.0f %12.1fms %12d %8d' % (
+            name, args.lines / seconds, latency * 1000, lost, failed)
+    if args.json:
+        with open(args.json, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+    if results['ptyexec']['failed_runs'] or results['ptyexec'].get(
+            'lost_lines'):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+#  replaybench.py
+#  OSReinstaller benchmarks
+#
+#  Throughput and CPU cost of the output parser. The installer and
+#  startosinstall transcripts in benchmarks/transcripts are replayed many
+#  times over by the stub in benchmarks/stubs/replay.py, and parse_output
+#  reads the process's pipes the way install.py does. Prints lines and
+#  events per second and the CPU time spent in this process per 1000
+#  lines, the best of a number of runs:
+#
+#    python benchmarks/replaybench.py --repeat 500 --chunk 4096
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import outputparser
+
+REPLAY = os.path.join(HERE, 'stubs', 'replay.py')
+TRANSCRIPTS = (
+    ('installer', outputparser.installer_table),
+    ('startosinstall', outputparser.startosinstall_table),
+)
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def replay_once(name, table, args):
+    '''Parses one replay of transcript name. Returns wall time, CPU time,
+    lines and events.'''
+    path = os.path.join(HERE, 'transcripts', name + '.txt')
+    with open(path, 'rb') as fileobj:
+        data = fileobj.read() * args.repeat
+    lines = len([line for line in
+                 data.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+                 if line])
+    started = time.time()
+    cpu_started = cpu_time()
+    proc = subprocess.Popen(
+        [sys.executable, REPLAY, path, '--repeat', str(args.repeat),
+         '--chunk', str(args.chunk)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    events = 0
+    for dummy in outputparser.parse_output(proc, table):
+        events += 1
+    return (time.time() - started, cpu_time() - cpu_started,
+            lines, events)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the output parser with replayed tool '
+                    'output.')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='Times each transcript is replayed per run.')
+    parser.add_argument('--chunk', type=int, default=4096,
+                        help='Bytes per write of the replaying process.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Runs per transcript; the best one counts.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to PATH.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    print '%-16s %10s %14s %14s %14s' % (
+        '', 'lines', 'lines/s', 'events/s', 'CPU/1000 lines')
+    for name, table_for in TRANSCRIPTS:
+        best = None
+        for dummy in range(args.runs):
+            result = replay_once(name, table_for(), args)
+            if best is None or result[0] < best[0]:
+                best = result
+        seconds, cpu_seconds, lines, events = best
+        results[name] = {
+            'seconds': seconds,
+            'cpu_seconds': cpu_seconds,
+            'lines': lines,
+            'events': events,
+        }
+        print '%-16s %10d %14.0f %14.0f %12.2fms' % (
+            name, lines, lines / seconds, events / seconds,
+            cpu_seconds / lines * 1000000)
+    if args.json:
+        with open(args.json, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
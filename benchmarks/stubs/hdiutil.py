@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+#  hdiutil.py
+#  OSReinstaller benchmarks
+#
+#  Stand-in for /usr/bin/hdiutil supporting the calls imaging.py makes. A
+#  sparse image is an empty file whose volume is a directory below
+#  BENCH_STATE_DIR; attaching returns that directory as the mountpoint. A
+#  compressed image made with -srcfolder is a tar file, extracted on attach.
+#
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tarfile
+import plistlib
+
+
+STATE_DIR = os.environ.get('BENCH_STATE_DIR', '/tmp/osreinstaller-bench')
+# seconds every command takes on top of its work
+DELAY = float(os.environ.get('BENCH_TOOL_DELAY', '0'))
+
+
+def volume_dir(image_path):
+    key = hashlib.sha1(os.path.abspath(image_path)).hexdigest()
+    return os.path.join(STATE_DIR, 'volumes', key)
+
+
+def option(args, name):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def fail(message):
+    print >> sys.stderr, 'hdiutil: %s' % message
+    return 1
+
+
+def create(args):
+    output = args[-1]
+    srcfolder = option(args, '-srcfolder')
+    if srcfolder:
+        if not os.path.isdir(srcfolder):
+            return fail('create failed - No such file or directory')
+        archive = tarfile.open(output, 'w')
+        try:
+            archive.add(srcfolder, arcname=os.path.basename(srcfolder))
+        finally:
+            archive.close()
+        print 'created: %s' % output
+        return 0
+    if not output.endswith('.sparseimage'):
+        output += '.sparseimage'
+    open(output, 'w').close()
+    volume = volume_dir(output)
+    shutil.rmtree(volume, True)
+    os.makedirs(volume)
+    if '-plist' in args:
+        sys.stdout.write(plistlib.writePlistToString([output]))
+    else:
+        print 'created: %s' % output
+    return 0
+
+
+def attach(args):
+    image = args[0]
+    if not os.path.isfile(image):
+        return fail('attach failed - No such file or directory')
+    volume = volume_dir(image)
+    if tarfile.is_tarfile(image):
+        shutil.rmtree(volume, True)
+        os.makedirs(volume)
+        archive = tarfile.open(image)
+        try:
+            archive.extractall(volume)
+        finally:
+            archive.close()
+    elif not os.path.isdir(volume):
+        return fail('attach failed - image not recognized')
+    sys.stdout.write(plistlib.writePlistToString(
+        {'system-entities': [{'mount-point': volume}]}))
+    return 0
+
+
+def detach(args):
+    if not os.path.isdir(args[0]):
+        return fail('detach failed - No such file or directory')
+    print '"%s" ejected.' % args[0]
+    return 0
+
+
+def main(argv):
+    time.sleep(DELAY)
+    commands = {'create': create, 'attach': attach, 'detach': detach}
+    if len(argv) < 2 or argv[1] not in commands:
+        return fail('unsupported arguments %s' % ' '.join(argv[1:]))
+    return commands[argv[1]](argv[2:])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
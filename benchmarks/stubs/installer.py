@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+#  installer.py
+#  OSReinstaller benchmarks
+#
+#  Stand-in for /usr/sbin/installer -pkg <dist> -target <volume> -verboseR.
+#  Checks the packages the dist file refers to were downloaded next to it,
+#  emits -verboseR output at BENCH_OUTPUT_RATE lines per second and builds
+#  an Install macOS.app holding the packages and a startosinstall stub on
+#  the target volume.
+#
+
+import os
+import re
+import sys
+import time
+import shutil
+
+
+STUB_DIR = os.path.dirname(os.path.abspath(__file__))
+DELAY = float(os.environ.get('BENCH_TOOL_DELAY', '0'))
+OUTPUT_LINES = int(os.environ.get('BENCH_OUTPUT_LINES', '200'))
+OUTPUT_RATE = float(os.environ.get('BENCH_OUTPUT_RATE', '0'))
+APP_NAME = 'Install macOS Bench.app'
+
+# passed on to startosinstall, which runs with a bare environment
+PASSED_ON = ('BENCH_TOOL_DELAY', 'BENCH_OUTPUT_LINES', 'BENCH_OUTPUT_RATE')
+
+
+def option(args, name):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def emit(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+    if OUTPUT_RATE:
+        time.sleep(1.0 / OUTPUT_RATE)
+
+
+def write_startosinstall(path):
+    lines = ['#!/bin/sh']
+    for name in PASSED_ON:
+        if name in os.environ:
+            lines.append("%s='%s'; export %s" % (name, os.environ[name], name))
+    lines.append('exec "%s" "%s" "$@"' % (
+        sys.executable, os.path.join(STUB_DIR, 'startosinstall.py')))
+    with open(path, 'w') as fileobj:
+        fileobj.write('\n'.join(lines) + '\n')
+    os.chmod(path, 0755)
+
+
+def main(argv):
+    dist_path = option(argv, '-pkg')
+    target = option(argv, '-target')
+    if not dist_path or not target or not os.path.isdir(target):
+        print >> sys.stderr, 'installer: Error - invalid arguments'
+        return 1
+    try:
+        dist = open(dist_path).read()
+    except IOError, err:
+        print >> sys.stderr, 'installer: Error - %s' % err
+        return 1
+    packages = [os.path.join(os.path.dirname(dist_path), name) for name in
+                re.findall(r'<pkg-ref[^>]*>([^<]+\.pkg)</pkg-ref>', dist)]
+    missing = [path for path in packages if not os.path.exists(path)]
+    if missing:
+        print >> sys.stderr, ('installer: Error - package %s not found'
+                              % missing[0])
+        return 1
+    time.sleep(DELAY)
+
+    emit('installer:PHASE:Preparing for installation\xe2\x80\xa6')
+    emit('installer:STATUS:Preparing the disk\xe2\x80\xa6')
+    emit('installer:PHASE:Preparing Install macOS Bench\xe2\x80\xa6')
+    app_path = os.path.join(target, 'Applications', APP_NAME)
+    resources = os.path.join(app_path, 'Contents', 'Resources')
+    shared_support = os.path.join(app_path, 'Contents', 'SharedSupport')
+    for path in (resources, shared_support):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    emit('installer:PHASE:Installing Install macOS Bench\xe2\x80\xa6')
+    steps = max(OUTPUT_LINES, 1)
+    copied = 0
+    for step in range(steps):
+        # copy the payload along with the progress output
+        while packages and copied < (step + 1) * len(packages) // steps:
+            shutil.copyfile(packages[copied], os.path.join(
+                shared_support, os.path.basename(packages[copied])))
+            copied += 1
+        emit('installer:%%%f' % (100.0 * (step + 1) / steps))
+        if step % 10 == 0:
+            emit('installer:STATUS:Writing files\xe2\x80\xa6')
+    write_startosinstall(os.path.join(resources, 'startosinstall'))
+    emit('installer:STATUS:Running package scripts\xe2\x80\xa6')
+    emit('installer:PHASE:Finishing the Installation\xe2\x80\xa6')
+    emit('installer:STATUS:')
+    emit('installer:PHASE:The software was successfully installed.')
+    emit('installer: The install was successful.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
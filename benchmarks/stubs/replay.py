@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+#  replay.py
+#  OSReinstaller benchmarks
+#
+#  Replays a transcript of tool output from benchmarks/transcripts, so the
+#  output parser can be tested and measured against a real process. The
+#  transcript is written to stdout in chunks of a given size, which split
+#  lines anywhere. Lines can be written to stderr first, more than a pipe
+#  holds, and the end of the transcript can be written after this process
+#  has exited, by a child that keeps the pipes open.
+#
+
+import os
+import sys
+import time
+import argparse
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Writes a transcript to stdout in chunks.')
+    parser.add_argument('transcript')
+    parser.add_argument('--chunk', type=int, default=4096,
+                        help='Bytes per write.')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds to sleep after each write.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Times the transcript is written.')
+    parser.add_argument('--stderr-lines', type=int, default=0,
+                        help='Lines written to stderr before the transcript.')
+    parser.add_argument('--after-exit', type=int, default=0, metavar='BYTES',
+                        help='Bytes at the end written after the exit.')
+    parser.add_argument('--exit-code', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def write(fd, data, chunk, delay):
+    for start in range(0, len(data), chunk):
+        os.write(fd, data[start:start + chunk])
+        if delay:
+            time.sleep(delay)
+
+
+def main(argv):
+    args = parse_args(argv)
+    with open(args.transcript, 'rb') as fileobj:
+        data = fileobj.read() * args.repeat
+    if args.stderr_lines:
+        write(2, ''.join('replay: diagnostic message %d\n' % idx
+                         for idx in range(args.stderr_lines)),
+              args.chunk, args.delay)
+    tail = ''
+    if args.after_exit:
+        data, tail = data[:-args.after_exit], data[-args.after_exit:]
+    write(1, data, args.chunk, args.delay)
+    if tail and os.fork() == 0:
+        # the child holds on to the pipes until the parent is gone
+        time.sleep(0.2)
+        write(1, tail, args.chunk, args.delay)
+        os._exit(0)
+    return args.exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
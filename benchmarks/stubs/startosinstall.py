@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+#  startosinstall.py
+#  OSReinstaller benchmarks
+#
+#  Stand-in for Install macOS.app's startosinstall. Prints what 10.13's
+#  startosinstall --eraseinstall prints, with BENCH_OUTPUT_LINES percent
+#  lines at BENCH_OUTPUT_RATE lines per second, and exits instead of
+#  restarting.
+#
+
+import os
+import sys
+import time
+
+
+DELAY = float(os.environ.get('BENCH_TOOL_DELAY', '0'))
+OUTPUT_LINES = int(os.environ.get('BENCH_OUTPUT_LINES', '200'))
+OUTPUT_RATE = float(os.environ.get('BENCH_OUTPUT_RATE', '0'))
+
+
+def emit(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+    if OUTPUT_RATE:
+        time.sleep(1.0 / OUTPUT_RATE)
+
+
+def main(argv):
+    if '--applicationpath' not in argv or '--agreetolicense' not in argv:
+        print >> sys.stderr, 'Error: invalid arguments'
+        return 1
+    time.sleep(DELAY)
+    emit('By using the agreetolicense option, you are agreeing that you have '
+         'run this tool with the license only option and have read and '
+         'agreed to the terms.')
+    emit('If you do not agree, press CTRL-C and cancel this process '
+         'immediately.')
+    emit('Preparing to run macOS Installer...')
+    steps = max(OUTPUT_LINES, 1)
+    for step in range(steps + 1):
+        emit('Preparing %.1f...' % (100.0 * step / steps))
+    emit('Preparing to run macOS Installer...')
+    emit('Waiting to reboot...')
+    emit('Process signaled okay')
+    emit('System going down for install')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+#  httpstub.py
+#  OSReinstaller tests
+#
+#  An origin server for the download tests. It serves files from memory on
+#  an ephemeral port, with Range support, and can be told to misbehave: fail
+#  requests with a status, drop a transfer in the middle of the body, stall,
+#  send slowly or ignore Range headers. DirectoryServer serves a directory
+#  with SimpleHTTPServer, which knows nothing about Range.
+#
+
+import sys
+import time
+import socket
+import os
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+# bytes per write, so drops, stalls and the rate limit take effect
+# within a body
+WRITE_SIZE = 16 * 1024
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = urllib.unquote(urlparse.urlsplit(self.path)[2])
+        requested = self.headers.get('Range')
+        with server.lock:
+            server.requests.append((path, requested))
+            fail = server.fail_count != 0
+            if server.fail_count > 0:
+                server.fail_count -= 1
+            drop = server.drop_count != 0
+            if drop and server.drop_count > 0:
+                server.drop_count -= 1
+        if fail:
+            self.send_error(server.fail_status)
+            return
+        data = server.files.get(path)
+        if data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(data) - 1
+        if requested and server.ranges:
+            first, last = requested.split('=', 1)[1].split('-')
+            start, end = int(first), min(int(last), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        body = data[start:end + 1]
+        if drop and server.drop_after is not None:
+            body = body[:server.drop_after]
+            self.close_connection = 1
+        self._send_body(body)
+
+    def _send_body(self, body):
+        server = self.server
+        sent = 0
+        started = time.time()
+        try:
+            while sent < len(body):
+                if (server.stall_after is not None and
+                        sent >= server.stall_after):
+                    # hold the connection open without sending anything
+                    # until the test is over
+                    server.released.wait()
+                    self.close_connection = 1
+                    return
+                block = body[sent:sent + WRITE_SIZE]
+                if server.stall_after is not None:
+                    block = block[:server.stall_after - sent]
+                self.wfile.write(block)
+                sent += len(block)
+                if server.rate:
+                    ahead = sent / float(server.rate) - (
+                        time.time() - started)
+                    if ahead > 0 and server.released.wait(ahead):
+                        self.close_connection = 1
+                        return
+        except socket.error:
+            # the client gave up on the transfer
+            self.close_connection = 1
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Serves files, a dict of paths to contents, on 127.0.0.1.
+
+    fail_count requests are answered with fail_status, -1 for all of them.
+    drop_count transfers, -1 for all of them, are cut off after drop_after
+    bytes of the body. Transfers stall after stall_after bytes and are sent
+    at rate bytes per second if set. Range headers are ignored unless ranges
+    is set. requests lists (path, Range header) for every request.'''
+
+    handler_class = StubHandler
+
+    def __init__(self, files=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           self.handler_class)
+        self.files = dict(files or {})
+        self.ranges = True
+        self.fail_count = 0
+        self.fail_status = 503
+        self.drop_count = 0
+        self.drop_after = None
+        self.stall_after = None
+        self.rate = None
+        self.requests = []
+        self.lock = threading.Lock()
+        self.released = threading.Event()
+        self._thread = None
+        self._handlers = []
+
+    def process_request(self, request, client_address):
+        # like ThreadingMixIn, but keeps the threads so stop() can end them
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self.lock:
+            self._handlers.append((thread, request))
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # clients hang up on transfers they gave up on
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.released.set()
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        # hang up on idle keep-alive connections and wait for the handlers,
+        # so none is left running at interpreter shutdown
+        for thread, request in self._handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+
+class DirectoryHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        path = urllib.unquote(urlparse.urlsplit(path)[2])
+        return os.path.join(self.server.root_dir, os.path.normpath(
+            path).lstrip('/'))
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path,
+                                         self.headers.get('Range')))
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+
+class DirectoryServer(StubServer):
+    '''Serves the files below root_dir like python -m SimpleHTTPServer'''
+
+    handler_class = DirectoryHandler
+
+    def __init__(self, root_dir):
+        StubServer.__init__(self)
+        self.root_dir = root_dir
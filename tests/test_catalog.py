@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+#  test_catalog.py
+#  OSReinstaller tests
+#
+#  Run with: python -m unittest discover tests
+#
+
+import os
+import sys
+import shutil
+import datetime
+import plistlib
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import catalog
+
+
+def installer(idx):
+    return {
+        'Distributions': {
+            'English': 'http://example.com/091-%05d.English.dist' % idx},
+        'ExtendedMetaInfo': {'InstallAssistantPackageIdentifiers': {
+            'OSInstall': catalog.OSINSTALL_IDENTIFIER}},
+        'Packages': [{
+            'URL': 'http://example.com/091-%05d/InstallESDDmg.pkg' % idx,
+            'Size': 5000000000 + idx,
+            'Digest': '%040x' % idx,
+        }],
+        'PostDate': datetime.datetime(2018, 1, 1) +
+                    datetime.timedelta(days=idx),
+        'ServerMetadataURL': 'http://example.com/091-%05d.smd' % idx,
+        'Title': u'Install macOS Hìgh Sierra',
+        'Empty': {},
+        'Flags': [True, False, 1.5, plistlib.Data('\x00\xff')],
+    }
+
+
+def other_product(idx):
+    return {
+        'Packages': [{
+            'URL': 'http://example.com/041-%05d/Update.pkg' % idx,
+            'Size': 1024 * idx,
+        }],
+        'PostDate': datetime.datetime(2016, 1, 1),
+    }
+
+
+class ParseSucatalogTest(unittest.TestCase):
+    '''parse_sucatalog must give the same installers as plistlib, wherever
+    the reads split the file'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='osreinstaller-test-')
+        self.path = os.path.join(self.tmpdir, 'test.sucatalog')
+        products = {}
+        for idx in range(20):
+            if idx % 4 == 1:
+                products['091-%05d' % idx] = installer(idx)
+            else:
+                products['041-%05d' % idx] = other_product(idx)
+        plistlib.writePlist({'CatalogVersion': 2,
+                             'IndexDate': datetime.datetime(2018, 5, 1),
+                             'Products': products}, self.path)
+        self.read_size = catalog.READ_SIZE
+
+    def tearDown(self):
+        catalog.READ_SIZE = self.read_size
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def expected(self):
+        expected = plistlib.readPlist(self.path)
+        expected['Products'] = dict(
+            (key, product) for key, product in expected['Products'].items()
+            if catalog.is_mac_os_installer(product))
+        return expected
+
+    def test_read_sizes(self):
+        expected = self.expected()
+        self.assertEqual(len(expected['Products']), 5)
+        for read_size in (1, 2, 3, 7, 64, 1000, 4096):
+            catalog.READ_SIZE = read_size
+            self.assertEqual(catalog.parse_sucatalog(self.path), expected,
+                             'read size %d' % read_size)
+
+    def test_split_in_product_tag(self):
+        '''A read boundary at every byte of an installer's opening tag'''
+        with open(self.path, 'rb') as fileobj:
+            data = fileobj.read()
+        expected = self.expected()
+        start = data.index('<dict>', data.index('<key>091-'))
+        for split in range(start, start + len('<dict>') + 1):
+            parser = catalog.CatalogParser()
+            parser.feed(data[:split])
+            parser.feed(data[split:])
+            self.assertEqual(parser.close(), expected, 'split at %d' % split)
+
+
+
+def key_for(idx):
+    return '091-%05d' % idx
+
+
+class ProductIndexTest(unittest.TestCase):
+    '''The index carries products over a republished catalog and keeps the
+    info a run adds to out of the index'''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='osreinstaller-test-')
+        self.fetched = []
+        self.saved = catalog.product_metadata, catalog.product_dist_info
+        catalog.product_metadata = self.product_metadata
+        catalog.product_dist_info = self.product_dist_info
+
+    def tearDown(self):
+        catalog.product_metadata, catalog.product_dist_info = self.saved
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def product_metadata(self, sucatalog, product_key, workdir,
+                         ignore_cache=False, progress=None):
+        self.fetched.append(('metadata', product_key, ignore_cache))
+        return {
+            'title': 'Install macOS High Sierra',
+            'version': '10.13.%d' % int(product_key[4:]),
+            'PostDate': str(sucatalog['Products'][product_key]['PostDate']),
+        }
+
+    def product_dist_info(self, sucatalog, product_key, workdir,
+                          ignore_cache=False, progress=None):
+        self.fetched.append(('dist', product_key, ignore_cache))
+        path = os.path.join(workdir, product_key + '.English.dist')
+        with open(path, 'w') as fileobj:
+            fileobj.write('<installer-gui-script/>')
+        return {'BUILD': '17B%d' % int(product_key[4:]),
+                'DistributionPath': path}
+
+    def package_path(self, product):
+        return catalog.fetch.local_path_for_url(
+            product['Packages'][0]['URL'], self.workdir)
+
+    def saved_index(self):
+        return plistlib.readPlist(os.path.join(self.workdir,
+                                               catalog.INDEX_NAME))
+
+    def test_changed_validator(self):
+        old_catalog = {'Products': {key_for(1): installer(1),
+                                    key_for(5): installer(5)}}
+        index = catalog.ProductIndex(self.workdir)
+        self.assertFalse(index.load('"etag-1"'))
+        product_key, dummy = catalog.select_installer(
+            old_catalog, self.workdir, index=index)
+        self.assertEqual(product_key, key_for(5))
+        saved = self.saved_index()
+        self.assertEqual(saved['validator'], '"etag-1"')
+        self.assertNotIn('DistributionPath', saved['product_info'][key_for(1)])
+        for info in saved['product_info'].values():
+            self.assertTrue(set(info) <= set(catalog.INDEX_FIELDS))
+
+        # 091-00005 is republished with another package, 091-00009 is new
+        republished = installer(5)
+        republished['Packages'][0]['URL'] = (
+            'http://example.com/091-00005-2/InstallESDDmg.pkg')
+        new_catalog = {'Products': {key_for(1): installer(1),
+                                    key_for(5): republished,
+                                    key_for(9): installer(9)}}
+        old_package = self.package_path(installer(5))
+        catalog.fetch.make_parent_dirs(old_package)
+        open(old_package, 'w').close()
+        index = catalog.ProductIndex(self.workdir)
+        self.assertFalse(index.load('"etag-2"'))
+        self.assertIsNotNone(index.previous)
+        index.carry_over(new_catalog)
+        self.assertEqual(sorted(index.carried), [key_for(1)])
+        self.assertEqual(index.stale, set([key_for(5)]))
+        self.assertFalse(os.path.exists(old_package))
+
+        carried = index.carried[key_for(1)]
+        self.fetched = []
+        product_key, product_info = catalog.select_installer(
+            new_catalog, self.workdir, build='17B1', index=index)
+        self.assertEqual(product_key, key_for(1))
+        self.assertEqual(product_info[key_for(1)]['BUILD'], '17B1')
+        self.assertNotIn('BUILD', carried)
+        self.assertEqual(sorted(self.fetched), [
+            ('dist', key_for(1), False),
+            ('dist', key_for(5), True),
+            ('dist', key_for(9), False),
+            ('metadata', key_for(5), True),
+            ('metadata', key_for(9), False),
+        ])
+        saved = self.saved_index()
+        self.assertEqual(saved['validator'], '"etag-2"')
+        self.assertEqual(saved['catalog'], new_catalog)
+        self.assertEqual(sorted(info['BUILD'] for info in
+                                saved['product_info'].values()),
+                         ['17B1', '17B5', '17B9'])
+
+    def test_hit_not_changed_by_run(self):
+        sucatalog = {'Products': {key_for(1): installer(1),
+                                  key_for(5): installer(5)}}
+        index = catalog.ProductIndex(self.workdir)
+        index.load('"etag-1"')
+        catalog.os_installer_product_info(sucatalog, self.workdir,
+                                          index=index)
+        index = catalog.ProductIndex(self.workdir)
+        self.assertTrue(index.load('"etag-1"'))
+        entry = index.product_info[key_for(5)]
+        self.fetched = []
+        product_key, product_info = catalog.select_installer(
+            sucatalog, self.workdir, build='17B5', index=index)
+        self.assertEqual(product_key, key_for(5))
+        product_info[key_for(5)]['Staged'] = True
+        product_info = catalog.os_installer_product_info(
+            sucatalog, self.workdir, index=index)
+        product_info[key_for(5)]['Staged'] = True
+        self.assertNotIn('Staged', entry)
+        self.assertNotIn('Staged', index.product_info[key_for(5)])
+        self.assertEqual(self.fetched, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
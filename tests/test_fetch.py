@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fetch.py
+#  OSReinstaller tests
+#
+#  The download engine against local origin servers: resuming a cancelled
+#  download, origins without Range support, missing files and data that
+#  doesn't match its digest.
+#
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import fetch
+from cache import PackageCache
+from connpool import ConnectionPool
+from fetch import (DownloadEngine, ReplicationError, CorruptDownload,
+                   local_path_for_url)
+from integrity import IntegrityError
+from mirrors import MirrorList
+from httpstub import StubServer, DirectoryServer
+
+PATH = '/content/pkgs/a.pkg'
+SEGMENT_SIZE = 1024 * 1024
+
+
+class DownloadEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(4 * SEGMENT_SIZE)
+        self.digest = hashlib.sha1(self.data).hexdigest()
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, 'client')
+        self.servers = []
+        self.saved = fetch.backoff_delay
+        fetch.backoff_delay = lambda attempt: 0
+
+    def tearDown(self):
+        fetch.backoff_delay = self.saved
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, server):
+        self.servers.append(server.start())
+        return server
+
+    def engine(self, **kwargs):
+        return DownloadEngine(workers=2, segment_size=SEGMENT_SIZE,
+                              pool=ConnectionPool(), mirrors=MirrorList(),
+                              cache=PackageCache(self.root), **kwargs)
+
+    def add(self, engine, url, digest=None):
+        return engine.add(url, local_path_for_url(url, self.root),
+                          size=len(self.data), digest=digest or self.digest)
+
+    def content(self, job):
+        with open(job.local_path, 'rb') as fileobj:
+            return fileobj.read()
+
+    def test_resume_after_cancel(self):
+        origin = self.start(StubServer({PATH: self.data}))
+        origin.rate = 4 * 1024 * 1024
+        url = origin.base + PATH[1:]
+        cancel_event = threading.Event()
+
+        def progress(done, dummy_total):
+            if done >= 2.5 * SEGMENT_SIZE:
+                cancel_event.set()
+
+        engine = self.engine(cancel_event=cancel_event, progress=progress)
+        job = self.add(engine, url)
+        self.assertRaises(ReplicationError, engine.run)
+        state = PackageCache(self.root).load_state(job.local_path)
+        completed = state['completed']
+        self.assertTrue(completed)
+        self.assertLess(len(completed), 4)
+
+        del origin.requests[:]
+        origin.rate = None
+        engine = self.engine()
+        job = self.add(engine, url)
+        engine.run()
+        self.assertEqual(self.content(job), self.data)
+        refetched = [int(requested[6:].split('-')[0])
+                     for dummy, requested in origin.requests]
+        self.assertEqual(sorted(refetched + completed),
+                         range(0, len(self.data), SEGMENT_SIZE))
+        self.assertIsNone(PackageCache(self.root).load_state(job.local_path))
+
+    def test_origin_without_range(self):
+        served = os.path.join(self.tmpdir, 'origin')
+        path = local_path_for_url(PATH, served)
+        fetch.make_parent_dirs(path)
+        with open(path, 'wb') as fileobj:
+            fileobj.write(self.data)
+        origin = self.start(DirectoryServer(served))
+        engine = self.engine()
+        job = self.add(engine, origin.base + PATH[1:])
+        engine.run()
+        self.assertEqual(self.content(job), self.data)
+        self.assertEqual(len(origin.requests), 1)
+        self.assertTrue(PackageCache(self.root).is_complete(
+            job.local_path, len(self.data), self.digest))
+
+    def test_missing_file(self):
+        origin = self.start(DirectoryServer(os.path.join(self.tmpdir,
+                                                         'origin')))
+        engine = self.engine()
+        self.add(engine, origin.base + PATH[1:])
+        with self.assertRaises(ReplicationError) as context:
+            engine.run()
+        self.assertIn('HTTP Error 404', str(context.exception))
+        # a client error isn't retried
+        self.assertEqual(len(origin.requests), 1)
+
+    def test_digest_mismatch(self):
+        origin = self.start(StubServer({PATH: self.data}))
+        engine = self.engine()
+        job = self.add(engine, origin.base + PATH[1:],
+                       digest=hashlib.sha1('other data').hexdigest())
+        with self.assertRaises(IntegrityError) as context:
+            engine.run()
+        self.assertIsInstance(context.exception, CorruptDownload)
+        self.assertIsInstance(job.error, IntegrityError)
+        # the only source would send the same bytes again
+        self.assertEqual(len(origin.requests), 4)
+        self.assertFalse(PackageCache(self.root).is_complete(
+            job.local_path, len(self.data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+#  test_imports.py
+#  OSReinstaller tests
+#
+#  The core modules and the command line entry point import without PyObjC,
+#  so they run on a headless machine. Each is imported in a fresh Python
+#  process, which reports the modules it loaded.
+#
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(os.path.dirname(HERE), 'OSReinstaller')
+
+CORE_MODULES = ('workflow', 'cli', 'catalog', 'fetch', 'imaging', 'install',
+                'peercache')
+# only the window needs these
+GUI_MODULES = ('objc', 'AppKit', 'Foundation', 'MainController')
+# imported when a dist file or the first download needs them
+LAZY_MODULES = ('xml.dom.minidom',)
+
+CHILD = '''
+import sys, json
+sys.path.insert(0, %r)
+import %s
+json.dump(sorted(sys.modules), sys.stdout)
+'''
+
+
+def modules_loaded_by(name):
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD % (SOURCE, name)])
+    return json.loads(output)
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_core_without_pyobjc(self):
+        for name in CORE_MODULES:
+            loaded = modules_loaded_by(name)
+            self.assertIn(name, loaded)
+            for module in GUI_MODULES + LAZY_MODULES:
+                self.assertNotIn(module, loaded,
+                                 'import %s loads %s' % (name, module))
+            self.assertEqual([module for module in loaded
+                              if module.startswith(('objc.', 'PyObjC'))],
+                             [], name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+#  test_mirrors.py
+#  OSReinstaller tests
+#
+#  Mirror ranking and failover of the download engine against local
+#  servers that fail, drop transfers, stall or send slowly.
+#
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import fetch
+from connpool import ConnectionPool
+from fetch import DownloadEngine, ReplicationError
+from mirrors import MirrorGroup, MirrorList
+from httpstub import StubServer
+
+PATH = '/content/pkgs/a.pkg'
+SEGMENT_SIZE = 1024 * 1024
+
+
+class MirrorMatchTest(unittest.TestCase):
+
+    def test_base_without_slash(self):
+        group = MirrorGroup(['http://a.example/content',
+                             'http://b.example/content/'])
+        self.assertEqual(group.match('http://a.example/content-old/a.pkg'),
+                         (None, None))
+        mirror, relative = group.match('http://a.example/content/a.pkg')
+        self.assertEqual(mirror.base, 'http://a.example/content/')
+        self.assertEqual(relative, 'a.pkg')
+        mirrors = MirrorList([['http://a.example/content',
+                               'http://b.example/content/']])
+        self.assertEqual(
+            mirrors.alternatives('http://a.example/content2/a.pkg'),
+            ['http://a.example/content2/a.pkg'])
+        self.assertFalse(mirrors.groups[0].probed)
+
+
+class ServerTestCase(unittest.TestCase):
+    '''Starts servers with a file at PATH and records backoff delays
+    instead of waiting them'''
+
+    def setUp(self):
+        self.data = os.urandom(3 * SEGMENT_SIZE)
+        self.servers = []
+        self.tmpdir = tempfile.mkdtemp()
+        self.delays = []
+        self.saved = fetch.backoff_delay, fetch.SLOW_GRACE
+
+        def backoff_delay(attempt):
+            self.delays.append(attempt)
+            return 0
+        fetch.backoff_delay = backoff_delay
+
+    def tearDown(self):
+        fetch.backoff_delay, fetch.SLOW_GRACE = self.saved
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def server(self):
+        server = StubServer({PATH: self.data}).start()
+        self.servers.append(server)
+        return server
+
+    def ranked(self, *servers):
+        '''A mirror list of servers, ranked in the given order without
+        probing them'''
+        mirrors = MirrorList([[server.base + 'content/'
+                               for server in servers]])
+        group = mirrors.groups[0]
+        group.probed = True
+        for idx, mirror in enumerate(group.mirrors):
+            mirror.rate = 1e9 / 10 ** idx
+        return mirrors
+
+    def download(self, url, mirrors, **kwargs):
+        '''Downloads url with the engine and returns the file's content'''
+        path = os.path.join(self.tmpdir, 'a.pkg')
+        engine = DownloadEngine(workers=2, segment_size=SEGMENT_SIZE,
+                                pool=ConnectionPool(), mirrors=mirrors,
+                                **kwargs)
+        engine.add(url, path, size=len(self.data),
+                   digest=hashlib.sha1(self.data).hexdigest())
+        engine.run()
+        with open(path, 'rb') as fileobj:
+            return fileobj.read()
+
+    def continued(self, server):
+        '''Range requests server got that don't start on a segment'''
+        return [requested for dummy, requested in server.requests
+                if requested and
+                int(requested[6:].split('-')[0]) % SEGMENT_SIZE]
+
+
+class ProbeTest(ServerTestCase):
+
+    def test_probe_ranking(self):
+        slow = self.server()
+        slow.rate = 1024 * 1024
+        failing = self.server()
+        failing.fail_count = -1
+        fast = self.server()
+        mirrors = MirrorList([[server.base + 'content'
+                               for server in (slow, failing, fast)]])
+        self.assertEqual(mirrors.alternatives(slow.base + PATH[1:]),
+                         [server.base + PATH[1:]
+                          for server in (fast, slow, failing)])
+        self.assertEqual(len(failing.requests), 1)
+        self.assertEqual([mirror.failures for mirror in mirrors.groups[0]
+                          .ranked()], [0, 0, 1])
+        # the ranking is measured once
+        mirrors.alternatives(fast.base + PATH[1:])
+        self.assertEqual(len(slow.requests), 1)
+
+
+class FailoverTest(ServerTestCase):
+
+    def test_stalled_segment_moves(self):
+        stalled = self.server()
+        stalled.stall_after = 2 * fetch.BLOCK_SIZE
+        good = self.server()
+        mirrors = self.ranked(stalled, good)
+        data = self.download(stalled.base + PATH[1:], mirrors,
+                             stall_timeout=0.5)
+        self.assertEqual(data, self.data)
+        # the first segment continued where the stalled transfer stopped
+        self.assertIn('bytes=%d-%d' % (2 * fetch.BLOCK_SIZE,
+                                       SEGMENT_SIZE - 1),
+                      self.continued(good))
+        self.assertEqual(mirrors.alternatives(stalled.base + PATH[1:])[0],
+                         good.base + PATH[1:])
+
+    def test_slow_segment_moves(self):
+        fetch.SLOW_GRACE = 0.2
+        slow = self.server()
+        slow.rate = 256 * 1024
+        fast = self.server()
+        mirrors = self.ranked(slow, fast)
+        data = self.download(slow.base + PATH[1:], mirrors)
+        self.assertEqual(data, self.data)
+        self.assertTrue(self.continued(fast))
+        self.assertGreaterEqual(mirrors.groups[0].mirrors[0].failures, 1)
+
+    def test_dropped_transfer_continues(self):
+        origin = self.server()
+        origin.drop_count = 1
+        origin.drop_after = fetch.BLOCK_SIZE
+        data = self.download(origin.base + PATH[1:], MirrorList())
+        self.assertEqual(data, self.data)
+        self.assertEqual(self.continued(origin),
+                         ['bytes=%d-%d' % (fetch.BLOCK_SIZE,
+                                           SEGMENT_SIZE - 1)])
+
+
+class RetryTest(ServerTestCase):
+
+    def test_backoff_delay(self):
+        backoff_delay = self.saved[0]
+        for attempt in range(1, 12):
+            ceiling = min(fetch.BACKOFF_BASE * 2 ** (attempt - 1),
+                          fetch.BACKOFF_MAX)
+            delay = backoff_delay(attempt)
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+
+    def test_unavailable_then_served(self):
+        origin = self.server()
+        origin.fail_count = 2
+        data = self.download(origin.base + PATH[1:], MirrorList())
+        self.assertEqual(data, self.data)
+        self.assertEqual(self.delays, [1, 2])
+
+    def test_gives_up_after_max_attempts(self):
+        origin = self.server()
+        origin.fail_count = -1
+        self.assertRaises(ReplicationError, self.download,
+                          origin.base + PATH[1:], MirrorList())
+        self.assertEqual(len(origin.requests), fetch.MAX_ATTEMPTS)
+        self.assertEqual(self.delays, range(1, fetch.MAX_ATTEMPTS))
+
+    def test_every_mirror_tried(self):
+        '''A round of attempts goes through all mirrors before a backoff'''
+        first = self.server()
+        first.fail_count = -1
+        second = self.server()
+        second.fail_count = -1
+        mirrors = self.ranked(first, second)
+        self.assertRaises(ReplicationError, self.download,
+                          first.base + PATH[1:], mirrors)
+        self.assertEqual(len(first.requests), fetch.MAX_ATTEMPTS)
+        self.assertEqual(len(second.requests), fetch.MAX_ATTEMPTS)
+        self.assertEqual(self.delays, range(1, fetch.MAX_ATTEMPTS))
+
+
+if __name__ == '__main__':
+    unittest.main()
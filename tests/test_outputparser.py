@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+#  test_outputparser.py
+#  OSReinstaller tests
+#
+#  Replays the transcripts in benchmarks/transcripts through a stub process
+#  and checks the events parse_output yields for them.
+#
+
+import os
+import sys
+import signal
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(ROOT, 'OSReinstaller'))
+
+import outputparser
+
+REPLAY = os.path.join(ROOT, 'benchmarks', 'stubs', 'replay.py')
+TRANSCRIPTS = os.path.join(ROOT, 'benchmarks', 'transcripts')
+# a parser that stops reading a pipe hangs; fail instead
+TIMEOUT = 30
+
+
+def transcript(name):
+    return os.path.join(TRANSCRIPTS, name + '.txt')
+
+
+def expected_events(name, table):
+    '''The events for a transcript, split into lines at once'''
+    with open(transcript(name), 'rb') as fileobj:
+        data = fileobj.read()
+    lines = data.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    events = [table.parse(line.decode('utf-8')) for line in lines]
+    return [(event.kind, event.text, event.percent)
+            for event in events if event is not None]
+
+
+def replay(name, table, *options):
+    '''Returns the process replaying a transcript and the events parsed
+    from it as (kind, text, percent) tuples'''
+    proc = subprocess.Popen(
+        [sys.executable, REPLAY, transcript(name)] + list(options),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    events = [(event.kind, event.text, event.percent)
+              for event in outputparser.parse_output(proc, table)]
+    return proc, events
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        def timed_out(dummy_signum, dummy_frame):
+            raise self.failureException('Timed out reading the output')
+        signal.signal(signal.SIGALRM, timed_out)
+        signal.alarm(TIMEOUT)
+
+    def tearDown(self):
+        signal.alarm(0)
+
+    def test_installer_partial_lines(self):
+        table = outputparser.installer_table()
+        expected = expected_events('installer', table)
+        self.assertIn((outputparser.PHASE, u'Preparing for installation…',
+                       None), expected)
+        for chunk in ('1', '3', '17', '4096'):
+            proc, events = replay('installer', table, '--chunk', chunk)
+            self.assertEqual(events, expected, 'chunk size %s' % chunk)
+            self.assertEqual(proc.returncode, 0)
+
+    def test_startosinstall_progress_lines(self):
+        table = outputparser.startosinstall_table()
+        proc, events = replay('startosinstall', table, '--chunk', '5')
+        self.assertEqual(events, expected_events('startosinstall', table))
+        percents = [percent for kind, dummy, percent in events
+                    if kind == outputparser.PERCENT]
+        self.assertEqual(percents, [step * 0.5 for step in range(201)])
+        self.assertEqual(events[-1][0], outputparser.DONE)
+
+    def test_output_after_exit(self):
+        table = outputparser.startosinstall_table()
+        proc, events = replay('startosinstall', table, '--after-exit', '100',
+                              '--exit-code', '3')
+        self.assertEqual(events, expected_events('startosinstall', table))
+        self.assertEqual(events[-1][0], outputparser.DONE)
+        self.assertEqual(proc.returncode, 3)
+
+    def test_stderr_drained(self):
+        '''More stderr than a pipe holds, written before any stdout'''
+        table = outputparser.installer_table()
+        proc, events = replay('installer', table, '--stderr-lines', '20000')
+        stderr = [event for event in events
+                  if event[0] == outputparser.STDERR]
+        self.assertEqual(len(stderr), 20000)
+        self.assertEqual(stderr[-1][1], u'replay: diagnostic message 19999')
+        self.assertEqual([event for event in events
+                          if event[0] != outputparser.STDERR],
+                         expected_events('installer', table))
+
+
+if __name__ == '__main__':
+    unittest.main()
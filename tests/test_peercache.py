@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+#  test_peercache.py
+#  OSReinstaller tests
+#
+#  Downloads through peer caches on ephemeral ports, with a stub origin
+#  server behind them.
+#
+
+import os
+import sys
+import shutil
+import socket
+import hashlib
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import fetch
+from cache import PackageCache, STATE_SUFFIX
+from connpool import ConnectionPool, HTTPError
+from fetch import DownloadEngine, local_path_for_url
+from mirrors import MirrorList
+from peercache import PeerCacheServer, DIGEST_PREFIX
+from httpstub import StubServer
+
+PATH = '/content/pkgs/a.pkg'
+SEGMENT_SIZE = 1024 * 1024
+
+
+def write_file(path, data):
+    fetch.make_parent_dirs(path)
+    with open(path, 'wb') as fileobj:
+        fileobj.write(data)
+
+
+def closed_port():
+    '''Returns a port nothing listens on'''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PeerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(3 * SEGMENT_SIZE)
+        self.digest = hashlib.sha1(self.data).hexdigest()
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin = StubServer({PATH: self.data}).start()
+        self.url = self.origin.base + PATH[1:]
+        self.peers = []
+        self.saved = fetch.backoff_delay
+        fetch.backoff_delay = lambda attempt: 0
+
+    def tearDown(self):
+        fetch.backoff_delay = self.saved
+        for peer in self.peers:
+            peer.stop()
+        self.origin.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def peer(self, name, data=None, indexed=False):
+        '''Starts a peer cache holding data at the path of self.url,
+        recorded in its cache index if indexed'''
+        root = os.path.join(self.tmpdir, name)
+        os.makedirs(root)
+        if data is not None:
+            path = local_path_for_url(self.url, root)
+            write_file(path, data)
+            if indexed:
+                PackageCache(root).record(path, self.digest)
+        peer = PeerCacheServer(root, port=0, host='127.0.0.1')
+        peer.start()
+        self.peers.append(peer)
+        return peer
+
+    def base(self, peer):
+        return 'http://127.0.0.1:%d' % peer.port
+
+    def download(self, peers):
+        '''Downloads self.url through peers. Returns the job and the file's
+        content.'''
+        root = os.path.join(self.tmpdir, 'client')
+        engine = DownloadEngine(workers=2, segment_size=SEGMENT_SIZE,
+                                pool=ConnectionPool(), mirrors=MirrorList(),
+                                peers=peers)
+        job = engine.add(self.url, local_path_for_url(self.url, root),
+                         size=len(self.data), digest=self.digest)
+        engine.run()
+        with open(job.local_path, 'rb') as fileobj:
+            return job, fileobj.read()
+
+    def test_fetched_by_digest(self):
+        peer = self.peer('peer', self.data, indexed=True)
+        job, data = self.download([self.base(peer)])
+        self.assertEqual(data, self.data)
+        self.assertEqual(job.source,
+                         self.base(peer) + DIGEST_PREFIX + self.digest)
+        self.assertEqual(self.origin.requests, [])
+        self.assertEqual(peer.bytes_served, len(self.data))
+
+    def test_digest_falls_back_to_path(self):
+        '''A peer that didn't verify the file itself is asked by path'''
+        peer = self.peer('peer', self.data)
+        job, data = self.download([self.base(peer)])
+        self.assertEqual(data, self.data)
+        self.assertEqual(job.source, self.base(peer) + PATH)
+        self.assertEqual(self.origin.requests, [])
+
+    def test_dead_peer_skipped(self):
+        peer = self.peer('peer', self.data)
+        dead = 'http://127.0.0.1:%d' % closed_port()
+        job, data = self.download([dead, self.base(peer)])
+        self.assertEqual(data, self.data)
+        self.assertEqual(job.source, self.base(peer) + PATH)
+        self.assertEqual(self.origin.requests, [])
+
+    def test_corrupt_peer_refetched_from_origin(self):
+        corrupt = self.data[:-1] + chr((ord(self.data[-1]) + 1) % 256)
+        peer = self.peer('peer', corrupt)
+        job, data = self.download([self.base(peer)])
+        self.assertEqual(data, self.data)
+        self.assertEqual(job.source, self.url)
+        self.assertTrue(self.origin.requests)
+        self.assertTrue(peer.bytes_served)
+
+    def test_unshared_files_refused(self):
+        peer = self.peer('peer', self.data, indexed=True)
+        root = peer.root_dir
+        for relative in ('logs/installer.log', 'artifacts/Install.dmg',
+                         'content/.hidden/a.pkg', 'content/pkgs/.a.pkg',
+                         'content/pkgs/b.pkg', 'content/pkgs/notes.txt',
+                         'a.pkg'):
+            write_file(os.path.join(root, relative), 'data')
+        write_file(os.path.join(root, 'content/pkgs/b.pkg' + STATE_SUFFIX),
+                   '')
+        self.assertEqual(peer.resolve(PATH),
+                         local_path_for_url(self.url, root))
+        for url_path in ('/logs/installer.log', '/artifacts/Install.dmg',
+                         '/content/.hidden/a.pkg', '/content/pkgs/.a.pkg',
+                         '/content/pkgs/b.pkg', '/content/pkgs/notes.txt',
+                         '/a.pkg', '/content/../logs/installer.log',
+                         '/content/pkgs/a.pkg' + STATE_SUFFIX,
+                         '/' + os.path.basename(PackageCache(root)
+                                                .index_path)):
+            self.assertIsNone(peer.resolve(url_path), url_path)
+        # a file being downloaded again isn't served by digest either
+        self.assertIsNotNone(peer.resolve(DIGEST_PREFIX + self.digest))
+        write_file(local_path_for_url(self.url, root) + STATE_SUFFIX, '')
+        self.assertIsNone(peer.resolve(DIGEST_PREFIX + self.digest))
+        self.assertIsNone(peer.resolve(PATH))
+        pool = ConnectionPool()
+        try:
+            with self.assertRaises(HTTPError) as context:
+                pool.request(self.base(peer) + '/logs/installer.log')
+            self.assertEqual(context.exception.code, 404)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
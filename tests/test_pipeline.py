@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+#  test_pipeline.py
+#  OSReinstaller tests
+#
+
+import os
+import sys
+import time
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'OSReinstaller'))
+
+import pipeline
+from pipeline import Pipeline, StageError
+
+
+class RecordingProcess(object):
+    '''Wraps a Popen and records terminate() calls'''
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.terminated = 0
+
+    def poll(self):
+        return self.proc.poll()
+
+    def terminate(self):
+        self.terminated += 1
+        self.proc.terminate()
+
+
+def failing_stage(dummy_pipeline):
+    raise RuntimeError('stage failed')
+
+
+class CancelCallbackTest(unittest.TestCase):
+
+    def run_pipeline(self, stages):
+        runner = Pipeline()
+        for name, func, deps in stages:
+            runner.add(name, func, deps)
+        with self.assertRaises(StageError) as context:
+            runner.run()
+        return runner, context.exception
+
+    def test_exited_process_not_terminated(self):
+        '''A stage whose process exited, then a later stage fails'''
+        procs = []
+
+        def tool_stage(runner):
+            with runner.terminating() as on_process:
+                proc = RecordingProcess(subprocess.Popen(['true']))
+                on_process(proc)
+                procs.append(proc)
+                proc.proc.wait()
+
+        runner, error = self.run_pipeline([
+            ('tool', tool_stage, ()),
+            ('fail', failing_stage, ('tool',)),
+        ])
+        self.assertEqual(error.stage, 'fail')
+        self.assertEqual(procs[0].terminated, 0)
+        self.assertEqual(runner._cancel_callbacks, [])
+
+    def test_callback_removed_after_block(self):
+        '''The callback is gone even before the process is reaped'''
+        runner = Pipeline()
+        with runner.terminating() as on_process:
+            proc = RecordingProcess(subprocess.Popen(['sleep', '5']))
+            on_process(proc)
+        try:
+            runner.cancel()
+            self.assertEqual(proc.terminated, 0)
+        finally:
+            proc.proc.kill()
+            proc.proc.wait()
+
+    def test_running_process_terminated(self):
+        '''A failing stage terminates the process of a running one'''
+        procs = []
+
+        def tool_stage(runner):
+            with runner.terminating() as on_process:
+                proc = RecordingProcess(subprocess.Popen(['sleep', '30']))
+                on_process(proc)
+                procs.append(proc)
+                proc.proc.wait()
+
+        def later_failing_stage(runner):
+            while not procs:
+                time.sleep(0.01)
+            raise RuntimeError('stage failed')
+
+        started = time.time()
+        runner, error = self.run_pipeline([
+            ('tool', tool_stage, ()),
+            ('fail', later_failing_stage, ()),
+        ])
+        self.assertEqual(error.stage, 'fail')
+        self.assertEqual(procs[0].terminated, 1)
+        self.assertLess(time.time() - started, 10)
+
+    def test_cancelled_before_start(self):
+        '''A process started after the cancel is terminated right away'''
+        runner = Pipeline()
+        runner.cancel()
+        with runner.terminating() as on_process:
+            proc = RecordingProcess(subprocess.Popen(['sleep', '30']))
+            on_process(proc)
+            proc.proc.wait()
+        self.assertEqual(proc.terminated, 1)
+        self.assertTrue(runner.cancelled.is_set())
+        self.assertRaises(pipeline.Cancelled, runner.check_cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main()